@@ -88,8 +88,10 @@ class AIAgentOrchestrator:
         - High-Demand Devices: {context.get('high_demand_devices', [])}
         - Low-Demand Devices: {context.get('low_demand_devices', [])}
         - Average Utilization: {context.get('avg_utilization', 0)}%
+        - Devices at Risk of Failure: {context.get('at_risk_devices', [])}
         
         Suggest 3 actionable steps to improve device utilization and reduce idle time.
+        Where devices are at risk of failure, say when to take them out for maintenance.
         """
         
         chat = LlmChat(
@@ -0,0 +1,270 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+import logging
+import math
+import os
+
+from caching import catalog_versions
+from models import DeviceStatus, SessionStatus
+from models_extended import MaintenanceStatus
+
+logger = logging.getLogger(__name__)
+
+OPEN_SESSION_STATUSES = (SessionStatus.ACTIVE.value, SessionStatus.EXTENDED.value)
+OPEN_MAINTENANCE_STATUSES = (MaintenanceStatus.SCHEDULED.value, MaintenanceStatus.IN_PROGRESS.value)
+# Scheduled visits have no end time; assume they take this long
+MAINTENANCE_WINDOW = timedelta(hours=float(os.environ.get('MAINTENANCE_WINDOW_HOURS', '2')))
+FOREVER = math.inf
+DEVICE_FIELDS = {"_id": 0, "id": 1, "cafe_id": 1, "device_type": 1, "status": 1, "name": 1, "hourly_rate": 1}
+
+def maintenance_scope(cafe_id: str) -> str:
+    return f"maintenance:{cafe_id}"
+
+def _timestamp(value) -> float:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+class DeviceCalendar:
+    """Busy intervals of one device, sorted by start.
+
+    ``reach[i]`` is the latest end among the first ``i + 1`` intervals, so an
+    overlap test is one bisect: the intervals starting before the window ends
+    overlap it iff the furthest any of them reaches is past the window start.
+    Adding or removing an interval only rewrites ``reach`` up to the first
+    entry it does not change.
+    """
+    __slots__ = ('intervals', 'reach', 'spans')
+
+    def __init__(self):
+        self.intervals: List[Tuple[float, float, str]] = []
+        self.reach: List[float] = []
+        self.spans: Dict[str, Tuple[float, float]] = {}
+
+    def add(self, key: str, start: float, end: float):
+        interval = (start, end, key)
+        i = bisect_left(self.intervals, interval)
+        self.intervals.insert(i, interval)
+        self.reach.insert(i, max(self.reach[i - 1], end) if i else end)
+        self.spans[key] = (start, end)
+        reach = self.reach
+        for j in range(i + 1, len(reach)):
+            if reach[j] >= end:
+                break
+            reach[j] = end
+
+    def remove(self, key: str):
+        span = self.spans.pop(key, None)
+        if span is None:
+            return
+        i = bisect_left(self.intervals, (*span, key))
+        del self.intervals[i], self.reach[i]
+        reach, intervals = self.reach, self.intervals
+        furthest = reach[i - 1] if i else -FOREVER
+        for j in range(i, len(reach)):
+            furthest = max(furthest, intervals[j][1])
+            if reach[j] == furthest:
+                break
+            reach[j] = furthest
+
+    def busy(self, start: float, end: float) -> bool:
+        i = bisect_left(self.intervals, (end,))
+        return i > 0 and self.reach[i - 1] > start
+
+    def free_from(self, start: float, length: float) -> float:
+        """Earliest time at or after ``start`` with ``length`` seconds free (inf if never)"""
+        candidate = start
+        for interval_start, interval_end, _ in self.intervals:
+            if interval_start >= candidate + length:
+                break
+            candidate = max(candidate, interval_end)
+        return candidate
+
+class DeviceEntry:
+    __slots__ = ('id', 'cafe_id', 'device_type', 'status', 'name', 'hourly_rate', 'calendar')
+
+    def __init__(self, device_id: str, cafe_id: str, device_type: str, status: str):
+        self.id = device_id
+        self.cafe_id = cafe_id
+        self.device_type = device_type
+        self.status = status
+        self.name = None
+        self.hourly_rate = None
+        self.calendar = DeviceCalendar()
+
+    def view(self) -> Dict:
+        return {
+            "id": self.id, "name": self.name, "device_type": self.device_type,
+            "status": self.status, "hourly_rate": self.hourly_rate
+        }
+
+class AvailabilityIndex:
+    """Per-process index of which devices are free, now or over a time window.
+
+    Devices are grouped per (cafe_id, device_type), with a set of the ones
+    whose status is AVAILABLE. Each device has a calendar of busy intervals:
+    open sessions (from their start, until they end), scheduled or running
+    maintenance, and whatever else is booked through ``block``. A device is
+    free over a window when it is AVAILABLE and nothing on its calendar
+    overlaps the window.
+
+    Routes in this process update the index as they write; session and device
+    changes from other workers arrive through the change feed. Maintenance
+    writes bump the ``maintenance:<cafe_id>`` change version and the cafe's
+    maintenance windows are reloaded on the next search there.
+    """
+
+    def __init__(self):
+        self._devices: Dict[str, DeviceEntry] = {}
+        self._groups: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self._free: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self._blocks: Dict[str, str] = {}
+        self._maintenance_versions: Dict[str, int] = {}
+
+    # ---- devices ----
+
+    def put_device(self, doc: Dict):
+        """Add or update a device from a ``devices`` document (or a partial one with id and status)"""
+        entry = self._devices.get(doc['id'])
+        if entry is None:
+            if 'device_type' not in doc or 'cafe_id' not in doc:
+                return  # not enough to place it; the next rebuild will
+            entry = self._devices[doc['id']] = DeviceEntry(doc['id'], doc['cafe_id'], doc['device_type'], doc['status'])
+            self._groups[(entry.cafe_id, entry.device_type)].add(entry.id)
+        elif doc.get('device_type', entry.device_type) != entry.device_type:
+            self._groups[(entry.cafe_id, entry.device_type)].discard(entry.id)
+            self._free[(entry.cafe_id, entry.device_type)].discard(entry.id)
+            entry.device_type = doc['device_type']
+            self._groups[(entry.cafe_id, entry.device_type)].add(entry.id)
+        entry.name = doc.get('name', entry.name)
+        entry.hourly_rate = doc.get('hourly_rate', entry.hourly_rate)
+        self.set_status(entry.id, doc.get('status', entry.status))
+
+    def set_status(self, device_id: str, status: str):
+        entry = self._devices.get(device_id)
+        if entry is None:
+            return
+        entry.status = status
+        free = self._free[(entry.cafe_id, entry.device_type)]
+        if status == DeviceStatus.AVAILABLE.value:
+            free.add(device_id)
+        else:
+            free.discard(device_id)
+
+    def remove_device(self, device_id: str):
+        entry = self._devices.pop(device_id, None)
+        if entry is None:
+            return
+        self._groups[(entry.cafe_id, entry.device_type)].discard(device_id)
+        self._free[(entry.cafe_id, entry.device_type)].discard(device_id)
+        for _, _, key in entry.calendar.intervals:
+            self._blocks.pop(key, None)
+
+    # ---- calendar ----
+
+    def block(self, key: str, device_id: str, start: float, end: float = FOREVER):
+        """Mark ``device_id`` busy over [start, end) under ``key``, replacing any earlier block with that key"""
+        self.release(key)
+        entry = self._devices.get(device_id)
+        if entry is None:
+            return
+        entry.calendar.add(key, start, end)
+        self._blocks[key] = device_id
+
+    def release(self, key: str):
+        device_id = self._blocks.pop(key, None)
+        if device_id is not None and device_id in self._devices:
+            self._devices[device_id].calendar.remove(key)
+
+    def apply_session(self, doc: Dict):
+        """Sync one session from its stored document; also a change feed listener"""
+        key = f"session:{doc['id']}"
+        if doc.get('status') in OPEN_SESSION_STATUSES:
+            self.block(key, doc['device_id'], _timestamp(doc['start_time']))
+        else:
+            self.release(key)
+
+    def apply_maintenance(self, doc: Dict):
+        key = f"maintenance:{doc['id']}"
+        if doc.get('status') not in OPEN_MAINTENANCE_STATUSES:
+            self.release(key)
+            return
+        start = _timestamp(doc['scheduled_date'])
+        end = FOREVER if doc['status'] == MaintenanceStatus.IN_PROGRESS.value else start + MAINTENANCE_WINDOW.total_seconds()
+        self.block(key, doc['device_id'], start, end)
+
+    async def maintenance_changed(self, db, cafe_id: str):
+        """Call after writing a cafe's maintenance records, so other workers reload them"""
+        await catalog_versions.bump(db, maintenance_scope(cafe_id))
+
+    async def _refresh_maintenance(self, db, cafe_id: str):
+        version = await catalog_versions.get(db, maintenance_scope(cafe_id))
+        if self._maintenance_versions.get(cafe_id) == version:
+            return
+        for key in [key for key, device_id in self._blocks.items()
+                    if key.startswith("maintenance:") and self._devices[device_id].cafe_id == cafe_id]:
+            self.release(key)
+        async for doc in db.device_maintenance.find(
+            {"cafe_id": cafe_id, "status": {"$in": list(OPEN_MAINTENANCE_STATUSES)}},
+            {"_id": 0, "id": 1, "device_id": 1, "status": 1, "scheduled_date": 1}
+        ):
+            self.apply_maintenance(doc)
+        self._maintenance_versions[cafe_id] = version
+
+    # ---- queries ----
+
+    def free_devices(self, cafe_id: str, device_type: str, start: float, end: float) -> List[DeviceEntry]:
+        """Devices of ``device_type`` in ``cafe_id`` that are free over [start, end)"""
+        devices = self._devices
+        return [
+            devices[device_id] for device_id in self._free.get((cafe_id, device_type), ())
+            if not devices[device_id].calendar.busy(start, end)
+        ]
+
+    def devices_of(self, cafe_id: str, device_type: str) -> List[DeviceEntry]:
+        return [self._devices[device_id] for device_id in self._groups.get((cafe_id, device_type), ())]
+
+    def counts(self, cafe_id: str) -> Dict[str, Dict[str, int]]:
+        """Total and currently available devices per type"""
+        return {
+            device_type: {"total": len(ids), "available": len(self._free.get((cafe, device_type), ()))}
+            for (cafe, device_type), ids in self._groups.items() if cafe == cafe_id and ids
+        }
+
+    def next_free(self, device_id: str, start: float, length: float) -> float:
+        """Earliest start at or after ``start`` when ``device_id`` is free for ``length`` seconds"""
+        entry = self._devices.get(device_id)
+        if entry is None or entry.status == DeviceStatus.MAINTENANCE.value:
+            return FOREVER
+        return entry.calendar.free_from(start, length)
+
+    async def search(self, db, cafe_id: str, device_type: str, start: float, end: float) -> List[DeviceEntry]:
+        await self._refresh_maintenance(db, cafe_id)
+        return self.free_devices(cafe_id, device_type, start, end)
+
+    async def rebuild(self, db):
+        """Reload every device, open session and open maintenance record"""
+        self._devices.clear()
+        self._groups.clear()
+        self._free.clear()
+        self._blocks.clear()
+        self._maintenance_versions.clear()
+        async for doc in db.devices.find({}, DEVICE_FIELDS):
+            self.put_device(doc)
+        async for doc in db.sessions.find(
+            {"status": {"$in": list(OPEN_SESSION_STATUSES)}},
+            {"_id": 0, "id": 1, "device_id": 1, "status": 1, "start_time": 1}
+        ):
+            self.apply_session(doc)
+        async for doc in db.device_maintenance.find(
+            {"status": {"$in": list(OPEN_MAINTENANCE_STATUSES)}},
+            {"_id": 0, "id": 1, "device_id": 1, "status": 1, "scheduled_date": 1}
+        ):
+            self.apply_maintenance(doc)
+        logger.info("Availability index rebuilt with %d devices", len(self._devices))
+
+availability_index = AvailabilityIndex()
@@ -0,0 +1,243 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import logging
+
+from pricing_engine import PricingTimeline, discounted
+
+logger = logging.getLogger(__name__)
+
+OPEN_SESSION_STATUSES = ("ACTIVE", "EXTENDED")
+
+def to_timestamp(value) -> float:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+class ActiveSession:
+    """Billing state of one open session.
+
+    Time is priced on the cafe's pricing timeline: ``hourly_rate / 60 *
+    (position(now) - position(started_at))``. Extensions are prepaid time:
+    the bill is whichever is larger, priced time or the ``prepaid`` amount,
+    so hours bought and then played are charged once. The coupon is applied
+    as a factor (percentage) or an amount taken off (fixed), once the charge
+    reaches its ``min_amount``, by the same ``discounted`` rule as quotes.
+    Without a prepayment or a minimum the bill is linear in priced time,
+    ``per_minute * minutes + constant``, which is what ``CafeMeter`` sums.
+    """
+    __slots__ = (
+        'session_id', 'cafe_id', 'device_id', 'customer_id', 'started_at',
+        'hourly_rate', 'prepaid', 'discount_type', 'discount_value', 'min_amount'
+    )
+
+    def __init__(
+        self,
+        session_id: str,
+        cafe_id: str,
+        device_id: str,
+        customer_id: str,
+        started_at: float,
+        hourly_rate: float,
+        prepaid: float = 0.0,
+        discount_type: Optional[str] = None,
+        discount_value: float = 0.0,
+        min_amount: float = 0.0
+    ):
+        self.session_id = session_id
+        self.cafe_id = cafe_id
+        self.device_id = device_id
+        self.customer_id = customer_id
+        self.started_at = started_at
+        self.hourly_rate = hourly_rate
+        self.prepaid = prepaid
+        self.discount_type = discount_type
+        self.discount_value = discount_value
+        self.min_amount = min_amount
+
+    @classmethod
+    def from_document(cls, doc: Dict, hourly_rate: Optional[float] = None) -> "ActiveSession":
+        """Build from a ``sessions`` document; ``hourly_rate`` covers documents stored without one"""
+        return cls(
+            session_id=doc['id'],
+            cafe_id=doc['cafe_id'],
+            device_id=doc['device_id'],
+            customer_id=doc.get('customer_id'),
+            started_at=to_timestamp(doc['start_time']),
+            hourly_rate=doc.get('hourly_rate') or hourly_rate or 0.0,
+            # While a session is open, total_amount only holds extension charges
+            prepaid=doc.get('total_amount') or 0.0,
+            discount_type=doc.get('coupon_discount_type') or ('fixed' if doc.get('coupon_discount') else None),
+            discount_value=doc.get('coupon_discount') or 0.0,
+            min_amount=doc.get('coupon_min_amount') or 0.0
+        )
+
+    @property
+    def linear(self) -> bool:
+        return not (self.prepaid or (self.discount_type and self.min_amount))
+
+    @property
+    def factor(self) -> float:
+        if self.discount_type == 'percentage':
+            return max(0.0, 1 - self.discount_value / 100)
+        return 1.0
+
+    @property
+    def per_minute(self) -> float:
+        return self.factor * self.hourly_rate / 60
+
+    @property
+    def constant(self) -> float:
+        return -self.discount_value if self.discount_type == 'fixed' else 0.0
+
+    def total(self, now: float, timeline: PricingTimeline) -> float:
+        priced_minutes = timeline.position(now) - timeline.position(self.started_at)
+        charge = max(self.hourly_rate * priced_minutes / 60, self.prepaid)
+        return float(discounted(charge, self.factor, -self.constant, self.min_amount))
+
+class CafeMeter:
+    """Sums of the linear terms of a cafe's open sessions, so its total is O(1).
+
+    Every session in a cafe is priced on the same timeline, so the sums stay
+    linear in ``timeline.position(now)``; a new timeline means re-summing once.
+    Extended sessions (prepaid time is billed as a floor) and sessions whose
+    coupon has a minimum are not linear, so those few are priced one by one
+    on top. Fixed coupons larger than a
+    session's bill so far are not clamped at zero in the sums, so the cafe
+    total can briefly read below the sum of session totals.
+    """
+    __slots__ = ('session_ids', 'timeline', 'per_minute', 'offset', 'nonlinear')
+
+    def __init__(self, timeline: PricingTimeline):
+        self.session_ids = set()
+        self.timeline = timeline
+        self.per_minute = 0.0
+        self.offset = 0.0
+        self.nonlinear: Dict[str, ActiveSession] = {}
+
+    def add(self, entry: ActiveSession, sign: int = 1):
+        if not entry.linear:
+            if sign > 0:
+                self.nonlinear[entry.session_id] = entry
+            else:
+                self.nonlinear.pop(entry.session_id, None)
+            return
+        self.per_minute += sign * entry.per_minute
+        self.offset += sign * (entry.constant - entry.per_minute * self.timeline.position(entry.started_at))
+
+    def total(self, now: float) -> float:
+        linear = self.per_minute * self.timeline.position(now) + self.offset
+        return linear + sum(entry.total(now, self.timeline) for entry in self.nonlinear.values())
+
+class BillingMeter:
+    """Per-process registry of open sessions and their running bills.
+
+    It is rebuilt from Mongo at startup, kept current by the session routes,
+    and fed session changes made by other workers through the change feed.
+    Cafes are priced flat until their compiled timeline is handed over with
+    ``set_timeline``.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, ActiveSession] = {}
+        self._cafes: Dict[str, CafeMeter] = {}
+        self._timelines: Dict[str, PricingTimeline] = {}
+        self._flat = PricingTimeline.flat()
+
+    def timeline(self, cafe_id: str) -> PricingTimeline:
+        return self._timelines.get(cafe_id, self._flat)
+
+    def set_timeline(self, cafe_id: str, timeline: PricingTimeline):
+        if self._timelines.get(cafe_id) is timeline:
+            return
+        self._timelines[cafe_id] = timeline
+        cafe = self._cafes.get(cafe_id)
+        if cafe is not None:
+            cafe.timeline = timeline
+            cafe.per_minute = cafe.offset = 0.0
+            cafe.nonlinear.clear()
+            for session_id in cafe.session_ids:
+                cafe.add(self._sessions[session_id])
+
+    def open(self, entry: ActiveSession):
+        self.close(entry.session_id)
+        self._sessions[entry.session_id] = entry
+        cafe = self._cafes.get(entry.cafe_id)
+        if cafe is None:
+            cafe = self._cafes[entry.cafe_id] = CafeMeter(self.timeline(entry.cafe_id))
+        cafe.session_ids.add(entry.session_id)
+        cafe.add(entry)
+
+    def close(self, session_id: str) -> Optional[ActiveSession]:
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return None
+        cafe = self._cafes[entry.cafe_id]
+        cafe.session_ids.discard(session_id)
+        if cafe.session_ids:
+            cafe.add(entry, sign=-1)
+        else:
+            # Reset instead of subtracting so float error cannot pile up
+            del self._cafes[entry.cafe_id]
+        return entry
+
+    def adjust(self, session_id: str, **changes):
+        """Change billing fields of an open session (extension charge, coupon, ...)"""
+        entry = self.close(session_id)
+        if entry is None:
+            return
+        for name, value in changes.items():
+            setattr(entry, name, value)
+        self.open(entry)
+
+    def apply_document(self, doc: Dict):
+        """Sync one session from its stored document, e.g. from the change feed"""
+        if doc.get('status') in OPEN_SESSION_STATUSES:
+            if doc.get('hourly_rate') is None and doc['id'] not in self._sessions:
+                return  # pre-rate session not seen at rebuild; it cannot be priced here
+            existing = self._sessions.get(doc['id'])
+            self.open(ActiveSession.from_document(doc, existing.hourly_rate if existing else None))
+        else:
+            self.close(doc['id'])
+
+    def get(self, session_id: str) -> Optional[ActiveSession]:
+        return self._sessions.get(session_id)
+
+    def session_total(self, session_id: str, now: Optional[float] = None) -> Optional[float]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        now = now if now is not None else datetime.now(timezone.utc).timestamp()
+        return entry.total(now, self.timeline(entry.cafe_id))
+
+    def cafe_total(self, cafe_id: str, now: Optional[float] = None) -> float:
+        cafe = self._cafes.get(cafe_id)
+        if cafe is None:
+            return 0.0
+        return cafe.total(now if now is not None else datetime.now(timezone.utc).timestamp())
+
+    def cafe_ids(self) -> List[str]:
+        """Cafes with at least one open session"""
+        return list(self._cafes)
+
+    def cafe_sessions(self, cafe_id: str) -> List[ActiveSession]:
+        cafe = self._cafes.get(cafe_id)
+        return [self._sessions[session_id] for session_id in cafe.session_ids] if cafe else []
+
+    async def rebuild(self, db):
+        """Reload every open session, looking up rates for sessions stored without one"""
+        sessions = await db.sessions.find(
+            {"status": {"$in": list(OPEN_SESSION_STATUSES)}}, {"_id": 0}
+        ).to_list(None)
+        missing = list({s['device_id'] for s in sessions if s.get('hourly_rate') is None})
+        rates = {}
+        if missing:
+            async for device in db.devices.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "hourly_rate": 1}):
+                rates[device['id']] = device['hourly_rate']
+
+        self._sessions.clear()
+        self._cafes.clear()
+        for doc in sessions:
+            self.open(ActiveSession.from_document(doc, rates.get(doc['device_id'], 100)))
+        logger.info("Billing meter rebuilt with %d open sessions", len(sessions))
+
+billing_meter = BillingMeter()
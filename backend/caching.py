@@ -0,0 +1,166 @@
+from fastapi import Request, Response
+from pymongo import ReturnDocument
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set
+import asyncio
+import hashlib
+import os
+import time
+
+CATALOG_CACHE_CONTROL = os.environ.get(
+    'CATALOG_CACHE_CONTROL',
+    'public, max-age=0, s-maxage=30, stale-while-revalidate=60'
+)
+
+PUBLIC_CACHE_SIZE = int(os.environ.get('PUBLIC_CACHE_SIZE', '2048'))
+PUBLIC_CACHE_TTL_SECONDS = float(os.environ.get('PUBLIC_CACHE_TTL_SECONDS', '60'))
+
+class ChangeVersions:
+    """Change counters per scope ("cafes", "cafe:<id>", "games:<cafe_id>", ...).
+
+    Every bump takes a number from one global sequence in ``change_counters``
+    and stores it as the scope's version, so versions only ever grow. Reads are
+    served from this process's copy; it is refreshed with a single query for
+    scopes changed since the last refresh, at most every ``refresh_seconds``.
+    Writes made by other workers therefore show up within that window, and
+    writes made here show up immediately.
+    """
+
+    def __init__(self, refresh_seconds: float = 1.0):
+        self.refresh_seconds = refresh_seconds
+        self._versions: Dict[str, int] = {}
+        self._high_water = 0
+        self._refreshed_at = float('-inf')
+        self._lock = asyncio.Lock()
+
+    async def get(self, db, scope: str) -> int:
+        if time.monotonic() - self._refreshed_at > self.refresh_seconds:
+            await self._refresh(db)
+        return self._versions.get(scope, 0)
+
+    async def bump(self, db, *scopes: str):
+        """Record a write to ``scopes``; call after the write has landed"""
+        seq_doc = await db.change_counters.find_one_and_update(
+            {"_id": "__seq__"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        version = seq_doc['version']
+        for scope in scopes:
+            await db.change_counters.update_one(
+                {"_id": scope}, {"$max": {"version": version}}, upsert=True
+            )
+            self._versions[scope] = max(self._versions.get(scope, 0), version)
+
+    async def _refresh(self, db):
+        async with self._lock:
+            if time.monotonic() - self._refreshed_at <= self.refresh_seconds:
+                return
+            changed = await db.change_counters.find(
+                {"version": {"$gt": self._high_water}, "_id": {"$ne": "__seq__"}}
+            ).to_list(None)
+            for doc in changed:
+                self._versions[doc['_id']] = max(self._versions.get(doc['_id'], 0), doc['version'])
+                self._high_water = max(self._high_water, doc['version'])
+            self._refreshed_at = time.monotonic()
+
+catalog_versions = ChangeVersions()
+
+async def catalog_etag(db, request: Request, *scopes: str) -> str:
+    """Weak ETag for a catalog response: the scopes' versions plus the request's query.
+
+    Compute it before reading Mongo. A write that lands in between then yields
+    new content under the old tag, which the next request replaces; the reverse
+    (old content under a new tag) cannot happen.
+    """
+    versions = [await catalog_versions.get(db, scope) for scope in scopes]
+    query = sorted(request.query_params.multi_items())
+    key = f"{request.url.path}|{query}|{versions}".encode()
+    return f'W/"{hashlib.blake2b(key, digest_size=8).hexdigest()}"'
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 response if the client's If-None-Match already covers ``etag``"""
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return None
+
+    # Weak comparison (RFC 9110 13.1.2): ignore the W/ prefix on both sides
+    candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    if '*' in candidates or etag.removeprefix('W/') in candidates:
+        return Response(status_code=304, headers=cache_headers(etag))
+    return None
+
+class ReadThroughCache:
+    """Bounded LRU cache with TTL and per-key single-flight loading.
+
+    Concurrent misses on one key share a single ``loader()`` call, so a burst
+    of identical requests costs one DB query. The load runs as its own task, so
+    a caller that disconnects does not fail the others waiting on it. Entries
+    carry tags; ``invalidate`` drops every entry with one of the given tags, and
+    a load that was in flight at that moment is returned to its waiters but not
+    stored.
+    """
+
+    def __init__(self, maxsize: int = PUBLIC_CACHE_SIZE, ttl_seconds: float = PUBLIC_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, tuple] = {}
+        self._tag_epochs: Dict[str, int] = {}
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]], tags: Iterable[str] = ()) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value, _ = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            tags = tuple(tags)
+            task = asyncio.ensure_future(self._load(key, loader, tags))
+            task.add_done_callback(lambda done: self._land(key, done))
+            flight = self._inflight[key] = (task, tags)
+        return await asyncio.shield(flight[0])
+
+    def invalidate(self, *tags: str):
+        """Drop entries tagged with any of ``tags``; call after the write has landed"""
+        targets: Set[str] = set(tags)
+        for tag in targets:
+            self._tag_epochs[tag] = self._tag_epochs.get(tag, 0) + 1
+        for key in [k for k, (_, _, entry_tags) in self._entries.items() if targets.intersection(entry_tags)]:
+            del self._entries[key]
+        for key in [k for k, (_, flight_tags) in self._inflight.items() if targets.intersection(flight_tags)]:
+            # Later callers start a fresh load instead of joining a stale one
+            del self._inflight[key]
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], tags: tuple) -> Any:
+        epochs = [self._tag_epochs.get(tag, 0) for tag in tags]
+        value = await loader()
+        if epochs == [self._tag_epochs.get(tag, 0) for tag in tags]:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, tags)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def _land(self, key: Hashable, task: asyncio.Task):
+        flight = self._inflight.get(key)
+        if flight is not None and flight[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+# Catalog reads keyed by their ETag, so a version bump is also a cache miss
+public_reads = ReadThroughCache()
+
+async def catalog_changed(db, *scopes: str):
+    """Write-path hook: new ETags for ``scopes`` and drop their cached reads"""
+    await catalog_versions.bump(db, *scopes)
+    public_reads.invalidate(*scopes)
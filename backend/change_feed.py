@@ -0,0 +1,186 @@
+from pymongo.errors import OperationFailure
+from typing import Callable, Dict, List, Optional
+import asyncio
+import logging
+import os
+import time
+
+from realtime import StatusHub, status_hub
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = float(os.environ.get('LIVE_POLL_INTERVAL_SECONDS', '2'))
+TOKEN_SAVE_INTERVAL_SECONDS = 5.0
+RETRY_DELAY_SECONDS = 5.0
+
+RESUME_TOKEN_ID = "live_status"
+# $changeStream needs a replica set (40573); very old servers lack the stage (40324)
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+CHANGE_STREAM_HISTORY_LOST = 286
+
+ACTIVE_SESSION_STATUSES = ["ACTIVE", "EXTENDED"]
+DEVICE_FIELDS = {"_id": 0, "id": 1, "cafe_id": 1, "device_type": 1, "status": 1, "name": 1, "hourly_rate": 1}
+SESSION_FIELDS = {
+    "_id": 0, "id": 1, "cafe_id": 1, "device_id": 1, "customer_id": 1, "status": 1,
+    "start_time": 1, "hourly_rate": 1, "total_amount": 1, "coupon_discount": 1, "coupon_discount_type": 1,
+    "coupon_min_amount": 1
+}
+
+class ChangeFeed:
+    """Fans out device and session changes made by any worker to this process's hub.
+
+    Each process runs one watcher: a change stream on ``devices`` and
+    ``sessions``, decoded once per event and published to local subscribers.
+    The resume token is saved to ``change_stream_tokens`` every few seconds,
+    so a restart picks up where the stream left off. A standalone mongod has
+    no change streams; in that case the feed polls instead: every cafe once
+    listeners are registered (they mirror all of them), otherwise only cafes
+    that currently have subscribers.
+
+    Session and device listeners get every decoded document, for state kept
+    in memory per process such as the billing meter.
+    """
+
+    def __init__(self, hub: StatusHub, poll_seconds: float = POLL_INTERVAL_SECONDS):
+        self.hub = hub
+        self.poll_seconds = poll_seconds
+        self.mode = "stopped"
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+        self._token_saved_at = 0.0
+        self._session_listeners: List[Callable[[Dict], None]] = []
+        self._device_listeners: List[Callable[[Dict], None]] = []
+
+    def add_session_listener(self, listener: Callable[[Dict], None]):
+        if listener not in self._session_listeners:
+            self._session_listeners.append(listener)
+
+    def add_device_listener(self, listener: Callable[[Dict], None]):
+        if listener not in self._device_listeners:
+            self._device_listeners.append(listener)
+
+    def start(self, db):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self, db):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._resume_token is not None:
+            await self._save_token(db)
+        self.mode = "stopped"
+
+    async def _run(self, db):
+        while True:
+            try:
+                await self._watch(db)
+            except OperationFailure as exc:
+                if exc.code in CHANGE_STREAMS_UNSUPPORTED:
+                    logger.info("Change streams unavailable, polling every %ss for live updates", self.poll_seconds)
+                    await self._poll(db)
+                    return
+                if exc.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Change stream resume point has left the oplog, starting from now")
+                    self._resume_token = None
+                    await db.change_stream_tokens.delete_one({"_id": RESUME_TOKEN_ID})
+                    continue
+                logger.exception("Change stream failed, retrying")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Change stream failed, retrying")
+            self.mode = "retrying"
+            await asyncio.sleep(RETRY_DELAY_SECONDS)
+
+    async def _watch(self, db):
+        if self._resume_token is None:
+            token_doc = await db.change_stream_tokens.find_one({"_id": RESUME_TOKEN_ID})
+            self._resume_token = token_doc['token'] if token_doc else None
+
+        pipeline = [
+            {"$match": {
+                "ns.coll": {"$in": ["devices", "sessions"]},
+                "operationType": {"$in": ["insert", "update", "replace"]}
+            }},
+            {"$project": {
+                "ns.coll": 1,
+                **{f"fullDocument.{name}": 1 for name in set(DEVICE_FIELDS) | set(SESSION_FIELDS) if name != "_id"}
+            }}
+        ]
+        async with db.watch(pipeline, full_document="updateLookup", resume_after=self._resume_token) as stream:
+            self.mode = "change_stream"
+            async for change in stream:
+                self.dispatch(change['ns']['coll'], change.get('fullDocument'))
+                self._resume_token = stream.resume_token
+                if time.monotonic() - self._token_saved_at > TOKEN_SAVE_INTERVAL_SECONDS:
+                    await self._save_token(db)
+
+    def dispatch(self, collection: str, doc: Optional[Dict]):
+        """Publish one decoded change; ``doc`` is None if it was deleted before lookup"""
+        if not doc or 'cafe_id' not in doc:
+            return
+        if collection == "devices":
+            self.hub.publish_device_status(doc['cafe_id'], doc['id'], doc['status'])
+            listeners = self._device_listeners
+        elif collection == "sessions":
+            self.hub.publish_session_status(doc['cafe_id'], doc['id'], doc['device_id'], doc['status'])
+            listeners = self._session_listeners
+        else:
+            return
+        for listener in listeners:
+            try:
+                listener(doc)
+            except Exception:
+                logger.exception("%s listener failed", collection)
+
+    async def _save_token(self, db):
+        await db.change_stream_tokens.update_one(
+            {"_id": RESUME_TOKEN_ID}, {"$set": {"token": self._resume_token}}, upsert=True
+        )
+        self._token_saved_at = time.monotonic()
+
+    async def _poll(self, db):
+        self.mode = "polling"
+        active_sessions: Dict[str, Dict] = {}
+        while True:
+            cafe_ids = self._poll_scope()
+            if cafe_ids is None or cafe_ids:
+                try:
+                    active_sessions = await self._poll_once(db, cafe_ids, active_sessions)
+                except Exception:
+                    logger.exception("Live update poll failed")
+            await asyncio.sleep(self.poll_seconds)
+
+    def _poll_scope(self) -> Optional[List[str]]:
+        """Cafes to poll; None for all of them"""
+        if self._session_listeners or self._device_listeners:
+            return None
+        return self.hub.cafe_ids()
+
+    async def _poll_once(self, db, cafe_ids: Optional[List[str]], previous: Dict[str, Dict]) -> Dict[str, Dict]:
+        # The hub drops statuses it has already seen, so republishing is cheap
+        scope = {} if cafe_ids is None else {"cafe_id": {"$in": cafe_ids}}
+        devices = await db.devices.find(scope, DEVICE_FIELDS).to_list(None)
+        for device in devices:
+            self.dispatch("devices", device)
+
+        sessions = await db.sessions.find(
+            {**scope, "status": {"$in": ACTIVE_SESSION_STATUSES}}, SESSION_FIELDS
+        ).to_list(None)
+        current = {session['id']: session for session in sessions}
+        for session in sessions:
+            self.dispatch("sessions", session)
+
+        ended = [session_id for session_id in previous if session_id not in current]
+        if ended:
+            async for session in db.sessions.find({"id": {"$in": ended}}, SESSION_FIELDS):
+                self.dispatch("sessions", session)
+        return current
+
+change_feed = ChangeFeed(status_hub)
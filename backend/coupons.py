@@ -0,0 +1,179 @@
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional, Tuple
+import asyncio
+import os
+import time
+import uuid
+
+from models import SessionStatus
+from caching import catalog_versions
+
+OPEN_SESSION_STATUSES = [SessionStatus.ACTIVE.value, SessionStatus.EXTENDED.value]
+
+COUPON_INDEX_RELOAD_SECONDS = float(os.environ.get('COUPON_INDEX_RELOAD_SECONDS', '600'))
+# Recently expired codes stay indexed so they are reported as expired, not unknown
+EXPIRED_COUPON_RETENTION = timedelta(days=30)
+COUPONS_SCOPE = "coupons"
+# Coupons are stamped before they are inserted, so one stamped earlier can land
+# after a newer one; incremental pulls reach back this far to catch it
+SYNC_OVERLAP = timedelta(seconds=5)
+
+def _as_datetime(value) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def coupon_in_window(coupon: Dict, now: datetime) -> bool:
+    return (
+        coupon.get('is_active', True)
+        and _as_datetime(coupon['valid_from']) <= now <= _as_datetime(coupon['valid_until'])
+    )
+
+def coupon_usable(coupon: Dict, now: datetime) -> bool:
+    """Active, in its validity window and not used up (as of this read)"""
+    if not coupon_in_window(coupon, now):
+        return False
+    return not (coupon.get('max_uses') and coupon.get('used_count', 0) >= coupon['max_uses'])
+
+class IndexedCoupon:
+    """What a lookup needs to know about a coupon, with its window pre-parsed"""
+    __slots__ = ('id', 'cafe_id', 'code', 'is_active', 'max_uses', 'valid_from', 'valid_until')
+
+    def __init__(self, doc: Dict):
+        self.id = doc['id']
+        self.cafe_id = doc['cafe_id']
+        self.code = doc['code']
+        self.is_active = doc.get('is_active', True)
+        self.max_uses = doc.get('max_uses')
+        self.valid_from = _as_datetime(doc['valid_from']).timestamp()
+        self.valid_until = _as_datetime(doc['valid_until']).timestamp()
+
+    def in_window(self, now: float) -> bool:
+        return self.is_active and self.valid_from <= now <= self.valid_until
+
+class CouponIndex:
+    """Per-process map of (cafe_id, code) to coupon, so unknown codes cost no query.
+
+    The map holds every active coupon that has not been expired for long, so
+    a miss is a definite "no such code". Writes through this process are
+    indexed straight away; writes through other workers bump the ``coupons``
+    change version, and the next lookup after that pulls only coupons created
+    since shortly before the newest one indexed. A full reload every
+    ``COUPON_INDEX_RELOAD_SECONDS`` catches edits made outside the API.
+
+    The index only screens lookups: usage limits and deactivation are still
+    enforced by the conditional update in ``redeem_coupon``.
+    """
+
+    def __init__(self, reload_seconds: float = COUPON_INDEX_RELOAD_SECONDS):
+        self.reload_seconds = reload_seconds
+        self._entries: Dict[Tuple[str, str], IndexedCoupon] = {}
+        self._version: Optional[int] = None
+        self._newest_created_at = ""
+        self._loaded_at = float('-inf')
+        self._lock = asyncio.Lock()
+
+    def put(self, doc: Dict):
+        entry = IndexedCoupon(doc)
+        if entry.is_active:
+            self._entries[(entry.cafe_id, entry.code)] = entry
+        else:
+            self._entries.pop((entry.cafe_id, entry.code), None)
+        self._newest_created_at = max(self._newest_created_at, doc.get('created_at') or "")
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._loaded_at > self.reload_seconds
+
+    async def refresh(self, db):
+        version = await catalog_versions.get(db, COUPONS_SCOPE)
+        if version == self._version and not self._is_stale():
+            return
+        async with self._lock:
+            if version == self._version and not self._is_stale():
+                return
+            cutoff = (datetime.now(timezone.utc) - EXPIRED_COUPON_RETENTION).isoformat()
+            query = {"is_active": True, "valid_until": {"$gte": cutoff}}
+            if self._is_stale():
+                self._entries.clear()
+                self._newest_created_at = ""
+                self._loaded_at = time.monotonic()
+            elif self._newest_created_at:
+                since = datetime.fromisoformat(self._newest_created_at) - SYNC_OVERLAP
+                query = {"created_at": {"$gte": since.isoformat()}}
+            async for doc in db.coupons.find(query, {"_id": 0}):
+                self.put(doc)
+
+            expired_before = time.time() - EXPIRED_COUPON_RETENTION.total_seconds()
+            for key in [key for key, entry in self._entries.items() if entry.valid_until < expired_before]:
+                del self._entries[key]
+            self._version = version
+
+    async def lookup(self, db, cafe_id: str, code: str) -> Optional[IndexedCoupon]:
+        await self.refresh(db)
+        return self._entries.get((cafe_id, code.upper()))
+
+    async def coupon_written(self, db, doc: Dict):
+        """Index a coupon written through this process and tell the other workers"""
+        self.put(doc)
+        await catalog_versions.bump(db, COUPONS_SCOPE)
+
+coupon_index = CouponIndex()
+
+async def redeem_coupon(db, code: str, session_doc: Dict) -> Dict:
+    """Redeem ``code`` on an open session and return the coupon.
+
+    Each step is a single atomic write, so concurrent redeemers cannot
+    oversell: a ``coupon_redemptions`` insert, unique on (coupon_id,
+    customer_id), allows one use per customer; a ``used_count`` increment
+    conditional on ``used_count < max_uses`` claims a use; and a session update
+    conditional on the session being open without a coupon attaches it. When
+    a later step fails the earlier ones are undone.
+    """
+    if session_doc.get('status') not in OPEN_SESSION_STATUSES:
+        raise HTTPException(status_code=400, detail="Session is not active")
+    if session_doc.get('coupon_code'):
+        raise HTTPException(status_code=400, detail="Session already has a coupon")
+
+    now = datetime.now(timezone.utc)
+    coupon = await coupon_index.lookup(db, session_doc['cafe_id'], code)
+    if coupon is None:
+        raise HTTPException(status_code=404, detail="Invalid coupon code")
+    if not coupon.in_window(now.timestamp()):
+        raise HTTPException(status_code=400, detail="Coupon expired or inactive")
+
+    redemption_id = str(uuid.uuid4())
+    try:
+        await db.coupon_redemptions.insert_one({
+            "id": redemption_id,
+            "coupon_id": coupon.id,
+            "customer_id": session_doc['customer_id'],
+            "session_id": session_doc['id'],
+            "created_at": now.isoformat()
+        })
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Coupon already used")
+
+    limit = {"used_count": {"$lt": coupon.max_uses}} if coupon.max_uses else {}
+    claimed = await db.coupons.find_one_and_update(
+        {"id": coupon.id, "is_active": True, **limit},
+        {"$inc": {"used_count": 1}},
+        projection={"_id": 0}
+    )
+    if claimed is None:
+        await db.coupon_redemptions.delete_one({"id": redemption_id})
+        raise HTTPException(status_code=400, detail="Coupon usage limit reached")
+
+    applied = await db.sessions.update_one(
+        {"id": session_doc['id'], "status": {"$in": OPEN_SESSION_STATUSES}, "coupon_code": None},
+        {"$set": {
+            "coupon_code": claimed['code'],
+            "coupon_discount": claimed['discount_value'],
+            "coupon_discount_type": claimed['discount_type'],
+            "coupon_min_amount": claimed.get('min_amount') or 0.0
+        }}
+    )
+    if applied.matched_count == 0:
+        await db.coupons.update_one({"id": coupon.id}, {"$inc": {"used_count": -1}})
+        await db.coupon_redemptions.delete_one({"id": redemption_id})
+        raise HTTPException(status_code=400, detail="Session already has a coupon or has ended")
+    return claimed
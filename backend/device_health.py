@@ -0,0 +1,239 @@
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import math
+import os
+import uuid
+
+from pagination import decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+HEALTH_COLLECTION = "device_health"
+# Free-form readings from before the time-series collection; renamed once copied over
+LEGACY_HEALTH_COLLECTION = "device_health_logs"
+MIGRATED_HEALTH_COLLECTION = "device_health_logs_migrated"
+HEALTH_RETENTION_DAYS = int(os.environ.get('HEALTH_RETENTION_DAYS', '30'))
+HEALTH_FLUSH_INTERVAL_SECONDS = float(os.environ.get('HEALTH_FLUSH_INTERVAL_SECONDS', '1'))
+HEALTH_FLUSH_BATCH_SIZE = int(os.environ.get('HEALTH_FLUSH_BATCH_SIZE', '5000'))
+# Readings held in memory at most; beyond this ingestion answers 503 until the writer catches up
+HEALTH_BUFFER_LIMIT = int(os.environ.get('HEALTH_BUFFER_LIMIT', '200000'))
+RETRY_AFTER_SECONDS = 5
+
+async def ensure_health_collection(db):
+    """Create the readings collection as a time-series collection (MongoDB 5.0+).
+
+    Readings are bucketed per (device, cafe, metric) under ``meta`` and expire
+    after ``HEALTH_RETENTION_DAYS``. Servers without time-series support get a
+    plain collection with a TTL index instead.
+    """
+    retention = HEALTH_RETENTION_DAYS * 86400
+    collection = db[HEALTH_COLLECTION]
+    if not await db.list_collection_names(filter={"name": HEALTH_COLLECTION}):
+        try:
+            await db.create_collection(
+                HEALTH_COLLECTION,
+                timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "seconds"},
+                expireAfterSeconds=retention
+            )
+        except CollectionInvalid:
+            pass  # another worker created it first
+        except OperationFailure:
+            logger.warning("Time-series collections unavailable, storing health readings in a plain collection")
+            await collection.create_index("timestamp", expireAfterSeconds=retention)
+    await collection.create_index([("meta.device_id", 1), ("timestamp", -1), ("id", -1)])
+
+def reading_document(device: Dict, metric: str, value: float, timestamp: Optional[datetime]) -> Dict:
+    """Stored shape of one reading; ``timestamp`` defaults to now and naive values are UTC"""
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc)
+    elif timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {
+        "id": str(uuid.uuid4()),
+        "timestamp": timestamp,
+        "meta": {"device_id": device['id'], "cafe_id": device['cafe_id'], "metric": metric},
+        "value": float(value)
+    }
+
+def reading_view(doc: Dict) -> Dict:
+    """API shape of a stored reading"""
+    timestamp = doc['timestamp']
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {
+        "id": doc['id'],
+        "device_id": doc['meta']['device_id'],
+        "metric": doc['meta']['metric'],
+        "value": doc['value'],
+        "timestamp": timestamp
+    }
+
+async def raw_readings(db, device_id: str, limit: int, cursor: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+    """One page of a device's readings, newest first, keyed on (timestamp, id)"""
+    query: Dict = {"meta.device_id": device_id}
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        try:
+            after = datetime.fromisoformat(sort_value)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [{"timestamp": {"$lt": after}}, {"timestamp": after, "id": {"$lt": doc_id}}]
+
+    docs = await db[HEALTH_COLLECTION].find(query, {"_id": 0}).sort(
+        [("timestamp", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    items = [reading_view(doc) for doc in docs[:limit]]
+    next_cursor = None
+    if len(docs) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last['timestamp'].isoformat(), last['id'])
+    return items, next_cursor
+
+async def migrate_legacy_readings(db, writer: "HealthWriter") -> int:
+    """One-off copy of ``device_health_logs`` into ``device_health``; returns the readings copied.
+
+    The old collection is renamed before it is read, so only one worker
+    copies it, and is kept under the new name afterwards. Its values were
+    stored as strings: rows that do not parse to a finite number, belong to
+    deleted devices or are past retention are skipped. Readings go through
+    ``writer`` so the rollups include them.
+    """
+    if not await db.list_collection_names(filter={"name": LEGACY_HEALTH_COLLECTION}):
+        return 0
+    try:
+        await db[LEGACY_HEALTH_COLLECTION].rename(MIGRATED_HEALTH_COLLECTION)
+    except OperationFailure:
+        return 0  # another worker is copying it
+    cutoff = datetime.now(timezone.utc) - timedelta(days=HEALTH_RETENTION_DAYS)
+    cafes: Dict[str, Optional[str]] = {}
+    copied = skipped = 0
+    async for doc in db[MIGRATED_HEALTH_COLLECTION].find({}, {"_id": 0}):
+        try:
+            value = float(doc['value'])
+            timestamp = doc['timestamp']
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            device_id, metric = doc['device_id'], doc['metric']
+        except (KeyError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if device_id not in cafes:
+            device = await db.devices.find_one({"id": device_id}, {"_id": 0, "cafe_id": 1})
+            cafes[device_id] = device['cafe_id'] if device else None
+        reading = reading_document({"id": device_id, "cafe_id": cafes[device_id]}, metric, value, timestamp)
+        if cafes[device_id] is None or not math.isfinite(value) or reading['timestamp'] < cutoff:
+            skipped += 1
+            continue
+        reading['id'] = doc.get('id') or reading['id']
+        writer.add([reading])
+        copied += 1
+        if writer.buffered >= writer.batch_size:
+            await writer.flush(db)
+    await writer.flush(db)
+    logger.info("Copied %d legacy health readings into %s (%d skipped)", copied, HEALTH_COLLECTION, skipped)
+    return copied
+
+class HealthWriter:
+    """Write-behind buffer between the ingestion endpoints and ``device_health``.
+
+    Requests only append to an in-memory list; a background task writes it out
+    with ``insert_many`` every ``flush_seconds``, or sooner once
+    ``batch_size`` readings are waiting. Flush listeners receive each batch
+    after it is stored (see health_rollups.py). A failed write puts the
+    batch back for the next flush, so delivery is at least once; readings
+    still buffered when a worker is killed are lost, which is acceptable for
+    telemetry. ``stop`` flushes what is left.
+    """
+
+    def __init__(
+        self,
+        flush_seconds: float = HEALTH_FLUSH_INTERVAL_SECONDS,
+        batch_size: int = HEALTH_FLUSH_BATCH_SIZE,
+        max_buffered: int = HEALTH_BUFFER_LIMIT
+    ):
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self._buffer: List[Dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_listeners: List[Callable[..., Awaitable[None]]] = []
+
+    def add_flush_listener(self, listener: Callable[..., Awaitable[None]]):
+        """``await listener(db, readings)`` runs after each stored batch"""
+        if listener not in self._flush_listeners:
+            self._flush_listeners.append(listener)
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def add(self, readings: List[Dict]):
+        if len(self._buffer) + len(readings) > self.max_buffered:
+            raise HTTPException(
+                status_code=503, detail="Health ingestion is backlogged, retry shortly",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+            )
+        self._buffer.extend(readings)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self, db):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self, db):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(db)
+
+    async def _run(self, db):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Health reading flush failed")
+
+    async def flush(self, db) -> int:
+        """Write out everything buffered so far; returns the number of readings stored"""
+        async with self._flush_lock:
+            stored = 0
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                try:
+                    await db[HEALTH_COLLECTION].insert_many(batch, ordered=False)
+                except BulkWriteError as exc:
+                    # Malformed readings cannot succeed on retry; keep the rest
+                    failed = {error['index'] for error in exc.details.get('writeErrors', [])}
+                    logger.warning("Dropped %d health readings rejected by MongoDB", len(failed))
+                    batch = [reading for i, reading in enumerate(batch) if i not in failed]
+                except Exception:
+                    self._buffer[:0] = batch
+                    raise
+                stored += len(batch)
+                for listener in self._flush_listeners:
+                    try:
+                        await listener(db, batch)
+                    except Exception:
+                        logger.exception("Health flush listener failed")
+            return stored
+
+health_writer = HealthWriter()
@@ -0,0 +1,81 @@
+from fastapi import HTTPException
+from pydantic import ValidationError
+from typing import Any, Dict, Iterable, List, Set, Tuple
+import csv
+import io
+import os
+
+from models import Device, DeviceCreate
+
+MAX_BULK_DEVICES = int(os.environ.get('MAX_BULK_DEVICES', '500'))
+MAX_CSV_BYTES = 1 << 20
+CSV_COLUMNS = ("name", "device_type", "hourly_rate", "specifications")
+REQUIRED_CSV_COLUMNS = {"name", "device_type", "hourly_rate"}
+
+def csv_rows(data: bytes) -> List[Tuple[int, Dict]]:
+    """(line number, row) pairs from an uploaded CSV with a header line"""
+    if len(data) > MAX_CSV_BYTES:
+        raise HTTPException(status_code=413, detail=f"CSV larger than {MAX_CSV_BYTES // 1024} KB")
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8")
+    reader = csv.DictReader(io.StringIO(text))
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or ()]
+    missing = REQUIRED_CSV_COLUMNS - set(reader.fieldnames)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"CSV is missing columns: {', '.join(sorted(missing))}")
+    return [
+        (reader.line_num, {key: (value.strip() or None) for key, value in row.items()
+                           if key in CSV_COLUMNS and isinstance(value, str)})
+        for row in reader
+    ]
+
+def _row_errors(row: Any) -> Tuple[List[str], Any]:
+    if not isinstance(row, dict):
+        return ["row must be an object"], None
+    try:
+        data = DeviceCreate.model_validate(row)
+    except ValidationError as exc:
+        return [f"{'.'.join(str(part) for part in error['loc']) or 'row'}: {error['msg']}" for error in exc.errors()], None
+    if data.hourly_rate <= 0:
+        return ["hourly_rate: must be greater than 0"], None
+    if not data.name.strip():
+        return ["name: must not be blank"], None
+    return [], data
+
+def validate_devices(rows: Iterable[Tuple[int, Any]], cafe_id: str, existing_names: Set[str]) -> Tuple[List[Dict], List[Dict]]:
+    """Check every row in one pass; returns (documents to insert, per-row results).
+
+    Names must be unique within the cafe, compared case-insensitively against
+    the cafe's devices and the other rows, so uploading the same sheet twice
+    creates nothing the second time.
+    """
+    rows = list(rows)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No devices to import")
+    if len(rows) > MAX_BULK_DEVICES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_DEVICES} devices per import")
+
+    docs, results = [], []
+    first_row: Dict[str, int] = {}
+    for row_number, row in rows:
+        errors, data = _row_errors(row)
+        result = {"row": row_number, "name": row.get('name') if isinstance(row, dict) else None, "id": None, "errors": errors}
+        results.append(result)
+        if data is None:
+            continue
+        key = data.name.strip().casefold()
+        if key in existing_names:
+            errors.append("name: a device with this name already exists in the cafe")
+        elif key in first_row:
+            errors.append(f"name: same as row {first_row[key]}")
+        first_row.setdefault(key, row_number)
+        if errors:
+            continue
+        device = Device(**data.model_dump(), cafe_id=cafe_id)
+        doc = device.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        docs.append(doc)
+        result['id'] = device.id
+    return docs, results
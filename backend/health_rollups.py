@@ -0,0 +1,274 @@
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import math
+import os
+import re
+
+import numpy as np
+
+from device_health import HEALTH_COLLECTION
+
+ROLLUP_COLLECTION = "device_health_rollups"
+MINUTE, HOUR = 60, 3600
+# Resolution name -> (bucket seconds, retention)
+RESOLUTIONS = {
+    "1m": (MINUTE, timedelta(days=int(os.environ.get('HEALTH_MINUTE_ROLLUP_DAYS', '7')))),
+    "1h": (HOUR, timedelta(days=int(os.environ.get('HEALTH_HOUR_ROLLUP_DAYS', '400')))),
+}
+MAX_POINTS = 1000
+
+# Histogram bins grow geometrically, so any quantile read from them is within
+# HISTOGRAM_ACCURACY of the true value, whatever the metric's scale
+HISTOGRAM_ACCURACY = 0.01
+_GAMMA = (1 + HISTOGRAM_ACCURACY) / (1 - HISTOGRAM_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_ZERO_BIN = "z"
+_MIN_MAGNITUDE = 1e-9
+
+STEP_PATTERN = re.compile(r"^(\d+)([smhd])$")
+STEP_UNITS = {"s": 1, "m": MINUTE, "h": HOUR, "d": 86400}
+# Used when the caller does not pick a step: the finest that keeps a chart readable
+CHART_STEPS = ["1m", "5m", "15m", "1h", "6h", "1d"]
+CHART_POINTS = 300
+
+def histogram_bin(value: float) -> str:
+    """Bin key of ``value``: its geometric bucket index, "n"-prefixed when negative"""
+    magnitude = abs(value)
+    if magnitude < _MIN_MAGNITUDE:
+        return _ZERO_BIN
+    index = math.ceil(math.log(magnitude) / _LOG_GAMMA)
+    return str(index) if value > 0 else f"n{index}"
+
+def _bin_value(key: str) -> float:
+    """Representative value of a bin (the midpoint of its bounds in relative terms)"""
+    if key == _ZERO_BIN:
+        return 0.0
+    negative = key.startswith("n")
+    index = int(key[1:] if negative else key)
+    value = 2 * _GAMMA ** index / (_GAMMA + 1)
+    return -value if negative else value
+
+def histogram_quantile(histogram: Dict[str, int], q: float) -> Optional[float]:
+    """Approximate ``q`` quantile of the values counted in ``histogram``"""
+    bins = sorted((_bin_value(key), count) for key, count in histogram.items() if count)
+    total = sum(count for _, count in bins)
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for value, count in bins:
+        seen += count
+        if seen > rank:
+            return value
+    return bins[-1][0]
+
+class Summary:
+    """count/sum/min/max plus a mergeable histogram of one metric over one window"""
+    __slots__ = ('count', 'sum', 'min', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.histogram: Dict[str, int] = {}
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        key = histogram_bin(value)
+        self.histogram[key] = self.histogram.get(key, 0) + 1
+
+    def merge(self, doc: Dict):
+        """Fold in a stored rollup bucket"""
+        self.count += doc['count']
+        self.sum += doc['sum']
+        self.min = min(self.min, doc['min'])
+        self.max = max(self.max, doc['max'])
+        for key, count in doc['hist'].items():
+            self.histogram[key] = self.histogram.get(key, 0) + count
+
+    def point(self, window_start: datetime) -> Dict:
+        # Bin midpoints can fall just outside the observed range
+        p95 = min(max(histogram_quantile(self.histogram, 0.95), self.min), self.max)
+        return {
+            "t": window_start, "count": self.count, "min": self.min, "max": self.max,
+            "avg": self.sum / self.count, "p95": p95
+        }
+
+def bucket_start(timestamp: datetime, seconds: int) -> datetime:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    epoch = int(timestamp.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, timezone.utc)
+
+def rollup_updates(readings: Iterable[Dict]) -> List[UpdateOne]:
+    """Upserts that fold ``readings`` into their 1m and 1h rollup buckets.
+
+    Readings are summed per bucket first, so a flush costs one write per
+    (device, metric, bucket) touched. Every field is updated with an
+    associative operator ($inc/$min/$max), so concurrent workers and
+    out-of-order readings land in the same totals.
+    """
+    buckets: Dict[Tuple, Summary] = {}
+    for reading in readings:
+        meta = reading['meta']
+        for resolution, (seconds, _) in RESOLUTIONS.items():
+            key = (meta['device_id'], meta['cafe_id'], meta['metric'], resolution,
+                   bucket_start(reading['timestamp'], seconds))
+            summary = buckets.get(key)
+            if summary is None:
+                summary = buckets[key] = Summary()
+            summary.add(reading['value'])
+
+    updates = []
+    for (device_id, cafe_id, metric, resolution, start), summary in buckets.items():
+        updates.append(UpdateOne(
+            {"_id": f"{device_id}:{metric}:{resolution}:{int(start.timestamp())}"},
+            {
+                "$setOnInsert": {
+                    "device_id": device_id, "cafe_id": cafe_id, "metric": metric,
+                    "resolution": resolution, "bucket": start,
+                    "expires_at": start + RESOLUTIONS[resolution][1]
+                },
+                "$inc": {
+                    "count": summary.count, "sum": summary.sum,
+                    **{f"hist.{key}": count for key, count in summary.histogram.items()}
+                },
+                "$min": {"min": summary.min},
+                "$max": {"max": summary.max}
+            },
+            upsert=True
+        ))
+    return updates
+
+async def apply_readings(db, readings: List[Dict]):
+    """HealthWriter flush listener: keep the rollups current as readings are stored"""
+    updates = rollup_updates(readings)
+    if updates:
+        await db[ROLLUP_COLLECTION].bulk_write(updates, ordered=False)
+
+async def ensure_rollup_indexes(db):
+    rollups = db[ROLLUP_COLLECTION]
+    await rollups.create_index([("device_id", 1), ("resolution", 1), ("metric", 1), ("bucket", 1)])
+    await rollups.create_index("expires_at", expireAfterSeconds=0)
+
+def parse_step(step: str) -> int:
+    match = STEP_PATTERN.match(step)
+    seconds = int(match.group(1)) * STEP_UNITS[match.group(2)] if match else 0
+    if not 0 < seconds <= 7 * 86400:
+        raise HTTPException(status_code=400, detail="step must look like 30s, 5m, 1h or 1d (at most 7d)")
+    return seconds
+
+def default_step(start: datetime, end: datetime) -> str:
+    span = (end - start).total_seconds()
+    for step in CHART_STEPS:
+        if span / parse_step(step) <= CHART_POINTS:
+            return step
+    return CHART_STEPS[-1]
+
+def _rollup_resolution(step_seconds: int) -> Optional[str]:
+    """Coarsest rollup whose buckets tile windows of ``step_seconds``"""
+    for resolution, (seconds, _) in sorted(RESOLUTIONS.items(), key=lambda item: -item[1][0]):
+        if step_seconds % seconds == 0:
+            return resolution
+    return None
+
+async def _from_rollups(db, device_id, metrics, resolution, start, end, step_seconds) -> Dict[str, Dict[int, Summary]]:
+    query = {"device_id": device_id, "resolution": resolution, "bucket": {"$gte": start, "$lt": end}}
+    if metrics:
+        query["metric"] = {"$in": metrics}
+    windows: Dict[str, Dict[int, Summary]] = {}
+    origin = int(start.timestamp())
+    async for doc in db[ROLLUP_COLLECTION].find(query, {"_id": 0, "metric": 1, "bucket": 1, "count": 1,
+                                                        "sum": 1, "min": 1, "max": 1, "hist": 1}):
+        bucket = doc['bucket'].replace(tzinfo=timezone.utc) if doc['bucket'].tzinfo is None else doc['bucket']
+        window = (int(bucket.timestamp()) - origin) // step_seconds
+        per_metric = windows.setdefault(doc['metric'], {})
+        summary = per_metric.get(window)
+        if summary is None:
+            summary = per_metric[window] = Summary()
+        summary.merge(doc)
+    return windows
+
+async def _from_readings(db, device_id, metrics, start, end, step_seconds) -> Dict[str, List[Dict]]:
+    """Exact statistics straight from raw readings, for steps finer than any rollup"""
+    query = {"meta.device_id": device_id, "timestamp": {"$gte": start, "$lt": end}}
+    if metrics:
+        query["meta.metric"] = {"$in": metrics}
+    docs = await db[HEALTH_COLLECTION].find(query, {"_id": 0, "meta.metric": 1, "timestamp": 1, "value": 1}).to_list(None)
+
+    by_metric: Dict[str, Tuple[list, list]] = {}
+    for doc in docs:
+        stamp = doc['timestamp']
+        if stamp.tzinfo is None:
+            stamp = stamp.replace(tzinfo=timezone.utc)
+        times, values = by_metric.setdefault(doc['meta']['metric'], ([], []))
+        times.append(stamp.timestamp())
+        values.append(doc['value'])
+
+    origin = start.timestamp()
+    series = {}
+    for metric, (times, values) in by_metric.items():
+        windows = ((np.asarray(times) - origin) // step_seconds).astype(np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        order = np.lexsort((values, windows))
+        windows, values = windows[order], values[order]
+        firsts = np.flatnonzero(np.r_[True, windows[1:] != windows[:-1]])
+        counts = np.diff(np.r_[firsts, len(values)])
+        sums = np.add.reduceat(values, firsts)
+        # Values are sorted within each window: min, max and p95 are positions
+        lasts = firsts + counts - 1
+        p95 = [np.percentile(values[first:last + 1], 95) for first, last in zip(firsts, lasts)]
+        series[metric] = [
+            {
+                "t": datetime.fromtimestamp(origin + int(windows[first]) * step_seconds, timezone.utc),
+                "count": int(count), "min": float(values[first]), "max": float(values[last]),
+                "avg": float(total / count), "p95": float(quantile)
+            }
+            for first, last, count, total, quantile in zip(firsts, lasts, counts, sums, p95)
+        ]
+    return series
+
+async def health_series(
+    db, device_id: str, start: datetime, end: datetime, step: Optional[str] = None,
+    metrics: Optional[List[str]] = None
+) -> Dict:
+    """min/max/avg/p95 per metric and window of ``step`` between ``start`` and ``end``.
+
+    Windows are aligned to multiples of ``step`` since the epoch; without a
+    step, one is picked that gives at most ``CHART_POINTS`` windows. Steps that
+    are whole hours read the 1h rollups, whole minutes the 1m rollups, and
+    anything finer is computed from the raw readings.
+    """
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    step = step or default_step(start, end)
+    step_seconds = parse_step(step)
+    start = bucket_start(start, step_seconds)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if (end - start).total_seconds() / step_seconds > MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Range too long for this step (at most {MAX_POINTS} points)")
+
+    resolution = _rollup_resolution(step_seconds)
+    if resolution is None:
+        series = await _from_readings(db, device_id, metrics, start, end, step_seconds)
+        source = "readings"
+    else:
+        windows = await _from_rollups(db, device_id, metrics, resolution, start, end, step_seconds)
+        series = {
+            metric: [
+                summary.point(start + timedelta(seconds=window * step_seconds))
+                for window, summary in sorted(per_window.items())
+            ]
+            for metric, per_window in windows.items()
+        }
+        source = f"rollup_{resolution}"
+    return {"device_id": device_id, "start": start, "end": end, "step": step, "source": source, "metrics": series}
@@ -0,0 +1,200 @@
+from pymongo.errors import DuplicateKeyError
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import parse_qsl
+import hashlib
+import os
+import time
+
+import orjson
+
+from auth import verify_token
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '4096'))
+# A claim older than this belongs to a worker that died mid-request
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+MAX_KEY_LENGTH = 255
+
+# POST endpoints that move money or open sessions; clients retry these
+IDEMPOTENT_PATHS = frozenset({
+    "/api/sessions",
+    "/api/wallet/add-money",
+    "/api/membership/purchase-pass",
+    "/api/referrals/apply",
+})
+
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETED = "COMPLETED"
+
+def request_fingerprint(method: str, path: str, query_string: bytes, body: bytes) -> str:
+    """Hash of what the request asks for; query parameter order does not matter"""
+    query = sorted(parse_qsl(query_string.decode('latin-1'), keep_blank_values=True))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{method} {path}?{query}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+def _caller(headers: Dict[bytes, bytes]) -> Optional[str]:
+    authorization = headers.get(b'authorization', b'').decode('latin-1')
+    if not authorization:
+        return None
+    try:
+        return verify_token(authorization.replace('Bearer ', '')).get('user_id')
+    except Exception:
+        return None
+
+def _error(status: int, detail: str) -> Tuple[int, list, bytes]:
+    return status, [(b'content-type', b'application/json')], orjson.dumps({"detail": detail})
+
+class IdempotencyMiddleware:
+    """Replays the stored response for a retried POST that carries an ``Idempotency-Key``.
+
+    Keys are scoped to the caller (the token's user) and live in the
+    ``idempotency_keys`` collection, expired by a TTL index after
+    ``IDEMPOTENCY_TTL_SECONDS``. The first request claims its key with an
+    insert, runs the handler and stores the response; a retry with the same
+    key and the same request gets that response back without the handler
+    running again. Completed responses are also kept in a bounded in-process
+    cache, so retries hitting the same worker skip the lookup.
+
+    A key reused for a different request is rejected with 422, and a retry
+    that arrives while the first attempt is still running gets 409. Server
+    errors are not stored: the claim is released so the retry runs again.
+    """
+
+    def __init__(self, app, db, paths: Iterable[str] = IDEMPOTENT_PATHS,
+                 cache_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.app = app
+        self.db = db
+        self.paths = frozenset(paths)
+        self.cache_size = cache_size
+        self._completed: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        key = headers.get(IDEMPOTENCY_HEADER.lower().encode(), b'').decode('latin-1').strip()
+        if not key:
+            return await self.app(scope, receive, send)
+        if len(key) > MAX_KEY_LENGTH:
+            return await self._send(send, *_error(400, f"{IDEMPOTENCY_HEADER} is too long"))
+        caller = _caller(headers)
+        if caller is None:
+            # Unauthenticated; let the route reject it
+            return await self.app(scope, receive, send)
+
+        body, receive = await self._buffer_body(receive)
+        fingerprint = request_fingerprint(scope['method'], scope['path'], scope.get('query_string', b''), body)
+        record_id = f"{caller}:{key}"
+
+        stored = await self._claim(record_id, fingerprint)
+        if stored is not None:
+            if stored['request_hash'] != fingerprint:
+                return await self._send(send, *_error(422, f"{IDEMPOTENCY_HEADER} was used for a different request"))
+            if stored['state'] != COMPLETED:
+                return await self._send(send, *_error(409, "A request with this Idempotency-Key is in progress"))
+            return await self._send(send, stored['status'], stored['headers'], stored['body'], replayed=True)
+
+        response = {"status": 500, "headers": [], "body": []}
+
+        async def capture(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = [[name, value] for name, value in message.get('headers', [])]
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture)
+        except BaseException:
+            await self.db.idempotency_keys.delete_one({"_id": record_id, "state": IN_PROGRESS})
+            raise
+
+        if response['status'] >= 500:
+            await self.db.idempotency_keys.delete_one({"_id": record_id, "state": IN_PROGRESS})
+            return
+        completed = {
+            "request_hash": fingerprint,
+            "state": COMPLETED,
+            "status": response['status'],
+            "headers": response['headers'],
+            "body": b''.join(response['body']),
+        }
+        await self.db.idempotency_keys.update_one({"_id": record_id}, {"$set": completed})
+        self._remember(record_id, completed)
+
+    async def _claim(self, record_id: str, fingerprint: str) -> Optional[Dict]:
+        """Claim ``record_id`` for this request, or return the record that holds it"""
+        cached = self._completed.get(record_id)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self._completed.move_to_end(record_id)
+                return cached[1]
+            del self._completed[record_id]
+
+        for _ in range(2):
+            now = datetime.now(timezone.utc)
+            try:
+                await self.db.idempotency_keys.insert_one({
+                    "_id": record_id, "request_hash": fingerprint, "state": IN_PROGRESS, "created_at": now
+                })
+                return None
+            except DuplicateKeyError:
+                pass
+            stored = await self.db.idempotency_keys.find_one({"_id": record_id})
+            if stored is None:
+                continue  # expired or released in between; claim again
+            if stored['state'] == COMPLETED:
+                stored['body'] = bytes(stored['body'])
+                self._remember(record_id, stored)
+                return stored
+            created_at = stored['created_at'].replace(tzinfo=timezone.utc)
+            if now - created_at < timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS):
+                return stored
+            # Abandoned claim: drop it and try once more
+            await self.db.idempotency_keys.delete_one(
+                {"_id": record_id, "state": IN_PROGRESS, "created_at": stored['created_at']}
+            )
+        return {"request_hash": fingerprint, "state": IN_PROGRESS}
+
+    def _remember(self, record_id: str, record: Dict):
+        self._completed[record_id] = (time.monotonic() + IDEMPOTENCY_TTL_SECONDS, record)
+        self._completed.move_to_end(record_id)
+        while len(self._completed) > self.cache_size:
+            self._completed.popitem(last=False)
+
+    @staticmethod
+    async def _buffer_body(receive):
+        """Read the whole request body and return it with a receive that replays it"""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body = b''.join(chunks)
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        return body, replay
+
+    @staticmethod
+    async def _send(send, status: int, headers, body: bytes, replayed: bool = False):
+        headers = [(bytes(name), bytes(value)) for name, value in headers]
+        if replayed:
+            headers.append((REPLAYED_HEADER.lower().encode(), b'true'))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
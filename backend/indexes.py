@@ -0,0 +1,73 @@
+from idempotency import IDEMPOTENCY_TTL_SECONDS
+from device_health import ensure_health_collection
+from health_rollups import ensure_rollup_indexes
+from reservations import HOLD_COLLECTION
+
+async def ensure_indexes(db):
+    """Create the indexes the routes rely on (idempotent, runs at startup)"""
+    # Lookups by id
+    for collection in (db.users, db.cafes, db.devices, db.sessions, db.games, db.coupons, db.reservations,
+                       db.waitlist):
+        await collection.create_index("id", unique=True)
+
+    # One redemption per (coupon, customer); see coupons.redeem_coupon
+    await db.coupon_redemptions.create_index([("coupon_id", 1), ("customer_id", 1)], unique=True)
+    await db.coupons.create_index([("code", 1), ("cafe_id", 1)])
+
+    # Wallet ledger, see wallet.py
+    await db.wallet_transactions.create_index("posting_id")
+    await db.wallet_transactions.create_index([("state", 1), ("created_at", 1)])
+    await db.users.create_index("pending_postings", sparse=True)
+    await db.wallet_transactions.create_index([("created_at", 1), ("id", 1)])
+    await db.wallet_checkpoints.create_index([("customer_id", 1), ("through_at", -1), ("through_id", -1)])
+
+    # Stored responses for Idempotency-Key retries, see idempotency.py
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+
+    # Device health readings (time-series), see device_health.py
+    await ensure_health_collection(db)
+    await ensure_rollup_indexes(db)
+    await db.device_risk.create_index([("cafe_id", 1), ("risk", -1)])
+
+    # Reservations: one slot hold per (device, slot) via _id, see reservations.py
+    await db[HOLD_COLLECTION].create_index("reservation_id")
+    await db[HOLD_COLLECTION].create_index("expires_at", expireAfterSeconds=0)
+    await db.reservations.create_index([("cafe_id", 1), ("status", 1), ("start_time", 1)])
+    await db.reservations.create_index([("cafe_id", 1), ("updated_at", 1)])
+
+    # Waitlist: served in (priority, joined_at, id) order, one waiting entry per customer and queue
+    await db.waitlist.create_index([("cafe_id", 1), ("device_type", 1), ("status", 1), ("priority", 1), ("joined_at", 1), ("id", 1)])
+    await db.waitlist.create_index(
+        [("cafe_id", 1), ("device_type", 1), ("customer_id", 1)],
+        unique=True, partialFilterExpression={"status": "WAITING"}
+    )
+    await db.waitlist.create_index([("customer_id", 1), ("status", 1), ("joined_at", -1)])
+
+    # Invoicing: one invoice per session, per-cafe serial numbers, see invoicing.py
+    await db.invoices.create_index(
+        "reference_id", unique=True, partialFilterExpression={"reference_id": {"$type": "string"}}
+    )
+    await db.invoices.create_index([("cafe_id", 1), ("invoice_number", 1)], unique=True)
+    await db.invoices.create_index([("cafe_id", 1), ("created_at", 1), ("invoice_number", 1)])
+    await db.sessions.create_index([("status", 1), ("invoice_id", 1), ("cafe_id", 1), ("end_time", 1), ("id", 1)])
+
+    # Keyset pagination: (<filter fields>, sort key, id), see pagination.py
+    await db.cafes.create_index([("created_at", -1), ("id", -1)])
+    await db.cafes.create_index([("owner_id", 1), ("created_at", -1), ("id", -1)])
+    await db.cafes.create_index([("is_active", 1), ("created_at", -1), ("id", -1)])
+    await db.devices.create_index([("created_at", -1), ("id", -1)])
+    await db.devices.create_index([("cafe_id", 1), ("created_at", -1), ("id", -1)])
+    await db.sessions.create_index([("created_at", -1), ("id", -1)])
+    await db.sessions.create_index([("cafe_id", 1), ("created_at", -1), ("id", -1)])
+    await db.sessions.create_index([("customer_id", 1), ("created_at", -1), ("id", -1)])
+    await db.games.create_index([("created_at", -1), ("id", -1)])
+    await db.games.create_index([("cafe_id", 1), ("created_at", -1), ("id", -1)])
+    await db.games.create_index([("device_types", 1), ("created_at", -1), ("id", -1)])
+    await db.passes.create_index([("customer_id", 1), ("created_at", -1), ("id", -1)])
+    await db.wallet_transactions.create_index([("customer_id", 1), ("created_at", -1), ("id", -1)])
+    await db.pricing_rules.create_index([("cafe_id", 1), ("created_at", -1), ("id", -1)])
+    await db.device_maintenance.create_index([("cafe_id", 1), ("scheduled_date", -1), ("id", -1)])
+    await db.invoices.create_index([("customer_id", 1), ("created_at", -1), ("id", -1)])
+    await db.reservations.create_index([("start_time", -1), ("id", -1)])
+    await db.reservations.create_index([("cafe_id", 1), ("start_time", -1), ("id", -1)])
+    await db.reservations.create_index([("customer_id", 1), ("start_time", -1), ("id", -1)])
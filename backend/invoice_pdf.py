@@ -0,0 +1,311 @@
+from fastapi import HTTPException
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import zipfile
+import zlib
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.environ.get('INVOICE_PDF_WORKERS', '2'))
+# Renders allowed to wait for a worker; more callers queue on the semaphore
+PDF_QUEUE_PER_WORKER = 8
+PDF_CACHE_DIR = os.environ.get('INVOICE_PDF_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'gamingcafe-invoice-pdfs')
+PDF_CACHE_MAX_BYTES = int(os.environ.get('INVOICE_PDF_CACHE_MB', '256')) << 20
+MAX_EXPORT_INVOICES = int(os.environ.get('MAX_EXPORT_INVOICES', '5000'))
+# Bump when the layout changes so cached files are rendered again
+LAYOUT_VERSION = 1
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+MARGIN = 50
+MAX_LINE_ITEMS = 30
+EXPORT_COLUMNS = ("invoice_number", "created_at", "customer_id", "reference_id", "amount", "tax_amount", "total_amount", "status")
+
+# ==================== RENDERING (runs in the worker processes) ====================
+
+def _text(value) -> bytes:
+    """A PDF string literal in WinAnsi; characters outside it print as '?'"""
+    data = str(value).encode('cp1252', errors='replace')
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+def _money(value) -> str:
+    return f"{float(value or 0):,.2f}"
+
+def _date(value) -> str:
+    return str(value or "")[:10]
+
+def render_invoice_pdf(invoice: Dict, cafe: Optional[Dict] = None, customer: Optional[Dict] = None) -> bytes:
+    """A one-page A4 invoice as PDF bytes.
+
+    Pure function of its arguments with no timestamps inside, so the same
+    invoice always renders to the same bytes. Amounts are set in Courier so
+    columns line up without font metrics.
+    """
+    cafe = cafe or {}
+    customer = customer or {}
+    ops: List[bytes] = []
+
+    def line(font: str, size: int, x: float, y: float, value):
+        ops.append(b"BT /%s %d Tf %.2f %.2f Td %s Tj ET" % (font.encode(), size, x, y, _text(value)))
+
+    def right(font: str, size: int, x: float, y: float, value):
+        # Courier glyphs are 0.6 em wide
+        line(font, size, x - len(str(value)) * size * 0.6, y, value)
+
+    y = PAGE_HEIGHT - MARGIN
+    line("F2", 20, MARGIN, y, "TAX INVOICE")
+    right("F3", 10, PAGE_WIDTH - MARGIN, y + 6, invoice.get('invoice_number', ''))
+    y -= 28
+    line("F2", 12, MARGIN, y, cafe.get('name') or "Gaming Cafe")
+    for text in (cafe.get('address'), cafe.get('city')):
+        if text:
+            y -= 14
+            line("F1", 10, MARGIN, y, text)
+
+    y -= 30
+    line("F2", 10, MARGIN, y, "Bill to")
+    line("F2", 10, 330, y, "Invoice date")
+    right("F3", 10, PAGE_WIDTH - MARGIN, y, _date(invoice.get('created_at')))
+    y -= 14
+    line("F1", 10, MARGIN, y, customer.get('name') or invoice.get('customer_id') or "")
+    line("F2", 10, 330, y, "Due date")
+    right("F3", 10, PAGE_WIDTH - MARGIN, y, _date(invoice.get('due_date')))
+    y -= 14
+    if customer.get('email'):
+        line("F1", 10, MARGIN, y, customer['email'])
+    line("F2", 10, 330, y, "Status")
+    right("F3", 10, PAGE_WIDTH - MARGIN, y, invoice.get('status', ''))
+
+    y -= 36
+    line("F2", 10, MARGIN, y, "Description")
+    right("F3", 10, 370, y, "Qty")
+    right("F3", 10, 460, y, "Rate")
+    right("F3", 10, PAGE_WIDTH - MARGIN, y, "Amount")
+    y -= 6
+    ops.append(b"%d %.2f m %d %.2f l S" % (MARGIN, y, PAGE_WIDTH - MARGIN, y))
+    items = invoice.get('line_items') or []
+    for item in items[:MAX_LINE_ITEMS]:
+        y -= 16
+        line("F1", 10, MARGIN, y, str(item.get('description', ''))[:55])
+        right("F3", 10, 370, y, f"{float(item.get('quantity') or 0):g}")
+        right("F3", 10, 460, y, _money(item.get('rate')))
+        right("F3", 10, PAGE_WIDTH - MARGIN, y, _money(item.get('amount')))
+    if len(items) > MAX_LINE_ITEMS:
+        y -= 16
+        line("F1", 10, MARGIN, y, f"... and {len(items) - MAX_LINE_ITEMS} more items")
+    y -= 10
+    ops.append(b"%d %.2f m %d %.2f l S" % (MARGIN, y, PAGE_WIDTH - MARGIN, y))
+
+    for label, value, font in (("Subtotal", invoice.get('amount'), "F1"),
+                               ("GST", invoice.get('tax_amount'), "F1"),
+                               ("Total (INR)", invoice.get('total_amount'), "F2")):
+        y -= 18
+        line(font, 11, 330, y, label)
+        right("F3", 11, PAGE_WIDTH - MARGIN, y, _money(value))
+
+    line("F1", 8, MARGIN, MARGIN, f"Reference {invoice.get('reference_id') or invoice.get('id', '')}")
+
+    content = zlib.compress(b"\n".join(ops))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+        b"/Resources << /Font << /F1 4 0 R /F2 5 0 R /F3 6 0 R >> >> /Contents 7 0 R >>" % (PAGE_WIDTH, PAGE_HEIGHT),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+        b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(content), content),
+    ]
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+# ==================== CACHE ====================
+
+def cache_key(invoice: Dict, cafe: Optional[Dict], customer: Optional[Dict]) -> str:
+    """``<invoice id>-<version>``, the version being a digest of everything printed"""
+    digest = hashlib.sha1(orjson.dumps(
+        [LAYOUT_VERSION, invoice, cafe, customer], option=orjson.OPT_SORT_KEYS, default=str
+    )).hexdigest()[:16]
+    return f"{invoice['id']}-{digest}"
+
+class PdfCache:
+    """Rendered PDFs on local disk, least recently used evicted past ``max_bytes``.
+
+    The index of files and sizes is per process, loaded from the directory on
+    first use; files other server processes wrote are picked up when read,
+    so the bound is approximate when several share the directory. Writes go
+    through a temporary file and a rename, so readers never see half a PDF.
+    """
+
+    def __init__(self, directory: str = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._sizes: Optional["OrderedDict[str, int]"] = None
+        self._total = 0
+        # get and put run on worker threads
+        self._lock = threading.Lock()
+
+    def _index(self) -> "OrderedDict[str, int]":
+        if self._sizes is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            files = []
+            for path in self.directory.glob("*.pdf"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, path.stem, stat.st_size))
+            self._sizes = OrderedDict((key, size) for _, key, size in sorted(files))
+            self._total = sum(self._sizes.values())
+        return self._sizes
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            self._index()
+            return self._total
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.pdf"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        sizes = self._index()
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            if key in sizes:
+                self._total -= sizes.pop(key)
+            return None
+        if key not in sizes:
+            sizes[key] = len(data)
+            self._total += len(data)
+        sizes.move_to_end(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self._evict()
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._put(key, data)
+
+    def _put(self, key: str, data: bytes):
+        sizes = self._index()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        self._total += len(data) - sizes.pop(key, 0)
+        sizes[key] = len(data)
+        self._evict()
+
+    def _evict(self):
+        sizes = self._sizes
+        while self._total > self.max_bytes and len(sizes) > 1:
+            key, size = sizes.popitem(last=False)
+            self._total -= size
+            self._path(key).unlink(missing_ok=True)
+
+# ==================== SERVICE ====================
+
+class InvoicePdfService:
+    """Renders invoice PDFs in a bounded process pool, in front of a ``PdfCache``.
+
+    Rendering is CPU work, so it runs in ``workers`` spawned processes and
+    the event loop only awaits the result. At most ``workers *
+    PDF_QUEUE_PER_WORKER`` renders are submitted at once; further callers
+    wait their turn. Concurrent requests for the same version share one
+    render. The pool starts on first use.
+    """
+
+    def __init__(self, workers: int = PDF_WORKERS, cache: Optional[PdfCache] = None):
+        self.workers = workers
+        self.cache = cache or PdfCache()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(workers * PDF_QUEUE_PER_WORKER)
+        self._rendering: Dict[str, asyncio.Future] = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, not fork: the server process holds driver threads and sockets
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _render(self, key: str, invoice: Dict, cafe: Optional[Dict], customer: Optional[Dict]) -> bytes:
+        async with self._slots:
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(
+                    self._executor(), render_invoice_pdf, invoice, cafe, customer
+                )
+            except BrokenProcessPool:
+                logger.exception("Invoice PDF worker died; restarting the pool")
+                self._pool = None
+                raise HTTPException(status_code=503, detail="PDF rendering unavailable, retry shortly")
+        await asyncio.to_thread(self.cache.put, key, data)
+        return data
+
+    async def pdf(self, invoice: Dict, cafe: Optional[Dict] = None, customer: Optional[Dict] = None) -> bytes:
+        """The invoice's PDF, from the cache when this version was rendered before"""
+        key = cache_key(invoice, cafe, customer)
+        data = await asyncio.to_thread(self.cache.get, key)
+        if data is not None:
+            return data
+        pending = self._rendering.get(key)
+        if pending is None:
+            pending = self._rendering[key] = asyncio.ensure_future(self._render(key, invoice, cafe, customer))
+            pending.add_done_callback(lambda _: self._rendering.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def export_zip(self, invoices: List[Dict], cafe: Optional[Dict], customers: Dict[str, Dict]) -> bytes:
+        """One PDF per invoice plus an ``invoices.csv`` summary, zipped"""
+        pdfs = await asyncio.gather(*(
+            self.pdf(invoice, cafe, customers.get(invoice.get('customer_id'))) for invoice in invoices
+        ))
+        return await asyncio.to_thread(_zip, zip(invoices, pdfs))
+
+def _zip(entries: Iterable[Tuple[Dict, bytes]]) -> bytes:
+    buffer = io.BytesIO()
+    summary = io.StringIO()
+    writer = csv.DictWriter(summary, fieldnames=EXPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for invoice, pdf in entries:
+            archive.writestr(f"{invoice.get('invoice_number') or invoice['id']}.pdf", pdf)
+            writer.writerow(invoice)
+        archive.writestr("invoices.csv", summary.getvalue())
+    return buffer.getvalue()
+
+invoice_pdfs = InvoicePdfService()
@@ -0,0 +1,170 @@
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Sequence
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from models import SessionStatus
+from models_extended import InvoiceStatus
+
+logger = logging.getLogger(__name__)
+
+GST_RATE = float(os.environ.get('GST_RATE', '0.18'))
+GST_BASIS_POINTS = round(GST_RATE * 10000)
+INVOICE_DUE_DAYS = 7
+INVOICE_BATCH_SIZE = int(os.environ.get('INVOICE_BATCH_SIZE', '1000'))
+COUNTER_COLLECTION = "invoice_counters"
+SESSION_FIELDS = {"_id": 0, "id": 1, "cafe_id": 1, "customer_id": 1, "device_id": 1,
+                  "status": 1, "total_amount": 1, "duration_hours": 1}
+
+def invoice_number(cafe_id: str, sequence: int) -> str:
+    """Per-cafe serial, e.g. INV-3F2A91-000042"""
+    return f"INV-{cafe_id[:6].upper()}-{sequence:06d}"
+
+async def allocate_numbers(db, cafe_id: str, count: int) -> int:
+    """Reserve ``count`` consecutive numbers of the cafe's sequence; returns the first.
+
+    One atomic $inc per block, so concurrent jobs and single invoices get
+    disjoint ranges and numbers only grow.
+    """
+    before = await db[COUNTER_COLLECTION].find_one_and_update(
+        {"_id": cafe_id},
+        {"$inc": {"next": count}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    return (before or {}).get('next', 0) + 1
+
+def build_invoices(sessions: Sequence[Dict], numbers: Sequence[str], now: datetime) -> List[Dict]:
+    """Invoice documents for completed sessions, one per session, numbered from ``numbers``.
+
+    Amounts and GST are worked out in whole paise for the whole batch with
+    numpy, so totals carry no float residue.
+    """
+    count = len(sessions)
+    paise = np.rint(np.fromiter((s.get('total_amount') or 0.0 for s in sessions), dtype=float, count=count) * 100).astype(np.int64)
+    hours = np.fromiter((s.get('duration_hours') or 0.0 for s in sessions), dtype=float, count=count)
+    # Half a paisa of tax rounds up
+    tax_paise = (paise * GST_BASIS_POINTS + 5000) // 10000
+    amounts, taxes, totals = paise / 100, tax_paise / 100, (paise + tax_paise) / 100
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = np.round(np.where(hours > 0, amounts / hours, amounts), 2)
+
+    created_at = now.isoformat()
+    due_date = (now + timedelta(days=INVOICE_DUE_DAYS)).isoformat()
+    invoices = []
+    for session, number, amount, tax, total, quantity, rate in zip(
+        sessions, numbers, amounts.tolist(), taxes.tolist(), totals.tolist(), hours.tolist(), rates.tolist()
+    ):
+        invoices.append({
+            "id": str(uuid.uuid4()),
+            "invoice_number": number,
+            "cafe_id": session['cafe_id'],
+            "customer_id": session['customer_id'],
+            "reference_id": session['id'],
+            "amount": amount,
+            "tax_amount": tax,
+            "total_amount": total,
+            "status": InvoiceStatus.PAID.value if session.get('status') == SessionStatus.COMPLETED.value else InvoiceStatus.DRAFT.value,
+            "line_items": [{
+                "description": f"Gaming Session - Device {session['device_id'][:8]}",
+                "quantity": quantity,
+                "rate": rate,
+                "amount": amount
+            }],
+            "due_date": due_date,
+            "created_at": created_at
+        })
+    return invoices
+
+async def _mark_invoiced(db, invoice_ids: Dict[str, str]):
+    """Record on each session which invoice covers it, so the next run skips it"""
+    if invoice_ids:
+        await db.sessions.bulk_write([
+            UpdateOne({"id": session_id}, {"$set": {"invoice_id": invoice_id}})
+            for session_id, invoice_id in invoice_ids.items()
+        ], ordered=False)
+
+async def invoice_for_session(db, session_doc: Dict) -> Dict:
+    """The invoice for one session, creating it on first call"""
+    existing = await db.invoices.find_one({"reference_id": session_doc['id']}, {"_id": 0})
+    if existing:
+        return existing
+    first = await allocate_numbers(db, session_doc['cafe_id'], 1)
+    invoice = build_invoices([session_doc], [invoice_number(session_doc['cafe_id'], first)], datetime.now(timezone.utc))[0]
+    try:
+        await db.invoices.insert_one(invoice)
+    except DuplicateKeyError:
+        # A concurrent call for the same session won; reference_id is unique
+        return await db.invoices.find_one({"reference_id": session_doc['id']}, {"_id": 0})
+    invoice.pop('_id', None)
+    await _mark_invoiced(db, {session_doc['id']: invoice['id']})
+    return invoice
+
+async def _invoice_chunk(db, sessions: List[Dict], now: datetime) -> Dict[str, int]:
+    # Sessions invoiced one at a time before they were marked
+    existing = {
+        doc['reference_id']: doc['id']
+        async for doc in db.invoices.find(
+            {"reference_id": {"$in": [s['id'] for s in sessions]}}, {"_id": 0, "id": 1, "reference_id": 1}
+        )
+    }
+    await _mark_invoiced(db, existing)
+    sessions = [s for s in sessions if s['id'] not in existing]
+
+    by_cafe: Dict[str, List[int]] = {}
+    for i, session in enumerate(sessions):
+        by_cafe.setdefault(session['cafe_id'], []).append(i)
+    numbers = [""] * len(sessions)
+    for cafe_id, positions in by_cafe.items():
+        first = await allocate_numbers(db, cafe_id, len(positions))
+        for offset, i in enumerate(positions):
+            numbers[i] = invoice_number(cafe_id, first + offset)
+
+    invoices = build_invoices(sessions, numbers, now)
+    created = {invoice['reference_id']: invoice['id'] for invoice in invoices}
+    if invoices:
+        try:
+            await db.invoices.insert_many(invoices, ordered=False)
+        except BulkWriteError as exc:
+            # Another run invoiced some of these sessions meanwhile; theirs stand
+            failed = {invoices[error['index']]['reference_id'] for error in exc.details.get('writeErrors', [])}
+            logger.warning("Skipped %d sessions invoiced concurrently", len(failed))
+            for session_id in failed:
+                created.pop(session_id)
+    await _mark_invoiced(db, created)
+    return {"invoiced": len(created), "skipped": len(existing) + len(invoices) - len(created)}
+
+async def run_invoicing(
+    db, cafe_ids: Optional[List[str]] = None, until: Optional[datetime] = None,
+    batch_size: int = INVOICE_BATCH_SIZE
+) -> Dict:
+    """Invoice every completed session that has none yet and ended before ``until``.
+
+    Sessions stream in from one cursor ordered by (cafe_id, end_time), so
+    each cafe's numbers follow the order its sessions ended. Each chunk of
+    ``batch_size`` takes one block of numbers per cafe from the counter,
+    then one insert_many and one bulk_write.
+    """
+    now = datetime.now(timezone.utc)
+    query = {"status": SessionStatus.COMPLETED.value, "invoice_id": None, "end_time": {"$lt": (until or now).isoformat()}}
+    if cafe_ids is not None:
+        query["cafe_id"] = {"$in": cafe_ids}
+
+    totals = {"invoiced": 0, "skipped": 0}
+    chunk: List[Dict] = []
+    cursor = db.sessions.find(query, SESSION_FIELDS).sort([("cafe_id", 1), ("end_time", 1), ("id", 1)]).batch_size(batch_size)
+    async for session in cursor:
+        chunk.append(session)
+        if len(chunk) >= batch_size:
+            for key, value in (await _invoice_chunk(db, chunk, now)).items():
+                totals[key] += value
+            chunk = []
+    if chunk:
+        for key, value in (await _invoice_chunk(db, chunk, now)).items():
+            totals[key] += value
+    return totals
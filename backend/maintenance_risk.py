@@ -0,0 +1,229 @@
+from pymongo import UpdateOne
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+import os
+
+import numpy as np
+
+from availability import availability_index
+from health_rollups import ROLLUP_COLLECTION
+from models_extended import DeviceMaintenance, MaintenanceStatus
+
+SCORING_DAYS = int(os.environ.get('MAINTENANCE_SCORING_DAYS', '7'))
+REPAIR_HISTORY_DAYS = 90
+TEMPERATURE_METRICS = ("temperature", "cpu_temperature", "gpu_temperature")
+ERROR_METRIC = "errors"  # errors counted since the previous reading
+UPTIME_METRIC = "uptime"  # percent of the reporting interval the device was up
+TEMP_CRITICAL = float(os.environ.get('MAINTENANCE_TEMP_CRITICAL', '85'))
+TEMP_WARNING = TEMP_CRITICAL - 10
+AUTO_SCHEDULE_RISK = float(os.environ.get('MAINTENANCE_AUTO_SCHEDULE_RISK', '0.5'))
+SCHEDULE_LEAD = timedelta(days=1)
+OPEN_MAINTENANCE = [MaintenanceStatus.SCHEDULED.value, MaintenanceStatus.IN_PROGRESS.value]
+RISK_COLLECTION = "device_risk"
+
+# Feature -> (value at which it counts in full, weight); weights sum to 1
+RISK_FEATURES = {
+    "temp_rise": (10.0, 0.25),      # last day's average over the baseline, in degrees
+    "temp_trend": (2.0, 0.15),      # least-squares slope of daily averages, degrees per day
+    "temp_peak": (10.0, 0.20),      # last day's peak above TEMP_WARNING
+    "error_spike": (4.0, 0.20),     # last day's errors over the baseline daily mean, minus one
+    "uptime_drop": (20.0, 0.10),    # baseline uptime percent minus the last day's
+    "recent_repairs": (3.0, 0.10),  # manual maintenance records in the last REPAIR_HISTORY_DAYS
+}
+REASONS = {
+    "temp_rise": "temperature {value:.1f}° above its baseline",
+    "temp_trend": "temperature rising {value:.1f}° a day",
+    "temp_peak": "peaked {value:.1f}° above the {warning:.0f}° warning level",
+    "error_spike": "errors at {value:.1f}x above baseline",
+    "uptime_drop": "uptime down {value:.1f} points",
+    "recent_repairs": "{value:.0f} maintenance visits in {days} days",
+}
+
+async def _daily_rollups(db, device_ids: List[str], since: datetime) -> List[Dict]:
+    """Per (device, metric, day) totals, folded from the 1h rollups by MongoDB"""
+    pipeline = [
+        {"$match": {
+            "device_id": {"$in": device_ids},
+            "resolution": "1h",
+            "metric": {"$in": [*TEMPERATURE_METRICS, ERROR_METRIC, UPTIME_METRIC]},
+            "bucket": {"$gte": since}
+        }},
+        {"$group": {
+            "_id": {
+                "device_id": "$device_id",
+                "metric": "$metric",
+                "day": {"$floor": {"$divide": [{"$subtract": ["$bucket", since]}, 86400000]}}
+            },
+            "count": {"$sum": "$count"},
+            "sum": {"$sum": "$sum"},
+            "max": {"$max": "$max"}
+        }}
+    ]
+    return await db[ROLLUP_COLLECTION].aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+def _masked_mean(total: np.ndarray, count: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+def risk_features(rows: List[Dict], device_index: Dict[str, int], days: int, repairs: np.ndarray) -> Dict[str, np.ndarray]:
+    """Feature columns, one entry per device, from daily rollup rows.
+
+    The last day is compared with the days before it (the baseline); a
+    feature is 0 when a device lacks the data for it.
+    """
+    n = len(device_index)
+    shape = (n, days)
+    rows = [row for row in rows if 0 <= row['_id']['day'] < days]
+    device = np.fromiter((device_index[row['_id']['device_id']] for row in rows), dtype=np.int64, count=len(rows))
+    day = np.fromiter((row['_id']['day'] for row in rows), dtype=np.int64, count=len(rows))
+    metric = np.asarray([row['_id']['metric'] for row in rows], dtype=object)
+    sums = np.fromiter((row['sum'] for row in rows), dtype=float, count=len(rows))
+    counts = np.fromiter((row['count'] for row in rows), dtype=float, count=len(rows))
+    peaks = np.fromiter((row['max'] for row in rows), dtype=float, count=len(rows))
+    is_temp = np.isin(metric, TEMPERATURE_METRICS)
+    is_error = metric == ERROR_METRIC
+    is_uptime = metric == UPTIME_METRIC
+
+    def scatter(mask: np.ndarray, values: np.ndarray, reduce=np.add, fill=0.0) -> np.ndarray:
+        grid = np.full(shape, fill)
+        reduce.at(grid, (device[mask], day[mask]), values[mask])
+        return grid
+
+    temp_sum, temp_count = scatter(is_temp, sums), scatter(is_temp, counts)
+    temp_max = scatter(is_temp, peaks, np.maximum, -np.inf)
+    errors, error_days = scatter(is_error, sums), scatter(is_error, counts) > 0
+    uptime_sum, uptime_count = scatter(is_uptime, sums), scatter(is_uptime, counts)
+
+    daily_temp = _masked_mean(temp_sum, temp_count)
+    recent_temp = daily_temp[:, -1]
+    baseline_temp = _masked_mean(temp_sum[:, :-1].sum(axis=1), temp_count[:, :-1].sum(axis=1))
+
+    # Slope of daily averages over the days that have any, per device
+    has_temp = temp_count > 0
+    x = np.broadcast_to(np.arange(days, dtype=float), (n, days))
+    points = has_temp.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(has_temp, x, 0).sum(axis=1) / points
+        y_mean = np.where(has_temp, daily_temp, 0).sum(axis=1) / points
+        dx = np.where(has_temp, x - x_mean[:, None], 0)
+        dy = np.where(has_temp, daily_temp - y_mean[:, None], 0)
+        slope = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+    slope = np.where(points >= 3, slope, 0)
+
+    baseline_days = error_days[:, :-1].sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        baseline_errors = np.where(baseline_days > 0, errors[:, :-1].sum(axis=1) / baseline_days, 0)
+    error_spike = np.where(error_days[:, -1], errors[:, -1] / np.maximum(baseline_errors, 1) - 1, 0)
+
+    recent_uptime = _masked_mean(uptime_sum[:, -1], uptime_count[:, -1])
+    baseline_uptime = _masked_mean(uptime_sum[:, :-1].sum(axis=1), uptime_count[:, :-1].sum(axis=1))
+
+    features = {
+        "temp_rise": recent_temp - baseline_temp,
+        "temp_trend": slope,
+        "temp_peak": temp_max[:, -1] - TEMP_WARNING,
+        "error_spike": error_spike,
+        "uptime_drop": baseline_uptime - recent_uptime,
+        "recent_repairs": repairs.astype(float),
+    }
+    return {name: np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0) for name, values in features.items()}
+
+def risk_scores(features: Dict[str, np.ndarray]) -> np.ndarray:
+    """Weighted sum of the features, each scaled to [0, 1]; 1 is the highest risk"""
+    total = 0
+    for name, (full, weight) in RISK_FEATURES.items():
+        total = total + weight * np.clip(features[name] / full, 0, 1)
+    return total
+
+async def score_devices(db, cafe_ids: Optional[List[str]] = None, now: Optional[datetime] = None) -> List[Dict]:
+    """Failure risk of every device in ``cafe_ids`` (all cafes when None), highest first"""
+    now = now or datetime.now(timezone.utc)
+    query = {"cafe_id": {"$in": cafe_ids}} if cafe_ids is not None else {}
+    devices = await db.devices.find(query, {"_id": 0, "id": 1, "cafe_id": 1, "name": 1}).to_list(None)
+    if not devices:
+        return []
+    device_index = {device['id']: i for i, device in enumerate(devices)}
+    device_ids = list(device_index)
+
+    rows = await _daily_rollups(db, device_ids, now - timedelta(days=SCORING_DAYS))
+    repairs = np.zeros(len(devices))
+    repair_since = (now - timedelta(days=REPAIR_HISTORY_DAYS)).isoformat()
+    async for row in db.device_maintenance.aggregate([
+        # Visits this job booked itself would otherwise count against the device
+        {"$match": {
+            "device_id": {"$in": device_ids}, "created_at": {"$gte": repair_since},
+            "maintenance_type": {"$ne": "predictive"}
+        }},
+        {"$group": {"_id": "$device_id", "count": {"$sum": 1}}}
+    ]):
+        repairs[device_index[row['_id']]] = row['count']
+
+    features = risk_features(rows, device_index, SCORING_DAYS, repairs)
+    risk = risk_scores(features)
+
+    scored = []
+    for i in np.argsort(-risk, kind='stable'):
+        reasons = [
+            REASONS[name].format(value=features[name][i], days=REPAIR_HISTORY_DAYS, warning=TEMP_WARNING)
+            for name, (full, _) in RISK_FEATURES.items() if features[name][i] >= full / 2
+        ]
+        scored.append({
+            "device_id": devices[i]['id'],
+            "cafe_id": devices[i]['cafe_id'],
+            "name": devices[i].get('name'),
+            "risk": round(float(risk[i]), 3),
+            "reasons": reasons,
+            "features": {name: round(float(values[i]), 3) for name, values in features.items()},
+            "scored_at": now
+        })
+    return scored
+
+async def save_scores(db, scored: List[Dict]):
+    """Keep the latest score per device in ``device_risk``"""
+    if scored:
+        await db[RISK_COLLECTION].bulk_write([
+            UpdateOne({"_id": entry['device_id']}, {"$set": entry}, upsert=True) for entry in scored
+        ], ordered=False)
+
+async def schedule_maintenance(db, scored: List[Dict], threshold: float = AUTO_SCHEDULE_RISK) -> List[Dict]:
+    """Book a predictive maintenance visit for devices at or over ``threshold``.
+
+    Devices that already have a scheduled or in-progress visit are skipped.
+    The device stays bookable until the visit starts.
+    """
+    at_risk = [entry for entry in scored if entry['risk'] >= threshold]
+    if not at_risk:
+        return []
+    busy = set(await db.device_maintenance.distinct("device_id", {
+        "device_id": {"$in": [entry['device_id'] for entry in at_risk]},
+        "status": {"$in": OPEN_MAINTENANCE}
+    }))
+
+    records = []
+    for entry in at_risk:
+        if entry['device_id'] in busy:
+            continue
+        record = DeviceMaintenance(
+            device_id=entry['device_id'],
+            cafe_id=entry['cafe_id'],
+            issue_description=f"Predicted failure risk {entry['risk']:.2f}: " + ("; ".join(entry['reasons']) or "combined signals"),
+            maintenance_type="predictive",
+            scheduled_date=entry['scored_at'] + SCHEDULE_LEAD
+        ).model_dump()
+        record['scheduled_date'] = record['scheduled_date'].isoformat()
+        record['created_at'] = record['created_at'].isoformat()
+        records.append(record)
+    if records:
+        await db.device_maintenance.insert_many(records)
+        for record in records:
+            availability_index.apply_maintenance(record)
+        for cafe_id in {record['cafe_id'] for record in records}:
+            await availability_index.maintenance_changed(db, cafe_id)
+    return [{k: v for k, v in record.items() if k != '_id'} for record in records]
+
+async def top_risks(db, cafe_id: str, limit: int = 5) -> List[Dict]:
+    """Highest stored risks in a cafe, in the compact form the AI agents get"""
+    docs = await db[RISK_COLLECTION].find(
+        {"cafe_id": cafe_id}, {"_id": 0, "name": 1, "device_id": 1, "risk": 1, "reasons": 1}
+    ).sort("risk", -1).limit(limit).to_list(limit)
+    return [{"device": doc.get('name') or doc['device_id'], "risk": doc['risk'], "reasons": doc['reasons']} for doc in docs]
@@ -87,6 +87,7 @@ class Device(BaseModel):
     status: DeviceStatus = DeviceStatus.AVAILABLE
     specifications: Optional[str] = None
     hourly_rate: float
+    current_session_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Session(BaseModel):
@@ -99,8 +100,12 @@ class Session(BaseModel):
     start_time: datetime
     end_time: Optional[datetime] = None
     duration_hours: Optional[float] = None
+    hourly_rate: Optional[float] = None
     total_amount: float = 0.0
     status: SessionStatus = SessionStatus.ACTIVE
+    reservation_id: Optional[str] = None
+    waitlist_id: Optional[str] = None
+    invoice_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Game(BaseModel):
@@ -167,3 +172,8 @@ class AIMessage(BaseModel):
 
 class DeviceStatusUpdate(BaseModel):
     status: DeviceStatus
+
+class DeviceBulkStatusUpdate(BaseModel):
+    cafe_id: str
+    device_ids: Optional[List[str]] = Field(None, max_length=500)  # every device in the cafe when omitted
+    status: DeviceStatus
@@ -170,9 +170,63 @@ class DeviceHealthLog(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     device_id: str
     metric: str  # temperature, uptime, errors, etc
-    value: str
+    value: float
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class HealthReading(BaseModel):
+    device_id: str
+    metric: str = Field(min_length=1, max_length=64)  # temperature, gpu_temperature, fan_rpm, ...
+    value: float = Field(allow_inf_nan=False)
+    timestamp: Optional[datetime] = None  # when measured; defaults to receipt time
+
+class HealthReadingBatch(BaseModel):
+    readings: List[HealthReading] = Field(min_length=1, max_length=5000)
+
+# Reservations
+class ReservationStatus(str, Enum):
+    CONFIRMED = "CONFIRMED"
+    CHECKED_IN = "CHECKED_IN"
+    COMPLETED = "COMPLETED"
+    CANCELLED = "CANCELLED"
+    NO_SHOW = "NO_SHOW"
+
+class Reservation(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    cafe_id: str
+    device_id: str
+    customer_id: str
+    start_time: datetime
+    end_time: datetime
+    status: ReservationStatus = ReservationStatus.CONFIRMED
+    session_id: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+# Waitlist
+class WaitlistStatus(str, Enum):
+    WAITING = "WAITING"
+    ASSIGNED = "ASSIGNED"
+    CANCELLED = "CANCELLED"
+
+class WaitlistEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    cafe_id: str
+    device_type: DeviceType
+    customer_id: str
+    tier: MembershipTier = MembershipTier.BRONZE
+    priority: int  # lower is served first; see waitlist.TIER_PRIORITY
+    status: WaitlistStatus = WaitlistStatus.WAITING
+    device_id: Optional[str] = None
+    session_id: Optional[str] = None
+    joined_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    assigned_at: Optional[datetime] = None
+    position: Optional[int] = None  # 1-based, while waiting
+    estimated_wait_minutes: Optional[float] = None
+
 # Invoice Model
 class InvoiceStatus(str, Enum):
     DRAFT = "DRAFT"
@@ -188,6 +242,7 @@ class Invoice(BaseModel):
     cafe_id: str
     customer_id: Optional[str] = None
     subscription_id: Optional[str] = None
+    reference_id: Optional[str] = None
     amount: float
     tax_amount: float = 0.0
     total_amount: float
@@ -240,5 +295,36 @@ class DeviceMaintenanceCreate(BaseModel):
     maintenance_type: str
     scheduled_date: datetime
 
+class ReservationCreate(BaseModel):
+    device_id: str
+    start_time: datetime  # without a UTC offset, read as cafe local time
+    duration_hours: float = Field(gt=0, le=12)
+    customer_id: Optional[str] = None  # staff booking for a customer; defaults to the caller
+
+class WaitlistJoin(BaseModel):
+    cafe_id: str
+    device_type: DeviceType
+    customer_id: Optional[str] = None  # staff adding a walk-in; defaults to the caller
+
 class ExtendSessionRequest(BaseModel):
     additional_hours: float
+
+class PriceQuoteRequest(BaseModel):
+    device_id: str
+    start_time: datetime  # without a UTC offset, read as cafe local time
+    duration_hours: float = Field(gt=0, le=24)
+    coupon_code: Optional[str] = None
+
+class PriceQuoteBatch(BaseModel):
+    quotes: List[PriceQuoteRequest] = Field(min_length=1, max_length=500)
+
+class PriceQuote(BaseModel):
+    device_id: str
+    start_time: datetime
+    duration_hours: float
+    hourly_rate: float
+    base_amount: float
+    discount: float
+    total_amount: float
+    coupon_code: Optional[str] = None
+    coupon_applied: bool
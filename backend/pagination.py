@@ -0,0 +1,63 @@
+from fastapi import HTTPException
+from typing import Any, Dict, List, Optional, Tuple
+import base64
+import binascii
+import orjson
+
+from responses import DocumentResponse
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(sort_value: Any, doc_id: str) -> str:
+    """Pack the (sort_key, id) of the last item on a page into an opaque token"""
+    return base64.urlsafe_b64encode(orjson.dumps([sort_value, doc_id])).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Any, str]:
+    """Unpack a continuation token produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, doc_id = orjson.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError, binascii.Error, orjson.JSONDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(doc_id, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return sort_value, doc_id
+
+async def paginate(
+    collection,
+    query: Dict,
+    sort_field: str = "created_at",
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict] = None
+) -> Tuple[List[Dict], Optional[str]]:
+    """Fetch one page of ``collection`` newest first, keyed on (sort_field, id).
+
+    Each page is a range scan that starts right after the previous page's last
+    item, so page N costs the same as page 1 as long as an index on
+    (<query fields>, sort_field, id) exists (see indexes.py).
+    """
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        after = {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": doc_id}}
+        ]}
+        query = {"$and": [query, after]} if query else after
+
+    items = await collection.find(query, projection or {"_id": 0}).sort(
+        [(sort_field, -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(last.get(sort_field), last['id'])
+
+    return items, next_cursor
+
+def paginated_response(items: List[Dict], next_cursor: Optional[str]) -> DocumentResponse:
+    """Return a page as a plain JSON array with the continuation token in a header"""
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return DocumentResponse(items, headers=headers)
@@ -0,0 +1,265 @@
+from bisect import bisect_right
+from collections import Counter
+from datetime import date, datetime, time, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo
+import math
+import os
+
+import numpy as np
+
+from caching import catalog_versions
+from coupons import coupon_usable
+
+CAFE_TIMEZONE = ZoneInfo(os.environ.get('CAFE_TIMEZONE', 'Asia/Kolkata'))
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+# Week positions count wall-clock minutes from this Monday 00:00
+REFERENCE_MONDAY = date(2024, 1, 1)
+REFERENCE_EPOCH_MINUTES = datetime.combine(REFERENCE_MONDAY, time(), timezone.utc).timestamp() / 60
+# Rules without days_of_week apply every day, except WEEKEND which means Sat/Sun
+DEFAULT_DAYS = {"WEEKEND": (5, 6)}
+ALL_DAYS = tuple(range(7))
+
+def parse_hhmm(value: str) -> int:
+    """'HH:MM' -> minutes after midnight"""
+    hours, minutes = value.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+        raise ValueError(f"Invalid time {value!r}, expected HH:MM")
+    return hours * 60 + minutes
+
+def rule_windows(rule: Dict) -> List[Tuple[int, int]]:
+    """Weekly [start, end) minute windows a rule covers, split at the week boundary.
+
+    A window whose end is before its start runs past midnight into the next
+    day; equal or missing times mean the whole day. Raises ValueError on a
+    malformed rule.
+    """
+    start = parse_hhmm(rule['start_time']) if rule.get('start_time') else 0
+    end = parse_hhmm(rule['end_time']) if rule.get('end_time') else start
+    length = (end - start) % DAY_MINUTES or DAY_MINUTES
+
+    days = rule.get('days_of_week')
+    if days is None:
+        days = DEFAULT_DAYS.get(rule.get('rule_type'), ALL_DAYS)
+    if any(not 0 <= day <= 6 for day in days):
+        raise ValueError("days_of_week must be between 0 (Monday) and 6 (Sunday)")
+
+    windows = []
+    for day in sorted(set(days)):
+        window_start = day * DAY_MINUTES + start
+        window_end = window_start + length
+        if window_end <= WEEK_MINUTES:
+            windows.append((window_start, window_end))
+        else:
+            windows.append((window_start, WEEK_MINUTES))
+            windows.append((0, window_end - WEEK_MINUTES))
+    return windows
+
+class PricingTimeline:
+    """A cafe's price multiplier over one week, as sorted minute segments.
+
+    ``cumulative[i]`` is the integral of the multiplier from the start of the
+    week to ``starts[i]``, so the priced length of any span costs two binary
+    searches, however many rule boundaries it crosses.
+    """
+    __slots__ = ('starts', 'multipliers', 'cumulative', 'week_total', 'tz', '_arrays')
+
+    def __init__(self, segments: List[Tuple[int, float]], tz: ZoneInfo = CAFE_TIMEZONE):
+        # segments: (start_minute, multiplier), sorted, first one starting at 0
+        self.starts = [start for start, _ in segments]
+        self.multipliers = [multiplier for _, multiplier in segments]
+        self.cumulative = [0.0]
+        for i in range(1, len(segments)):
+            self.cumulative.append(
+                self.cumulative[-1] + self.multipliers[i - 1] * (self.starts[i] - self.starts[i - 1])
+            )
+        self.week_total = self.cumulative[-1] + self.multipliers[-1] * (WEEK_MINUTES - self.starts[-1])
+        self.tz = tz
+        self._arrays = None
+
+    @classmethod
+    def flat(cls, tz: ZoneInfo = CAFE_TIMEZONE) -> "PricingTimeline":
+        return cls([(0, 1.0)], tz)
+
+    @property
+    def is_flat(self) -> bool:
+        return self.multipliers == [1.0]
+
+    def wall_minutes(self, ts: float) -> float:
+        """Epoch seconds -> local wall-clock minutes since REFERENCE_MONDAY"""
+        local = datetime.fromtimestamp(ts, self.tz)
+        days = (local.date() - REFERENCE_MONDAY).days
+        return days * DAY_MINUTES + local.hour * 60 + local.minute + (local.second + local.microsecond / 1e6) / 60
+
+    def integral(self, minute: float) -> float:
+        """Priced minutes from REFERENCE_MONDAY to ``minute`` (wall-clock minutes)"""
+        weeks, offset = divmod(minute, WEEK_MINUTES)
+        i = bisect_right(self.starts, offset) - 1
+        return weeks * self.week_total + self.cumulative[i] + self.multipliers[i] * (offset - self.starts[i])
+
+    def multiplier_at(self, minute: float) -> float:
+        return self.multipliers[bisect_right(self.starts, minute % WEEK_MINUTES) - 1]
+
+    def position(self, ts: float) -> float:
+        """Priced minutes up to epoch time ``ts``; differences of positions are priced durations"""
+        return self.integral(self.wall_minutes(ts))
+
+    def cost(self, start_ts: float, end_ts: float, hourly_rate: float) -> float:
+        return hourly_rate / 60 * (self.position(end_ts) - self.position(start_ts))
+
+    # Array versions of the above, for pricing many spans in one pass
+
+    def wall_minutes_many(self, timestamps: Sequence[float]) -> np.ndarray:
+        # The UTC offset lookup is per element; everything after it is vectorized
+        offsets = np.fromiter(
+            (datetime.fromtimestamp(ts, self.tz).utcoffset().total_seconds() for ts in timestamps),
+            dtype=float, count=len(timestamps)
+        )
+        return (np.asarray(timestamps, dtype=float) + offsets) / 60 - REFERENCE_EPOCH_MINUTES
+
+    def integral_many(self, minutes: np.ndarray) -> np.ndarray:
+        if self._arrays is None:
+            self._arrays = (
+                np.asarray(self.starts, dtype=float),
+                np.asarray(self.multipliers, dtype=float),
+                np.asarray(self.cumulative, dtype=float)
+            )
+        starts, multipliers, cumulative = self._arrays
+        weeks, offsets = np.divmod(minutes, WEEK_MINUTES)
+        i = np.searchsorted(starts, offsets, side='right') - 1
+        return weeks * self.week_total + cumulative[i] + multipliers[i] * (offsets - starts[i])
+
+    def cost_many(self, start_ts: Sequence[float], end_ts: Sequence[float], hourly_rates: Sequence[float]) -> np.ndarray:
+        priced = self.integral_many(self.wall_minutes_many(end_ts)) - self.integral_many(self.wall_minutes_many(start_ts))
+        return np.asarray(hourly_rates, dtype=float) / 60 * priced
+
+def compile_timeline(rules: Iterable[Dict], tz: ZoneInfo = CAFE_TIMEZONE) -> PricingTimeline:
+    """Merge rules into one weekly timeline; overlapping multipliers multiply.
+
+    FESTIVAL rules carry no dates in the model, so they are treated like any
+    other windowed rule and should be switched off with ``is_active`` afterwards.
+    """
+    changes: Dict[int, List[Tuple[float, int]]] = {0: []}
+    for rule in rules:
+        if not rule.get('is_active', True):
+            continue
+        for start, end in rule_windows(rule):
+            changes.setdefault(start, []).append((rule['multiplier'], 1))
+            changes.setdefault(end, []).append((rule['multiplier'], -1))
+    changes.pop(WEEK_MINUTES, None)
+
+    active: Counter = Counter()
+    segments: List[Tuple[int, float]] = []
+    for minute in sorted(changes):
+        for multiplier, delta in changes[minute]:
+            active[multiplier] += delta
+        current = math.prod(multiplier ** count for multiplier, count in active.items() if count)
+        if not segments or segments[-1][1] != current:
+            segments.append((minute, current))
+    return PricingTimeline(segments, tz)
+
+def discounted(charge, factor, fixed, minimum):
+    """The coupon rule shared by quotes and bills, element-wise on arrays.
+
+    A percentage coupon is a ``factor`` and a fixed one an amount taken off;
+    neither applies while the charge is below the coupon's ``minimum``.
+    """
+    return np.where(charge >= minimum, np.maximum(0.0, charge * factor - fixed), charge)
+
+def price_quotes(
+    quotes: Sequence[Dict],
+    devices: Dict[str, Dict],
+    coupons: Dict[Tuple[str, str], Dict],
+    timelines: Dict[str, PricingTimeline],
+    now: datetime
+) -> List[Dict]:
+    """Price quotes (device_id, start_ts, end_ts, coupon_code) in one array pass per cafe.
+
+    ``devices`` maps device id to its document, ``coupons`` maps (cafe_id,
+    code) to the coupon and ``timelines`` maps cafe id to its timeline.
+    Coupons go through ``discounted``, the same rule the bill uses.
+    """
+    count = len(quotes)
+    base = np.empty(count)
+    by_cafe: Dict[str, List[int]] = {}
+    for i, quote in enumerate(quotes):
+        by_cafe.setdefault(devices[quote['device_id']]['cafe_id'], []).append(i)
+    for cafe_id, indices in by_cafe.items():
+        base[indices] = timelines[cafe_id].cost_many(
+            [quotes[i]['start_ts'] for i in indices],
+            [quotes[i]['end_ts'] for i in indices],
+            [devices[quotes[i]['device_id']]['hourly_rate'] for i in indices]
+        )
+
+    factor, fixed, minimum = np.ones(count), np.zeros(count), np.full(count, np.inf)
+    usable: Dict[Tuple[str, str], bool] = {}
+    for i, quote in enumerate(quotes):
+        if not quote.get('coupon_code'):
+            continue
+        key = (devices[quote['device_id']]['cafe_id'], quote['coupon_code'])
+        coupon = coupons.get(key)
+        if key not in usable:
+            usable[key] = coupon is not None and coupon_usable(coupon, now)
+        if not usable[key]:
+            continue
+        minimum[i] = coupon.get('min_amount') or 0.0
+        if coupon['discount_type'] == 'percentage':
+            factor[i] = max(0.0, 1 - coupon['discount_value'] / 100)
+        else:
+            fixed[i] = coupon['discount_value']
+
+    applied = base >= minimum
+    total = discounted(base, factor, fixed, minimum)
+    base, total = np.round(base, 2), np.round(total, 2)
+    return [
+        {
+            "device_id": quote['device_id'],
+            "start_time": quote['start_time'],
+            "duration_hours": quote['duration_hours'],
+            "hourly_rate": devices[quote['device_id']]['hourly_rate'],
+            "base_amount": float(base[i]),
+            "discount": round(float(base[i] - total[i]), 2),
+            "total_amount": float(total[i]),
+            "coupon_code": quote.get('coupon_code'),
+            "coupon_applied": bool(applied[i])
+        }
+        for i, quote in enumerate(quotes)
+    ]
+
+def pricing_scope(cafe_id: str) -> str:
+    return f"pricing:{cafe_id}"
+
+class PricingEngine:
+    """Compiled timeline per cafe, recompiled when the cafe's rules change.
+
+    Compiled timelines are tagged with the cafe's ``pricing:<id>`` change
+    version, so a rule written through any worker is picked up within the
+    version refresh window.
+    """
+
+    def __init__(self):
+        self._compiled: Dict[str, Tuple[int, PricingTimeline]] = {}
+
+    async def timeline(self, db, cafe_id: str) -> PricingTimeline:
+        version = await catalog_versions.get(db, pricing_scope(cafe_id))
+        cached = self._compiled.get(cafe_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        rules = await db.pricing_rules.find({"cafe_id": cafe_id, "is_active": True}, {"_id": 0}).to_list(None)
+        timeline = compile_timeline(rules)
+        self._compiled[cafe_id] = (version, timeline)
+        return timeline
+
+    async def rules_changed(self, db, cafe_id: str):
+        await catalog_versions.bump(db, pricing_scope(cafe_id))
+        self._compiled.pop(cafe_id, None)
+
+    def cached(self, cafe_id: str) -> Optional[PricingTimeline]:
+        cached = self._compiled.get(cafe_id)
+        return cached[1] if cached else None
+
+pricing_engine = PricingEngine()
@@ -0,0 +1,37 @@
+from fastapi import HTTPException
+from pydantic import BaseModel, ConfigDict, create_model
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Type
+
+def field_projection(
+    model: Type[BaseModel],
+    fields: Optional[str],
+    always: Iterable[str] = ("id", "created_at")
+) -> Optional[Dict]:
+    """Turn a ``fields=a,b,c`` query value into a MongoDB projection.
+
+    Names are validated against ``model``. Fields listed in ``always`` are kept
+    so pagination cursors can still be built from a narrowed document.
+    Returns None when no narrowing was asked for.
+    """
+    if not fields:
+        return None
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = sorted(set(names) - set(model.model_fields))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    projection = {"_id": 0}
+    for name in (*always, *names):
+        projection[name] = 1
+    return projection
+
+@lru_cache(maxsize=None)
+def partial_model(model: Type[BaseModel]) -> Type[BaseModel]:
+    """Copy of ``model`` with every field optional, for responses narrowed by ``fields=``"""
+    return create_model(
+        f"Partial{model.__name__}",
+        __config__=ConfigDict(extra="ignore"),
+        **{name: (Optional[field.annotation], None) for name, field in model.model_fields.items()}
+    )
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import io
+import os
+
+import qrcode
+import qrcode.image.svg
+
+from caching import ReadThroughCache
+
+QR_WORKERS = int(os.environ.get('QR_WORKERS', '2'))
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', '4096'))
+# A session's code never changes; the TTL only ages out idle entries
+QR_CACHE_TTL_SECONDS = 6 * 3600.0
+QR_MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+def render_session_qr(session_id: str, image_format: str) -> bytes:
+    """The check-in code for a session as PNG or SVG bytes"""
+    qr = qrcode.QRCode(
+        version=1, box_size=10, border=5,
+        image_factory=qrcode.image.svg.SvgPathImage if image_format == "svg" else None
+    )
+    qr.add_data(f"SESSION:{session_id}")
+    qr.make(fit=True)
+    if image_format == "svg":
+        return qr.make_image().to_string()
+    buffer = io.BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class SessionQrCodes:
+    """Session QR codes rendered on a small thread pool and kept in a bounded LRU.
+
+    Rendering takes milliseconds of Python and PIL work, so it stays off the
+    event loop; repeat requests for a session (the app polls while the
+    customer is at the counter) are served from memory. Concurrent first
+    requests share one render.
+    """
+
+    def __init__(self, workers: int = QR_WORKERS, maxsize: int = QR_CACHE_SIZE):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="qr")
+        self._cache = ReadThroughCache(maxsize=maxsize, ttl_seconds=QR_CACHE_TTL_SECONDS)
+
+    async def image(self, session_id: str, image_format: str = "png") -> bytes:
+        async def render():
+            return await asyncio.get_running_loop().run_in_executor(
+                self._pool, render_session_qr, session_id, image_format
+            )
+        return await self._cache.get((session_id, image_format), render)
+
+    async def data_uri(self, session_id: str) -> str:
+        png = await self.image(session_id, "png")
+        return f"data:image/png;base64,{base64.b64encode(png).decode()}"
+
+session_qr_codes = SessionQrCodes()
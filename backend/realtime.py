@@ -0,0 +1,100 @@
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+import asyncio
+import logging
+import os
+import orjson
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('LIVE_SUBSCRIBER_QUEUE_SIZE', '256'))
+RECENT_SESSIONS_TRACKED = 10000
+
+class Subscription:
+    """One live connection's view of a cafe's status feed"""
+    __slots__ = ('cafe_id', 'queue', 'dropped')
+
+    def __init__(self, cafe_id: str, queue_size: int):
+        self.cafe_id = cafe_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+class StatusHub:
+    """In-process pub/sub of device status deltas, one channel per cafe.
+
+    Each event is encoded once and put on every subscriber's bounded queue
+    without waiting. A subscriber whose queue is full has fallen behind: it is
+    marked dropped and unsubscribed, and its connection is expected to close so
+    the client reconnects and starts again from a fresh snapshot.
+
+    The same change can arrive twice, once from the route that made it and once
+    from the change feed, so status events that repeat the last known status
+    are skipped.
+    """
+
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[Subscription]] = defaultdict(set)
+        self._device_status: Dict[str, str] = {}
+        self._session_status: "OrderedDict[str, str]" = OrderedDict()
+
+    def cafe_ids(self) -> List[str]:
+        """Cafes with at least one live subscriber"""
+        return list(self._subscribers)
+
+    def subscribe(self, cafe_id: str) -> Subscription:
+        subscription = Subscription(cafe_id, self.queue_size)
+        self._subscribers[cafe_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.cafe_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.cafe_id]
+
+    def publish(self, cafe_id: str, event: Dict):
+        subscribers = self._subscribers.get(cafe_id)
+        if not subscribers:
+            return
+
+        message = orjson.dumps(event).decode()
+        for subscription in list(subscribers):
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.warning("Dropping slow live subscriber for cafe %s", cafe_id)
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+
+    def publish_device_status(self, cafe_id: str, device_id: str, status: str, session_id: Optional[str] = None):
+        # Recorded even without subscribers, so a later repeat is judged correctly
+        if self._device_status.get(device_id) == status:
+            return
+        self._device_status[device_id] = status
+        self.publish(cafe_id, {
+            "type": "device_status",
+            "device_id": device_id,
+            "status": status,
+            "session_id": session_id,
+            "at": datetime.now(timezone.utc)
+        })
+
+    def publish_session_status(self, cafe_id: str, session_id: str, device_id: str, status: str):
+        if self._session_status.get(session_id) == status:
+            return
+        self._session_status[session_id] = status
+        self._session_status.move_to_end(session_id)
+        if len(self._session_status) > RECENT_SESSIONS_TRACKED:
+            self._session_status.popitem(last=False)
+        self.publish(cafe_id, {
+            "type": "session_status",
+            "session_id": session_id,
+            "device_id": device_id,
+            "status": status,
+            "at": datetime.now(timezone.utc)
+        })
+
+status_hub = StatusHub()
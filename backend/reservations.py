@@ -0,0 +1,347 @@
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import os
+import time
+
+from availability import availability_index
+from caching import catalog_versions
+from models import DeviceStatus
+from models_extended import Reservation, ReservationStatus
+
+SLOT_MINUTES = int(os.environ.get('RESERVATION_SLOT_MINUTES', '15'))
+SLOT_SECONDS = SLOT_MINUTES * 60
+BOOKING_HORIZON = timedelta(days=int(os.environ.get('RESERVATION_HORIZON_DAYS', '30')))
+CHECK_IN_EARLY = timedelta(minutes=15)
+# Walk-ins and waitlist hand-offs have no end time, so they are refused when a
+# reservation on the device starts within this long (plus the check-in window)
+OPEN_SESSION_CLEARANCE = timedelta(hours=float(os.environ.get('OPEN_SESSION_CLEARANCE_HOURS', '1')))
+NO_SHOW_GRACE = timedelta(minutes=int(os.environ.get('NO_SHOW_GRACE_MINUTES', '15')))
+HOLD_COLLECTION = "reservation_slots"
+# Reservations in these states keep their slots taken
+HELD_STATUSES = (ReservationStatus.CONFIRMED.value, ReservationStatus.CHECKED_IN.value)
+# Other workers' writes are pulled by updated_at; the overlap absorbs clock skew between them
+SYNC_OVERLAP = timedelta(seconds=5)
+PRUNE_INTERVAL_SECONDS = 60.0
+RESERVATION_FIELDS = {"_id": 0, "id": 1, "cafe_id": 1, "device_id": 1, "status": 1,
+                      "start_time": 1, "end_time": 1, "updated_at": 1}
+
+def open_session_horizon(now: float) -> float:
+    """Reservations starting before this keep a session opened at ``now`` off the device"""
+    return now + (OPEN_SESSION_CLEARANCE + CHECK_IN_EARLY).total_seconds()
+
+def reservations_scope(cafe_id: str) -> str:
+    return f"reservations:{cafe_id}"
+
+def _as_datetime(value) -> datetime:
+    value = datetime.fromisoformat(value) if isinstance(value, str) else value
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+class DeviceBookings:
+    """One device's reservations as sorted, non-overlapping [start, end) intervals.
+
+    Reservations on a device never overlap, so starts and ends are both sorted
+    and a conflict check is one bisect: only the reservation starting at or
+    before ``start`` and the next one after it can overlap [start, end).
+    """
+    __slots__ = ('starts', 'ends', 'ids')
+
+    def __init__(self):
+        self.starts: List[float] = []
+        self.ends: List[float] = []
+        self.ids: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def conflict(self, start: float, end: float) -> Optional[str]:
+        """Id of a reservation overlapping [start, end), if any"""
+        i = bisect_right(self.starts, start)
+        if i and self.ends[i - 1] > start:
+            return self.ids[i - 1]
+        if i < len(self.starts) and self.starts[i] < end:
+            return self.ids[i]
+        return None
+
+    def add(self, reservation_id: str, start: float, end: float):
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.ids.insert(i, reservation_id)
+
+    def remove(self, reservation_id: str, start: float):
+        i = bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.ids[i] == reservation_id:
+                del self.starts[i], self.ends[i], self.ids[i]
+                return
+            i += 1
+
+    def prune(self, before: float) -> List[str]:
+        """Drop reservations that ended by ``before``; returns their ids"""
+        i = bisect_right(self.ends, before)
+        dropped = self.ids[:i]
+        del self.starts[:i], self.ends[:i], self.ids[:i]
+        return dropped
+
+class ReservationBook:
+    """Per-process copy of upcoming reservations, kept per device.
+
+    It turns away conflicting bookings before they reach MongoDB and keeps
+    reserved windows out of availability searches. Writes through this
+    process apply immediately; other workers bump ``reservations:<cafe_id>``
+    and the next read for that cafe pulls the reservations updated since the
+    last pull. The slot holds in ``reservation_slots`` remain the authority
+    on conflicts, so a stale copy can only cost a wasted insert.
+    """
+
+    def __init__(self):
+        self._devices: Dict[str, DeviceBookings] = {}
+        self._entries: Dict[str, Tuple[str, float]] = {}
+        self._versions: Dict[str, int] = {}
+        self._synced_at: Dict[str, datetime] = {}
+        self._pruned_at = float('-inf')
+        self._lock = asyncio.Lock()
+
+    def conflict(self, device_id: str, start: float, end: float) -> Optional[str]:
+        bookings = self._devices.get(device_id)
+        return bookings.conflict(start, end) if bookings else None
+
+    def put(self, doc: Dict):
+        """Sync one reservation from its stored document"""
+        self._drop(doc['id'])
+        key = f"reservation:{doc['id']}"
+        start = _as_datetime(doc['start_time']).timestamp()
+        end = _as_datetime(doc['end_time']).timestamp()
+        if doc['status'] in HELD_STATUSES and end > time.time():
+            bookings = self._devices.setdefault(doc['device_id'], DeviceBookings())
+            # The slot holds were free, so anything overlapping here is a stale copy
+            while (stale := bookings.conflict(start, end)) is not None:
+                self._drop(stale)
+            bookings.add(doc['id'], start, end)
+            self._entries[doc['id']] = (doc['device_id'], start)
+        # Once checked in, the session blocks the device instead
+        if doc['status'] == ReservationStatus.CONFIRMED.value and end > time.time():
+            availability_index.block(key, doc['device_id'], start, end)
+        else:
+            availability_index.release(key)
+
+    def _drop(self, reservation_id: str):
+        entry = self._entries.pop(reservation_id, None)
+        if entry is not None:
+            device_id, start = entry
+            self._devices[device_id].remove(reservation_id, start)
+            availability_index.release(f"reservation:{reservation_id}")
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned_at < PRUNE_INTERVAL_SECONDS:
+            return
+        for bookings in self._devices.values():
+            for reservation_id in bookings.prune(now):
+                del self._entries[reservation_id]
+                availability_index.release(f"reservation:{reservation_id}")
+        self._pruned_at = now
+
+    async def written(self, db, doc: Dict):
+        """Apply a reservation written through this process and tell the other workers"""
+        self.put(doc)
+        await catalog_versions.bump(db, reservations_scope(doc['cafe_id']))
+
+    async def refresh(self, db, cafe_id: str):
+        version = await catalog_versions.get(db, reservations_scope(cafe_id))
+        if self._versions.get(cafe_id) == version:
+            return
+        async with self._lock:
+            if self._versions.get(cafe_id) == version:
+                return
+            now = datetime.now(timezone.utc)
+            synced_at = self._synced_at.get(cafe_id)
+            if synced_at is None:
+                query = {"cafe_id": cafe_id, "status": {"$in": list(HELD_STATUSES)}, "end_time": {"$gt": now.isoformat()}}
+            else:
+                query = {"cafe_id": cafe_id, "updated_at": {"$gte": (synced_at - SYNC_OVERLAP).isoformat()}}
+            newest = synced_at or now
+            async for doc in db.reservations.find(query, RESERVATION_FIELDS):
+                self.put(doc)
+                newest = max(newest, _as_datetime(doc['updated_at']))
+            self._synced_at[cafe_id] = newest
+            self._versions[cafe_id] = version
+            self._prune()
+
+    async def rebuild(self, db):
+        """Reload every reservation that still holds slots"""
+        for reservation_id in list(self._entries):
+            self._drop(reservation_id)
+        self._versions.clear()
+        now = datetime.now(timezone.utc)
+        cafe_ids = set()
+        async for doc in db.reservations.find(
+            {"status": {"$in": list(HELD_STATUSES)}, "end_time": {"$gt": now.isoformat()}}, RESERVATION_FIELDS
+        ):
+            self.put(doc)
+            cafe_ids.add(doc['cafe_id'])
+        self._synced_at = {cafe_id: now for cafe_id in cafe_ids}
+
+reservation_book = ReservationBook()
+
+def check_booking_window(start: datetime, end: datetime, now: datetime):
+    if start.timestamp() % SLOT_SECONDS or end.timestamp() % SLOT_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Reservations start and end on {SLOT_MINUTES}-minute boundaries")
+    if start.timestamp() < now.timestamp() - now.timestamp() % SLOT_SECONDS:
+        raise HTTPException(status_code=400, detail="Reservation must start in the future")
+    if start > now + BOOKING_HORIZON:
+        raise HTTPException(status_code=400, detail=f"Reservations open at most {BOOKING_HORIZON.days} days ahead")
+
+async def hold_slots(db, reservation_id: str, device_id: str, start: datetime, end: datetime):
+    """Take every slot of [start, end) on the device, or none of them.
+
+    Each slot is a document whose _id is (device, slot start), so two bookings
+    racing for a slot cannot both insert it. Holds expire when the
+    reservation's window is over.
+    """
+    first, last = int(start.timestamp()), int(end.timestamp())
+    holds = [
+        {
+            "_id": f"{device_id}:{epoch}",
+            "device_id": device_id,
+            "reservation_id": reservation_id,
+            "slot": datetime.fromtimestamp(epoch, timezone.utc),
+            "expires_at": end
+        }
+        for epoch in range(first, last, SLOT_SECONDS)
+    ]
+    try:
+        await db[HOLD_COLLECTION].insert_many(holds, ordered=True)
+    except BulkWriteError:
+        await db[HOLD_COLLECTION].delete_many({"reservation_id": reservation_id})
+        raise HTTPException(status_code=409, detail="Slot already reserved")
+
+async def release_slots(db, reservation_id: str, after: Optional[datetime] = None):
+    """Give back a reservation's slots, only those starting at or after ``after`` if given"""
+    query: Dict = {"reservation_id": reservation_id}
+    if after is not None:
+        query["slot"] = {"$gte": after}
+    await db[HOLD_COLLECTION].delete_many(query)
+
+async def book(db, device_doc: Dict, customer_id: str, start: datetime, end: datetime) -> Reservation:
+    """Reserve ``device_doc`` for [start, end)"""
+    now = datetime.now(timezone.utc)
+    check_booking_window(start, end, now)
+    if device_doc['status'] == DeviceStatus.MAINTENANCE.value:
+        raise HTTPException(status_code=400, detail="Device is under maintenance")
+
+    await reservation_book.refresh(db, device_doc['cafe_id'])
+    if reservation_book.conflict(device_doc['id'], start.timestamp(), end.timestamp()):
+        raise HTTPException(status_code=409, detail="Slot already reserved")
+
+    reservation = Reservation(
+        cafe_id=device_doc['cafe_id'],
+        device_id=device_doc['id'],
+        customer_id=customer_id,
+        start_time=start.astimezone(timezone.utc),
+        end_time=end.astimezone(timezone.utc),
+        created_at=now,
+        updated_at=now
+    )
+    await hold_slots(db, reservation.id, reservation.device_id, start, end)
+    doc = reservation.model_dump()
+    for field in ('start_time', 'end_time', 'created_at', 'updated_at'):
+        doc[field] = doc[field].isoformat()
+    await db.reservations.insert_one(doc)
+    await reservation_book.written(db, doc)
+    return reservation
+
+async def _transition(db, reservation_id: str, from_status: str, to_status: str, **fields) -> Optional[Dict]:
+    """Move a reservation between states atomically; None if it was not in ``from_status``"""
+    updated_at = datetime.now(timezone.utc).isoformat()
+    doc = await db.reservations.find_one_and_update(
+        {"id": reservation_id, "status": from_status},
+        {"$set": {"status": to_status, "updated_at": updated_at, **fields}},
+        projection={"_id": 0}
+    )
+    if doc is None:
+        return None
+    doc.update(status=to_status, updated_at=updated_at, **fields)
+    return doc
+
+async def cancel(db, reservation_id: str) -> Dict:
+    doc = await _transition(db, reservation_id, ReservationStatus.CONFIRMED.value, ReservationStatus.CANCELLED.value)
+    if doc is None:
+        raise HTTPException(status_code=409, detail="Only confirmed reservations can be cancelled")
+    await release_slots(db, reservation_id)
+    await reservation_book.written(db, doc)
+    return doc
+
+def check_in_window(doc: Dict, now: datetime):
+    if doc['status'] != ReservationStatus.CONFIRMED.value:
+        raise HTTPException(status_code=409, detail=f"Reservation is {doc['status'].lower().replace('_', ' ')}")
+    if now < _as_datetime(doc['start_time']) - CHECK_IN_EARLY:
+        raise HTTPException(status_code=400, detail=f"Check-in opens {int(CHECK_IN_EARLY.total_seconds() // 60)} minutes before the reservation")
+    if now >= _as_datetime(doc['end_time']):
+        raise HTTPException(status_code=400, detail="Reservation has ended")
+
+async def claim_check_in(db, reservation_id: str) -> Dict:
+    """Mark a confirmed reservation checked in; exactly one concurrent caller wins"""
+    doc = await _transition(db, reservation_id, ReservationStatus.CONFIRMED.value, ReservationStatus.CHECKED_IN.value)
+    if doc is None:
+        raise HTTPException(status_code=409, detail="Reservation already checked in or no longer open")
+    return doc
+
+async def undo_check_in(db, doc: Dict):
+    """Put a reservation back to CONFIRMED when its device could not be claimed"""
+    undone = await _transition(db, doc['id'], ReservationStatus.CHECKED_IN.value, ReservationStatus.CONFIRMED.value)
+    if undone is not None:
+        await reservation_book.written(db, undone)
+
+async def attach_session(db, doc: Dict, session_id: str):
+    await db.reservations.update_one({"id": doc['id']}, {"$set": {"session_id": session_id}})
+    await reservation_book.written(db, {**doc, "session_id": session_id})
+
+async def complete(db, reservation_id: str, ended_at: datetime):
+    """The reservation's session ended: free whatever is left of its window"""
+    doc = await _transition(db, reservation_id, ReservationStatus.CHECKED_IN.value, ReservationStatus.COMPLETED.value)
+    if doc is None:
+        return
+    await release_slots(db, reservation_id, after=ended_at)
+    await reservation_book.written(db, doc)
+
+async def expire_no_shows(db, cafe_ids: List[str], limit: int = 50) -> List[Dict]:
+    """Mark confirmed reservations not checked in within ``NO_SHOW_GRACE`` of their start as no-shows"""
+    cutoff = (datetime.now(timezone.utc) - NO_SHOW_GRACE).isoformat()
+    candidates = await db.reservations.find({
+        "cafe_id": {"$in": cafe_ids},
+        "status": ReservationStatus.CONFIRMED.value,
+        "start_time": {"$lt": cutoff}
+    }, {"_id": 0, "id": 1}).sort("start_time", 1).limit(limit).to_list(limit)
+
+    missed = []
+    for candidate in candidates:
+        # A check-in racing this one wins or loses on the same conditional update
+        doc = await _transition(db, candidate['id'], ReservationStatus.CONFIRMED.value, ReservationStatus.NO_SHOW.value)
+        if doc is None:
+            continue
+        await release_slots(db, doc['id'])
+        reservation_book.put(doc)
+        missed.append(doc)
+    for cafe_id in {doc['cafe_id'] for doc in missed}:
+        await catalog_versions.bump(db, reservations_scope(cafe_id))
+    return missed
+
+async def noshow_rate(db, cafe_id: str, days: int = 30) -> float:
+    """Percent of the cafe's reservations in the last ``days`` that ended as no-shows"""
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    counts = {
+        row['_id']: row['count']
+        async for row in db.reservations.aggregate([
+            {"$match": {"cafe_id": cafe_id, "start_time": {"$gte": since}, "status": {"$in": [
+                ReservationStatus.CHECKED_IN.value, ReservationStatus.COMPLETED.value, ReservationStatus.NO_SHOW.value
+            ]}}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ])
+    }
+    total = sum(counts.values())
+    return round(100 * counts.get(ReservationStatus.NO_SHOW.value, 0) / total, 1) if total else 0.0
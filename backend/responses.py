@@ -0,0 +1,18 @@
+from fastapi.responses import ORJSONResponse
+from typing import Any
+import orjson
+
+class DocumentResponse(ORJSONResponse):
+    """JSON response for documents read straight from MongoDB.
+
+    Returning this from a route skips the ``response_model`` validation and
+    re-serialization pass, so only use it for documents this API wrote itself.
+    orjson handles datetimes natively; ISO strings stored by the routes are
+    passed through unchanged.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z
+        )
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone, timedelta
 from typing import List, Optional
@@ -8,6 +8,16 @@ from fastapi.responses import StreamingResponse
 import json
 
 from auth import get_current_user
+from pagination import paginate, paginated_response
+import invoicing
+from invoice_pdf import MAX_EXPORT_INVOICES, invoice_pdfs
+import reservations
+from models_extended import HealthReadingBatch
+from device_health import health_writer, raw_readings, reading_document
+from health_rollups import health_series
+import maintenance_risk
+from responses import DocumentResponse
+import wallet
 
 def create_advanced_routes(db, api_router):
     """Advanced features: exports, notifications, automation"""
@@ -114,63 +124,116 @@ def create_advanced_routes(db, api_router):
         if not session_doc:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Check if invoice already exists
-        existing = await db.invoices.find_one({"reference_id": session_id}, {"_id": 0})
-        if existing:
-            if isinstance(existing['created_at'], str):
-                existing['created_at'] = datetime.fromisoformat(existing['created_at'])
-            if isinstance(existing['due_date'], str):
-                existing['due_date'] = datetime.fromisoformat(existing['due_date'])
-            return existing
-        
-        # Create invoice
-        invoice_number = f"INV-{datetime.now(timezone.utc).strftime('%Y%m%d')}-{session_id[:8].upper()}"
-        
-        amount = session_doc.get('total_amount', 0)
-        tax_amount = amount * 0.18  # 18% GST
-        total_amount = amount + tax_amount
-        
-        invoice = {
-            "id": str(uuid.uuid4()),
-            "invoice_number": invoice_number,
-            "cafe_id": session_doc['cafe_id'],
-            "customer_id": session_doc['customer_id'],
-            "reference_id": session_id,
-            "amount": amount,
-            "tax_amount": tax_amount,
-            "total_amount": total_amount,
-            "status": "PAID" if session_doc.get('status') == 'COMPLETED' else "DRAFT",
-            "line_items": [{
-                "description": f"Gaming Session - Device {session_doc['device_id'][:8]}",
-                "quantity": session_doc.get('duration_hours', 0),
-                "rate": amount / session_doc.get('duration_hours', 1) if session_doc.get('duration_hours') else amount,
-                "amount": amount
-            }],
-            "due_date": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.invoices.insert_one(invoice)
-        
-        invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-        invoice['due_date'] = datetime.fromisoformat(invoice['due_date'])
+        invoice = await invoicing.invoice_for_session(db, session_doc)
+        if isinstance(invoice['created_at'], str):
+            invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
+        if isinstance(invoice['due_date'], str):
+            invoice['due_date'] = datetime.fromisoformat(invoice['due_date'])
         return invoice
     
+    @api_router.post("/invoices/batch")
+    async def generate_invoices_batch(
+        cafe_id: Optional[str] = None,
+        until: Optional[datetime] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
+        """Invoice every completed, un-invoiced session (month-end closing)"""
+        if current_user['role'] == 'SUPER_ADMIN':
+            cafe_ids = [cafe_id] if cafe_id else None
+        elif current_user['role'] == 'CAFE_OWNER':
+            query = {"owner_id": current_user['user_id']}
+            if cafe_id:
+                query["id"] = cafe_id
+            cafes = await db.cafes.find(query, {"_id": 0, "id": 1}).to_list(1000)
+            if cafe_id and not cafes:
+                raise HTTPException(status_code=403, detail="Not allowed to invoice this cafe")
+            cafe_ids = [c['id'] for c in cafes]
+        else:
+            raise HTTPException(status_code=403, detail="Only cafe owners can run invoicing")
+        
+        if until is not None and until.tzinfo is None:
+            until = until.replace(tzinfo=timezone.utc)
+        return await invoicing.run_invoicing(db, cafe_ids, until)
+    
     @api_router.get("/invoices/my")
-    async def get_my_invoices(current_user: dict = Depends(get_current_user)):
+    async def get_my_invoices(
+        limit: int = Query(50, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """Get invoices for customer"""
-        invoices = await db.invoices.find(
-            {"customer_id": current_user['user_id']},
-            {"_id": 0}
-        ).sort("created_at", -1).limit(50).to_list(50)
-        
-        for inv in invoices:
-            if isinstance(inv['created_at'], str):
-                inv['created_at'] = datetime.fromisoformat(inv['created_at'])
-            if isinstance(inv['due_date'], str):
-                inv['due_date'] = datetime.fromisoformat(inv['due_date'])
+        invoices, next_cursor = await paginate(
+            db.invoices, {"customer_id": current_user['user_id']}, limit=limit, cursor=cursor
+        )
         
-        return invoices
+        return paginated_response(invoices, next_cursor)
+    
+    async def can_manage_cafe(current_user: dict, cafe_id: str) -> bool:
+        if current_user['role'] == 'SUPER_ADMIN':
+            return True
+        if current_user['role'] == 'CAFE_OWNER':
+            return bool(await db.cafes.find_one({"id": cafe_id, "owner_id": current_user['user_id']}, {"_id": 0, "id": 1}))
+        if current_user['role'] == 'STAFF':
+            user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0, "cafe_id": 1})
+            return bool(user_doc) and user_doc.get('cafe_id') == cafe_id
+        return False
+    
+    @api_router.get("/invoices/export")
+    async def export_invoices(
+        cafe_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
+        """Zip of a cafe's invoice PDFs with a CSV summary, for the accountant"""
+        if not await can_manage_cafe(current_user, cafe_id):
+            raise HTTPException(status_code=403, detail="Not allowed to export this cafe's invoices")
+        
+        query = {"cafe_id": cafe_id}
+        created = {}
+        if start:
+            created["$gte"] = (start if start.tzinfo else start.replace(tzinfo=timezone.utc)).astimezone(timezone.utc).isoformat()
+        if end:
+            created["$lt"] = (end if end.tzinfo else end.replace(tzinfo=timezone.utc)).astimezone(timezone.utc).isoformat()
+        if created:
+            query["created_at"] = created
+        invoices = await db.invoices.find(query, {"_id": 0}).sort([("created_at", 1), ("invoice_number", 1)]).to_list(MAX_EXPORT_INVOICES + 1)
+        if len(invoices) > MAX_EXPORT_INVOICES:
+            raise HTTPException(status_code=400, detail=f"More than {MAX_EXPORT_INVOICES} invoices; narrow the date range")
+        
+        cafe = await db.cafes.find_one({"id": cafe_id}, {"_id": 0, "name": 1, "address": 1, "city": 1})
+        customer_ids = list({i['customer_id'] for i in invoices if i.get('customer_id')})
+        customers = {
+            u['id']: u for u in await db.users.find(
+                {"id": {"$in": customer_ids}}, {"_id": 0, "id": 1, "name": 1, "email": 1}
+            ).to_list(len(customer_ids))
+        }
+        data = await invoice_pdfs.export_zip(invoices, cafe, customers)
+        return StreamingResponse(
+            iter([data]),
+            media_type="application/zip",
+            headers={"Content-Disposition": f"attachment; filename=invoices-{cafe_id[:8]}.zip"}
+        )
+    
+    @api_router.get("/invoices/{invoice_id}/pdf")
+    async def get_invoice_pdf(invoice_id: str, current_user: dict = Depends(get_current_user)):
+        """Invoice as a PDF, rendered off the event loop and cached"""
+        invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
+        if not invoice:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        if invoice.get('customer_id') != current_user['user_id'] and not await can_manage_cafe(current_user, invoice['cafe_id']):
+            raise HTTPException(status_code=403, detail="Not allowed to view this invoice")
+        
+        cafe = await db.cafes.find_one({"id": invoice['cafe_id']}, {"_id": 0, "name": 1, "address": 1, "city": 1})
+        customer = None
+        if invoice.get('customer_id'):
+            customer = await db.users.find_one({"id": invoice['customer_id']}, {"_id": 0, "id": 1, "name": 1, "email": 1})
+        data = await invoice_pdfs.pdf(invoice, cafe, customer)
+        return StreamingResponse(
+            iter([data]),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"inline; filename={invoice.get('invoice_number') or invoice_id}.pdf"}
+        )
     
     # ==================== NO-SHOW & OVERSTAY AUTOMATION ====================
     
@@ -186,38 +249,64 @@ def create_advanced_routes(db, api_router):
         
         cafe_ids = [c['id'] for c in cafes]
         
-        # Find sessions that are active but haven't been started in 15 mins
-        cutoff_time = datetime.now(timezone.utc) - timedelta(minutes=15)
+        # Reservations nobody checked in on within the grace period; their slots go back on sale
+        missed = await reservations.expire_no_shows(db, cafe_ids)
+        
+        # ₹50 penalty, which may take the wallet below zero
+        penalties = [
+            wallet.Posting(
+                customer_id=reservation['customer_id'],
+                amount=-50,
+                transaction_type="debit",
+                description="No-show penalty",
+                contra_account=wallet.NO_SHOW_PENALTIES,
+                reference_id=reservation['id'],
+                allow_overdraft=True
+            )
+            for reservation in missed
+        ]
+        processed = len(missed)
         
-        no_show_sessions = await db.sessions.find({
-            "cafe_id": {"$in": cafe_ids},
-            "status": "ACTIVE",
-            "start_time": {"$lt": cutoff_time.isoformat()}
-        }, {"_id": 0}).limit(50).to_list(50)
+        await wallet.post_many(db, penalties)
         
-        processed = 0
-        for session in no_show_sessions:
-            # Mark as no-show and release device
-            await db.sessions.update_one(
-                {"id": session['id']},
-                {"$set": {"status": "NO_SHOW", "end_time": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            # Release device
-            await db.devices.update_one(
-                {"id": session['device_id']},
-                {"$set": {"status": "AVAILABLE"}}
-            )
-            
-            # Apply penalty to customer (reduce wallet balance)
-            await db.users.update_one(
-                {"id": session['customer_id']},
-                {"$inc": {"wallet_balance": -50}}  # ₹50 penalty
-            )
-            
-            processed += 1
+        return {"message": f"Processed {processed} no-shows", "reservations_processed": processed}
+    
+    @api_router.post("/automation/reconcile-wallets")
+    async def reconcile_wallets(current_user: dict = Depends(get_current_user)):
+        """Check every wallet balance against its ledger entries"""
+        if current_user['role'] != 'SUPER_ADMIN':
+            raise HTTPException(status_code=403, detail="Only admins can reconcile wallets")
+        
+        return await wallet.reconcile(db)
+    
+    @api_router.post("/automation/wallet-checkpoints")
+    async def write_wallet_checkpoints(current_user: dict = Depends(get_current_user)):
+        """Checkpoint the balance of every wallet with ledger activity since the last run"""
+        if current_user['role'] != 'SUPER_ADMIN':
+            raise HTTPException(status_code=403, detail="Only admins can write wallet checkpoints")
+        
+        return await wallet.write_checkpoints(db)
+    
+    @api_router.post("/automation/score-devices")
+    async def score_device_risk(
+        auto_schedule: bool = False,
+        limit: int = Query(50, ge=1, le=500),
+        current_user: dict = Depends(get_current_user)
+    ):
+        """Rank devices by predicted failure risk from their health telemetry"""
+        if current_user['role'] == 'SUPER_ADMIN':
+            cafe_ids = None
+        elif current_user['role'] == 'CAFE_OWNER':
+            cafes = await db.cafes.find({"owner_id": current_user['user_id']}, {"_id": 0, "id": 1}).limit(100).to_list(100)
+            cafe_ids = [c['id'] for c in cafes]
+        else:
+            raise HTTPException(status_code=403, detail="Only cafe owners can run automation")
+        
+        scored = await maintenance_risk.score_devices(db, cafe_ids)
+        await maintenance_risk.save_scores(db, scored)
+        scheduled = await maintenance_risk.schedule_maintenance(db, scored) if auto_schedule else []
         
-        return {"message": f"Processed {processed} no-shows", "sessions_processed": processed}
+        return DocumentResponse({"scored": len(scored), "devices": scored[:limit], "scheduled": scheduled})
     
     @api_router.post("/automation/check-overstay")
     async def check_overstay(current_user: dict = Depends(get_current_user)):
@@ -275,83 +364,97 @@ def create_advanced_routes(db, api_router):
         if not referrer_membership:
             raise HTTPException(status_code=404, detail="Invalid referral code")
         
-        # Check if already used
-        my_membership = await db.memberships.find_one({"customer_id": current_user['user_id']}, {"_id": 0})
-        if my_membership and my_membership.get('referred_by'):
-            raise HTTPException(status_code=400, detail="You have already used a referral code")
+        if referrer_membership['customer_id'] == current_user['user_id']:
+            raise HTTPException(status_code=400, detail="You cannot use your own referral code")
         
-        # Apply referral
-        await db.memberships.update_one(
-            {"customer_id": current_user['user_id']},
+        # Apply referral; the condition makes a second use fail even when concurrent
+        applied = await db.memberships.update_one(
+            {"customer_id": current_user['user_id'], "referred_by": None},
             {"$set": {"referred_by": referrer_membership['customer_id']}}
         )
+        if applied.modified_count == 0:
+            if not await db.memberships.count_documents({"customer_id": current_user['user_id']}, limit=1):
+                raise HTTPException(status_code=404, detail="Membership not found")
+            raise HTTPException(status_code=400, detail="You have already used a referral code")
         
         # Reward both users
         reward_amount = 100  # ₹100 for each
-        
-        # Reward referrer
-        await db.users.update_one(
-            {"id": referrer_membership['customer_id']},
-            {"$inc": {"wallet_balance": reward_amount}}
-        )
-        
-        # Create transaction for referrer
-        await db.wallet_transactions.insert_one({
-            "id": str(uuid.uuid4()),
-            "customer_id": referrer_membership['customer_id'],
-            "amount": reward_amount,
-            "transaction_type": "credit",
-            "description": "Referral reward",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        })
-        
-        # Reward new user
-        await db.users.update_one(
-            {"id": current_user['user_id']},
-            {"$inc": {"wallet_balance": reward_amount}}
-        )
-        
-        # Create transaction for new user
-        await db.wallet_transactions.insert_one({
-            "id": str(uuid.uuid4()),
-            "customer_id": current_user['user_id'],
-            "amount": reward_amount,
-            "transaction_type": "credit",
-            "description": "Referral signup bonus",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        })
+        await wallet.post_many(db, [
+            wallet.Posting(
+                customer_id=referrer_membership['customer_id'],
+                amount=reward_amount,
+                transaction_type="credit",
+                description="Referral reward",
+                contra_account=wallet.REFERRAL_REWARDS,
+                reference_id=current_user['user_id']
+            ),
+            wallet.Posting(
+                customer_id=current_user['user_id'],
+                amount=reward_amount,
+                transaction_type="credit",
+                description="Referral signup bonus",
+                contra_account=wallet.REFERRAL_REWARDS,
+                reference_id=referrer_membership['customer_id']
+            )
+        ])
         
         return {"message": "Referral applied successfully", "reward": reward_amount}
     
     # ==================== DEVICE HEALTH MONITORING ====================
     
-    @api_router.post("/devices/{device_id}/health-log")
-    async def log_device_health(device_id: str, metric: str, value: str, current_user: dict = Depends(get_current_user)):
-        """Log device health metric"""
-        health_log = {
-            "id": str(uuid.uuid4()),
-            "device_id": device_id,
-            "metric": metric,
-            "value": value,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.device_health_logs.insert_one(health_log)
+    @api_router.post("/devices/{device_id}/health-log", status_code=202)
+    async def log_device_health(device_id: str, metric: str, value: float, current_user: dict = Depends(get_current_user)):
+        """Log one device health metric (prefer the batch endpoint)"""
+        device = await db.devices.find_one({"id": device_id}, {"_id": 0, "id": 1, "cafe_id": 1})
+        if not device:
+            raise HTTPException(status_code=404, detail="Device not found")
+        
+        health_writer.add([reading_document(device, metric, value, None)])
         return {"message": "Health metric logged"}
     
+    @api_router.post("/devices/health/batch", status_code=202)
+    async def log_device_health_batch(batch: HealthReadingBatch, current_user: dict = Depends(get_current_user)):
+        """Queue a batch of typed health readings from device agents"""
+        device_ids = list({reading.device_id for reading in batch.readings})
+        devices = {
+            device['id']: device
+            async for device in db.devices.find({"id": {"$in": device_ids}}, {"_id": 0, "id": 1, "cafe_id": 1})
+        }
+        unknown = sorted(set(device_ids) - devices.keys())
+        if unknown:
+            raise HTTPException(status_code=404, detail=f"Unknown devices: {', '.join(unknown[:10])}")
+        
+        health_writer.add([
+            reading_document(devices[reading.device_id], reading.metric, reading.value, reading.timestamp)
+            for reading in batch.readings
+        ])
+        return {"accepted": len(batch.readings)}
+    
     @api_router.get("/devices/{device_id}/health")
-    async def get_device_health(device_id: str, current_user: dict = Depends(get_current_user)):
+    async def get_device_health(
+        device_id: str,
+        limit: int = Query(100, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """Get device health history"""
-        logs = await db.device_health_logs.find(
-            {"device_id": device_id},
-            {"_id": 0}
-        ).sort("timestamp", -1).limit(100).to_list(100)
-        
-        for log in logs:
-            if isinstance(log['timestamp'], str):
-                log['timestamp'] = datetime.fromisoformat(log['timestamp'])
-        
-        return logs
+        readings, next_cursor = await raw_readings(db, device_id, limit, cursor)
+        return paginated_response(readings, next_cursor)
+    
+    @api_router.get("/devices/{device_id}/health/summary")
+    async def get_device_health_summary(
+        device_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        step: Optional[str] = Query(None, description="Window size such as 30s, 5m, 1h or 1d"),
+        metrics: Optional[str] = Query(None, description="Comma-separated metrics; all when omitted"),
+        current_user: dict = Depends(get_current_user)
+    ):
+        """min/max/avg/p95 per metric and window, for charts (defaults to the last 24 hours)"""
+        end = end or datetime.now(timezone.utc)
+        start = start or end - timedelta(days=1)
+        names = [name.strip() for name in metrics.split(',') if name.strip()] if metrics else None
+        return DocumentResponse(await health_series(db, device_id, start, end, step, names))
     
     # ==================== FRANCHISE DASHBOARD ====================
     
@@ -1,15 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone, timedelta
 from typing import List, Optional
 import uuid
-import qrcode
-import io
-import base64
 
 from models_extended import *
 from auth import get_current_user
+from pagination import paginate, paginated_response
+from projection import field_projection, partial_model
+from responses import DocumentResponse
+from caching import public_reads, catalog_changed, catalog_etag, cache_headers, not_modified
 from ai_agents_extended import extended_ai_agents
+from realtime import status_hub
+from billing_meter import billing_meter
+from availability import availability_index
+import waitlist
+import wallet
+from coupons import coupon_index, redeem_coupon
+from pricing_engine import CAFE_TIMEZONE, price_quotes, pricing_engine, rule_windows
+from qr_codes import QR_MEDIA_TYPES, session_qr_codes
 
 def create_extended_routes(db, api_router):
     """Create all extended API routes"""
@@ -27,32 +36,55 @@ def create_extended_routes(db, api_router):
         doc = game.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
         await db.games.insert_one(doc)
+        await catalog_changed(db, "games", f"games:{game.cafe_id}")
         return game
     
-    @api_router.get("/games", response_model=List[Game])
-    async def list_games(cafe_id: Optional[str] = None, device_type: Optional[DeviceType] = None):
+    @api_router.get("/games", response_model=List[partial_model(Game)])
+    async def list_games(
+        request: Request,
+        cafe_id: Optional[str] = None,
+        device_type: Optional[DeviceType] = None,
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+        limit: int = Query(100, ge=1, le=100),
+        cursor: Optional[str] = None
+    ):
         """List games"""
+        scope = f"games:{cafe_id}" if cafe_id else "games"
+        etag = await catalog_etag(db, request, scope)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        
         query = {}
         if cafe_id:
             query["cafe_id"] = cafe_id
         if device_type:
             query["device_types"] = device_type.value
         
-        games = await db.games.find(query, {"_id": 0}).limit(100).to_list(100)
-        for game in games:
-            if isinstance(game['created_at'], str):
-                game['created_at'] = datetime.fromisoformat(game['created_at'])
-        return games
+        async def load():
+            return await paginate(
+                db.games, query, limit=limit, cursor=cursor, projection=field_projection(Game, fields)
+            )
+        
+        games, next_cursor = await public_reads.get(etag, load, tags=(scope,))
+        response = paginated_response(games, next_cursor)
+        response.headers.update(cache_headers(etag))
+        return response
     
     @api_router.get("/games/{game_id}", response_model=Game)
-    async def get_game(game_id: str):
+    async def get_game(game_id: str, request: Request):
         """Get game details with guides"""
-        game_doc = await db.games.find_one({"id": game_id}, {"_id": 0})
+        etag = await catalog_etag(db, request, "games")
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        
+        game_doc = await public_reads.get(
+            etag, lambda: db.games.find_one({"id": game_id}, {"_id": 0}), tags=("games",)
+        )
         if not game_doc:
             raise HTTPException(status_code=404, detail="Game not found")
-        if isinstance(game_doc['created_at'], str):
-            game_doc['created_at'] = datetime.fromisoformat(game_doc['created_at'])
-        return Game(**game_doc)
+        return DocumentResponse(game_doc, headers=cache_headers(etag))
     
     # ==================== MEMBERSHIP & LOYALTY ROUTES ====================
     
@@ -92,11 +124,6 @@ def create_extended_routes(db, api_router):
         if not pass_info:
             raise HTTPException(status_code=400, detail="Invalid pass type")
         
-        # Check wallet balance
-        user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0})
-        if user_doc['wallet_balance'] < pass_info['price']:
-            raise HTTPException(status_code=400, detail="Insufficient wallet balance")
-        
         # Create pass
         valid_from = datetime.now(timezone.utc)
         valid_until = valid_from + timedelta(days=30 if request.pass_type == PassType.MONTHLY else 7 if request.pass_type == PassType.WEEKLY else 1)
@@ -111,44 +138,44 @@ def create_extended_routes(db, api_router):
             valid_until=valid_until
         )
         
+        # Store the pass unpaid before charging, so a debit always has its pass;
+        # wallet.recover_pass_purchases finishes purchases a crash interrupted
         doc = pass_obj.model_dump()
         doc['valid_from'] = doc['valid_from'].isoformat()
         doc['valid_until'] = doc['valid_until'].isoformat()
         doc['created_at'] = doc['created_at'].isoformat()
-        await db.passes.insert_one(doc)
+        await db.passes.insert_one({**doc, "is_active": False, "payment_pending": True})
         
-        # Deduct from wallet
-        await db.users.update_one(
-            {"id": current_user['user_id']},
-            {"$inc": {"wallet_balance": -pass_info['price']}}
-        )
-        
-        # Record transaction
-        transaction = WalletTransaction(
-            customer_id=current_user['user_id'],
-            amount=-pass_info['price'],
-            transaction_type="debit",
-            description=f"Purchased {request.pass_type.value} pass",
-            reference_id=pass_obj.id
+        # The debit is refused atomically if the balance is short
+        try:
+            await wallet.post(db, wallet.Posting(
+                customer_id=current_user['user_id'],
+                amount=-pass_info['price'],
+                transaction_type="debit",
+                description=f"Purchased {request.pass_type.value} pass",
+                contra_account=wallet.PASS_SALES,
+                reference_id=pass_obj.id
+            ))
+        except HTTPException:
+            await db.passes.delete_one({"id": pass_obj.id, "payment_pending": True})
+            raise
+        await db.passes.update_one(
+            {"id": pass_obj.id}, {"$set": {"is_active": True}, "$unset": {"payment_pending": ""}}
         )
-        trans_doc = transaction.model_dump()
-        trans_doc['created_at'] = trans_doc['created_at'].isoformat()
-        await db.wallet_transactions.insert_one(trans_doc)
         
         return pass_obj
     
     @api_router.get("/membership/passes", response_model=List[Pass])
-    async def list_my_passes(current_user: dict = Depends(get_current_user)):
+    async def list_my_passes(
+        limit: int = Query(50, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """List customer passes"""
-        passes = await db.passes.find({"customer_id": current_user['user_id']}, {"_id": 0}).limit(50).to_list(50)
-        for p in passes:
-            if isinstance(p['valid_from'], str):
-                p['valid_from'] = datetime.fromisoformat(p['valid_from'])
-            if isinstance(p['valid_until'], str):
-                p['valid_until'] = datetime.fromisoformat(p['valid_until'])
-            if isinstance(p['created_at'], str):
-                p['created_at'] = datetime.fromisoformat(p['created_at'])
-        return passes
+        passes, next_cursor = await paginate(
+            db.passes, {"customer_id": current_user['user_id']}, limit=limit, cursor=cursor
+        )
+        return paginated_response(passes, next_cursor)
     
     @api_router.post("/wallet/add-money")
     async def add_money_to_wallet(amount: float, current_user: dict = Depends(get_current_user)):
@@ -156,31 +183,38 @@ def create_extended_routes(db, api_router):
         if amount <= 0:
             raise HTTPException(status_code=400, detail="Amount must be positive")
         
-        await db.users.update_one(
-            {"id": current_user['user_id']},
-            {"$inc": {"wallet_balance": amount}}
-        )
-        
-        transaction = WalletTransaction(
+        new_balance = await wallet.post(db, wallet.Posting(
             customer_id=current_user['user_id'],
             amount=amount,
             transaction_type="credit",
-            description="Wallet recharge"
-        )
-        trans_doc = transaction.model_dump()
-        trans_doc['created_at'] = trans_doc['created_at'].isoformat()
-        await db.wallet_transactions.insert_one(trans_doc)
+            description="Wallet recharge",
+            contra_account=wallet.RECHARGES
+        ))
         
-        return {"message": "Money added successfully", "new_balance": (await db.users.find_one({"id": current_user['user_id']}, {"_id": 0}))['wallet_balance']}
+        return {"message": "Money added successfully", "new_balance": new_balance}
     
     @api_router.get("/wallet/transactions", response_model=List[WalletTransaction])
-    async def get_wallet_transactions(current_user: dict = Depends(get_current_user)):
+    async def get_wallet_transactions(
+        limit: int = Query(50, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """Get wallet transaction history"""
-        transactions = await db.wallet_transactions.find({"customer_id": current_user['user_id']}, {"_id": 0}).sort("created_at", -1).limit(50).to_list(50)
-        for t in transactions:
-            if isinstance(t['created_at'], str):
-                t['created_at'] = datetime.fromisoformat(t['created_at'])
-        return transactions
+        transactions, next_cursor = await paginate(
+            db.wallet_transactions,
+            {"customer_id": current_user['user_id'], "state": {"$ne": wallet.FAILED}},
+            limit=limit,
+            cursor=cursor
+        )
+        return paginated_response(transactions, next_cursor)
+    
+    @api_router.get("/wallet/balance")
+    async def get_wallet_balance_at(at: datetime, current_user: dict = Depends(get_current_user)):
+        """Wallet balance as of a past moment, rebuilt from the ledger"""
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        balance = await wallet.balance_at(db, current_user['user_id'], at)
+        return {"customer_id": current_user['user_id'], "at": at, "balance": round(balance, 2)}
     
     # ==================== PRICING RULES & COUPONS ====================
     
@@ -191,25 +225,76 @@ def create_extended_routes(db, api_router):
         if not cafes:
             raise HTTPException(status_code=404, detail="No cafe found")
         
+        if rule_data.multiplier <= 0:
+            raise HTTPException(status_code=400, detail="Multiplier must be positive")
+        try:
+            rule_windows(rule_data.model_dump())
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        
         rule = PricingRule(**rule_data.model_dump(), cafe_id=cafes[0]['id'])
         doc = rule.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
         await db.pricing_rules.insert_one(doc)
+        
+        # Running bills switch to the new timeline straight away
+        await pricing_engine.rules_changed(db, rule.cafe_id)
+        billing_meter.set_timeline(rule.cafe_id, await pricing_engine.timeline(db, rule.cafe_id))
         return rule
     
     @api_router.get("/pricing-rules", response_model=List[PricingRule])
-    async def list_pricing_rules(current_user: dict = Depends(get_current_user)):
+    async def list_pricing_rules(
+        limit: int = Query(50, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """List pricing rules"""
         cafes = await db.cafes.find({"owner_id": current_user['user_id']}, {"_id": 0, "id": 1}).limit(10).to_list(10)
         if not cafes:
             return []
         
-        rules = await db.pricing_rules.find({"cafe_id": cafes[0]['id']}, {"_id": 0}).limit(50).to_list(50)
-        for r in rules:
-            if isinstance(r['created_at'], str):
-                r['created_at'] = datetime.fromisoformat(r['created_at'])
-        return rules
-    
+        rules, next_cursor = await paginate(
+            db.pricing_rules, {"cafe_id": cafes[0]['id']}, limit=limit, cursor=cursor
+        )
+        return paginated_response(rules, next_cursor)
+
+    @api_router.post("/pricing/quote", response_model=List[PriceQuote])
+    async def quote_prices(batch: PriceQuoteBatch, current_user: dict = Depends(get_current_user)):
+        """Price many device x start time x duration combinations in one round trip"""
+        device_ids = list({quote.device_id for quote in batch.quotes})
+        devices = {
+            device['id']: device
+            async for device in db.devices.find(
+                {"id": {"$in": device_ids}}, {"_id": 0, "id": 1, "cafe_id": 1, "hourly_rate": 1}
+            )
+        }
+        missing = [device_id for device_id in device_ids if device_id not in devices]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Device not found: {', '.join(missing)}")
+
+        codes = list({quote.coupon_code.upper() for quote in batch.quotes if quote.coupon_code})
+        coupons = {}
+        if codes:
+            async for coupon in db.coupons.find({"code": {"$in": codes}}, {"_id": 0}):
+                coupons[(coupon['cafe_id'], coupon['code'])] = coupon
+
+        cafe_ids = {device['cafe_id'] for device in devices.values()}
+        timelines = {cafe_id: await pricing_engine.timeline(db, cafe_id) for cafe_id in cafe_ids}
+
+        quotes = []
+        for quote in batch.quotes:
+            start = quote.start_time if quote.start_time.tzinfo else quote.start_time.replace(tzinfo=CAFE_TIMEZONE)
+            start_ts = start.timestamp()
+            quotes.append({
+                "device_id": quote.device_id,
+                "start_time": start,
+                "duration_hours": quote.duration_hours,
+                "start_ts": start_ts,
+                "end_ts": start_ts + quote.duration_hours * 3600,
+                "coupon_code": quote.coupon_code.upper() if quote.coupon_code else None
+            })
+        return DocumentResponse(price_quotes(quotes, devices, coupons, timelines, datetime.now(timezone.utc)))
+
     @api_router.post("/coupons", response_model=Coupon)
     async def create_coupon(coupon_data: CouponCreate, current_user: dict = Depends(get_current_user)):
         """Create coupon"""
@@ -236,38 +321,24 @@ def create_extended_routes(db, api_router):
         doc['valid_until'] = doc['valid_until'].isoformat()
         doc['created_at'] = doc['created_at'].isoformat()
         await db.coupons.insert_one(doc)
+        await coupon_index.coupon_written(db, doc)
         return coupon
     
     @api_router.post("/coupons/apply")
     async def apply_coupon(request: ApplyCouponRequest, current_user: dict = Depends(get_current_user)):
         """Apply coupon to session"""
-        # Find coupon
-        coupon_doc = await db.coupons.find_one({"code": request.code.upper()}, {"_id": 0})
-        if not coupon_doc:
-            raise HTTPException(status_code=404, detail="Invalid coupon code")
-        
-        if isinstance(coupon_doc['valid_from'], str):
-            coupon_doc['valid_from'] = datetime.fromisoformat(coupon_doc['valid_from'])
-        if isinstance(coupon_doc['valid_until'], str):
-            coupon_doc['valid_until'] = datetime.fromisoformat(coupon_doc['valid_until'])
-        
-        now = datetime.now(timezone.utc)
-        if not coupon_doc['is_active'] or now < coupon_doc['valid_from'] or now > coupon_doc['valid_until']:
-            raise HTTPException(status_code=400, detail="Coupon expired or inactive")
-        
-        if coupon_doc['max_uses'] and coupon_doc['used_count'] >= coupon_doc['max_uses']:
-            raise HTTPException(status_code=400, detail="Coupon usage limit reached")
-        
-        # Update session with coupon
-        await db.sessions.update_one(
-            {"id": request.session_id},
-            {"$set": {"coupon_code": request.code.upper(), "coupon_discount": coupon_doc['discount_value']}}
-        )
+        session_doc = await db.sessions.find_one({"id": request.session_id}, {"_id": 0})
+        if not session_doc or (
+            current_user['role'] == 'CUSTOMER' and session_doc['customer_id'] != current_user['user_id']
+        ):
+            raise HTTPException(status_code=404, detail="Session not found")
         
-        # Increment usage
-        await db.coupons.update_one(
-            {"code": request.code.upper()},
-            {"$inc": {"used_count": 1}}
+        coupon_doc = await redeem_coupon(db, request.code, session_doc)
+        billing_meter.adjust(
+            request.session_id,
+            discount_type=coupon_doc['discount_type'],
+            discount_value=coupon_doc['discount_value'],
+            min_amount=coupon_doc.get('min_amount') or 0.0
         )
         
         return {"message": "Coupon applied successfully", "discount": coupon_doc['discount_value']}
@@ -286,31 +357,126 @@ def create_extended_routes(db, api_router):
         doc['scheduled_date'] = doc['scheduled_date'].isoformat()
         doc['created_at'] = doc['created_at'].isoformat()
         await db.device_maintenance.insert_one(doc)
+        availability_index.apply_maintenance(doc)
+        await availability_index.maintenance_changed(db, device_doc['cafe_id'])
         
         # Update device status
         await db.devices.update_one(
             {"id": maintenance_data.device_id},
             {"$set": {"status": "MAINTENANCE"}}
         )
+        status_hub.publish_device_status(device_doc['cafe_id'], maintenance_data.device_id, "MAINTENANCE")
+        availability_index.set_status(maintenance_data.device_id, "MAINTENANCE")
         
         return maintenance
     
+    @api_router.post("/devices/maintenance/{maintenance_id}/complete", response_model=DeviceMaintenance)
+    async def complete_maintenance(
+        maintenance_id: str,
+        cost: Optional[float] = None,
+        notes: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
+        """Close a maintenance record and put the device back in service"""
+        completed_date = datetime.now(timezone.utc)
+        updates = {"status": MaintenanceStatus.COMPLETED.value, "completed_date": completed_date.isoformat()}
+        if cost is not None:
+            updates['cost'] = cost
+        if notes is not None:
+            updates['notes'] = notes
+        record = await db.device_maintenance.find_one_and_update(
+            {"id": maintenance_id, "status": {"$ne": MaintenanceStatus.COMPLETED.value}},
+            {"$set": updates},
+            projection={"_id": 0}
+        )
+        if record is None:
+            raise HTTPException(status_code=404, detail="Open maintenance record not found")
+        record.update(updates)
+        availability_index.apply_maintenance(record)
+        await availability_index.maintenance_changed(db, record['cafe_id'])
+        
+        # Back in service unless another manual visit still holds it (predictive ones never take it out)
+        still_open = await db.device_maintenance.count_documents({
+            "device_id": record['device_id'],
+            "status": {"$in": [MaintenanceStatus.SCHEDULED.value, MaintenanceStatus.IN_PROGRESS.value]},
+            "maintenance_type": {"$ne": "predictive"}
+        })
+        if not still_open:
+            released = await db.devices.update_one(
+                {"id": record['device_id'], "status": "MAINTENANCE"},
+                {"$set": {"status": "AVAILABLE"}}
+            )
+            if released.modified_count:
+                status_hub.publish_device_status(record['cafe_id'], record['device_id'], "AVAILABLE")
+                availability_index.set_status(record['device_id'], "AVAILABLE")
+                await waitlist.hand_off(db, record['device_id'])
+        
+        return record
+    
     @api_router.get("/devices/maintenance", response_model=List[DeviceMaintenance])
-    async def list_maintenance_records(current_user: dict = Depends(get_current_user)):
+    async def list_maintenance_records(
+        limit: int = Query(50, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
         """List maintenance records"""
         cafes = await db.cafes.find({"owner_id": current_user['user_id']}, {"_id": 0, "id": 1}).limit(10).to_list(10)
         if not cafes:
             return []
         
-        records = await db.device_maintenance.find({"cafe_id": cafes[0]['id']}, {"_id": 0}).sort("scheduled_date", -1).limit(50).to_list(50)
-        for r in records:
-            if isinstance(r['scheduled_date'], str):
-                r['scheduled_date'] = datetime.fromisoformat(r['scheduled_date'])
-            if r.get('completed_date') and isinstance(r['completed_date'], str):
-                r['completed_date'] = datetime.fromisoformat(r['completed_date'])
-            if isinstance(r['created_at'], str):
-                r['created_at'] = datetime.fromisoformat(r['created_at'])
-        return records
+        records, next_cursor = await paginate(
+            db.device_maintenance, {"cafe_id": cafes[0]['id']},
+            sort_field="scheduled_date", limit=limit, cursor=cursor
+        )
+        return paginated_response(records, next_cursor)
+    
+    # ==================== WAITLIST ====================
+    
+    @api_router.post("/waitlist", response_model=WaitlistEntry)
+    async def join_waitlist(request: WaitlistJoin, current_user: dict = Depends(get_current_user)):
+        """Queue for the next free device of a type; members of higher tiers are served first"""
+        customer_id = current_user['user_id']
+        if request.customer_id and current_user['role'] != 'CUSTOMER':
+            customer_id = request.customer_id
+        return await waitlist.join(db, request.cafe_id, request.device_type.value, customer_id)
+    
+    @api_router.get("/waitlist", response_model=List[WaitlistEntry])
+    async def get_waitlist(
+        cafe_id: Optional[str] = None,
+        device_type: Optional[DeviceType] = None,
+        limit: int = Query(50, ge=1, le=200),
+        current_user: dict = Depends(get_current_user)
+    ):
+        """The queue for a device type in serving order, or a customer's own entries"""
+        if current_user['role'] == 'CUSTOMER':
+            docs = await db.waitlist.find(
+                {"customer_id": current_user['user_id'], "status": {"$in": [WaitlistStatus.WAITING.value, WaitlistStatus.ASSIGNED.value]}},
+                {"_id": 0}
+            ).sort("joined_at", -1).limit(limit).to_list(limit)
+            return [await waitlist.entry_view(db, doc) for doc in docs]
+        if not cafe_id or device_type is None:
+            raise HTTPException(status_code=400, detail="cafe_id and device_type are required")
+        return await waitlist.queue(db, cafe_id, device_type.value, limit)
+    
+    @api_router.get("/waitlist/{entry_id}", response_model=WaitlistEntry)
+    async def get_waitlist_entry(entry_id: str, current_user: dict = Depends(get_current_user)):
+        """One entry with its current position and estimated wait"""
+        doc = await db.waitlist.find_one({"id": entry_id}, {"_id": 0})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Waitlist entry not found")
+        if current_user['role'] == 'CUSTOMER' and doc['customer_id'] != current_user['user_id']:
+            raise HTTPException(status_code=403, detail="Not your waitlist entry")
+        return await waitlist.entry_view(db, doc)
+    
+    @api_router.post("/waitlist/{entry_id}/cancel", response_model=WaitlistEntry)
+    async def leave_waitlist(entry_id: str, current_user: dict = Depends(get_current_user)):
+        """Leave the waitlist"""
+        doc = await db.waitlist.find_one({"id": entry_id}, {"_id": 0, "customer_id": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Waitlist entry not found")
+        if current_user['role'] == 'CUSTOMER' and doc['customer_id'] != current_user['user_id']:
+            raise HTTPException(status_code=403, detail="Not your waitlist entry")
+        return await waitlist.cancel(db, entry_id)
     
     # ==================== SESSION EXTENSIONS ====================
     
@@ -332,29 +498,34 @@ def create_extended_routes(db, api_router):
             {"id": session_id},
             {"$set": {"status": "EXTENDED"}, "$inc": {"total_amount": additional_cost}}
         )
+        billing_meter.apply_document({
+            **session_doc,
+            "status": "EXTENDED",
+            "total_amount": session_doc.get('total_amount', 0) + additional_cost
+        })
         
         return {"message": "Session extended", "additional_cost": additional_cost}
     
     # ==================== QR CODE GENERATION ====================
     
     @api_router.get("/sessions/{session_id}/qr")
-    async def get_session_qr(session_id: str, current_user: dict = Depends(get_current_user)):
-        """Generate QR code for session check-in"""
-        session_doc = await db.sessions.find_one({"id": session_id}, {"_id": 0})
+    async def get_session_qr(
+        session_id: str,
+        format: str = Query("json", pattern="^(json|png|svg)$"),
+        current_user: dict = Depends(get_current_user)
+    ):
+        """QR code for session check-in: a base64 PNG in JSON, or the raw PNG/SVG image"""
+        session_doc = await db.sessions.find_one({"id": session_id}, {"_id": 0, "id": 1})
         if not session_doc:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Generate QR code
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(f"SESSION:{session_id}")
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
-        return {"qr_code": f"data:image/png;base64,{img_str}", "session_id": session_id}
+        if format == "json":
+            return {"qr_code": await session_qr_codes.data_uri(session_id), "session_id": session_id}
+        return Response(
+            content=await session_qr_codes.image(session_id, format),
+            media_type=QR_MEDIA_TYPES[format],
+            headers={"Cache-Control": "private, max-age=3600"}
+        )
     
     # ==================== EXTENDED AI AGENTS ====================
     
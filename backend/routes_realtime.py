@@ -0,0 +1,155 @@
+from fastapi import Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict
+import asyncio
+import os
+import orjson
+
+from auth import get_current_user, verify_token
+from realtime import status_hub
+from billing_meter import billing_meter
+from pricing_engine import pricing_engine
+
+BILLING_STREAM_INTERVAL_SECONDS = float(os.environ.get('BILLING_STREAM_INTERVAL_SECONDS', '5'))
+
+def create_realtime_routes(db, api_router):
+    """Live device status and billing feeds"""
+
+    async def can_watch_cafe(current_user: dict, cafe_id: str) -> bool:
+        if current_user['role'] == 'SUPER_ADMIN':
+            return True
+        if current_user['role'] == 'CAFE_OWNER':
+            cafe_doc = await db.cafes.find_one({"id": cafe_id, "owner_id": current_user['user_id']}, {"_id": 0, "id": 1})
+            return cafe_doc is not None
+        if current_user['role'] == 'STAFF':
+            user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0, "cafe_id": 1})
+            return bool(user_doc) and user_doc.get('cafe_id') == cafe_id
+        return False
+
+    async def can_watch_session(current_user: dict, session_id: str) -> bool:
+        entry = billing_meter.get(session_id)
+        if entry is None:
+            session_doc = await db.sessions.find_one({"id": session_id}, {"_id": 0, "cafe_id": 1, "customer_id": 1})
+            if not session_doc:
+                return False
+            cafe_id, customer_id = session_doc['cafe_id'], session_doc['customer_id']
+        else:
+            cafe_id, customer_id = entry.cafe_id, entry.customer_id
+        return customer_id == current_user['user_id'] or await can_watch_cafe(current_user, cafe_id)
+
+    async def session_bill(session_id: str) -> Dict:
+        entry = billing_meter.get(session_id)
+        if entry is not None:
+            # Picks up rule changes made through other workers
+            billing_meter.set_timeline(entry.cafe_id, await pricing_engine.timeline(db, entry.cafe_id))
+        total = billing_meter.session_total(session_id)
+        return {
+            "session_id": session_id,
+            "active": total is not None,
+            "running_total": round(total, 2) if total is not None else None,
+            "at": datetime.now(timezone.utc)
+        }
+
+    async def cafe_bill(cafe_id: str) -> Dict:
+        billing_meter.set_timeline(cafe_id, await pricing_engine.timeline(db, cafe_id))
+        timeline = billing_meter.timeline(cafe_id)
+        now = datetime.now(timezone.utc)
+        ts = now.timestamp()
+        return {
+            "cafe_id": cafe_id,
+            "running_total": round(billing_meter.cafe_total(cafe_id, ts), 2),
+            "sessions": [
+                {"session_id": entry.session_id, "device_id": entry.device_id, "running_total": round(entry.total(ts, timeline), 2)}
+                for entry in billing_meter.cafe_sessions(cafe_id)
+            ],
+            "at": now
+        }
+
+    def event_stream(request: Request, snapshot: Callable[[], Awaitable[Dict]]) -> StreamingResponse:
+        """Server-sent events carrying ``await snapshot()`` every few seconds until the client leaves"""
+        async def events():
+            while not await request.is_disconnected():
+                yield b"data: " + orjson.dumps(await snapshot()) + b"\n\n"
+                await asyncio.sleep(BILLING_STREAM_INTERVAL_SECONDS)
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    @api_router.websocket("/ws/cafes/{cafe_id}/devices")
+    async def device_status_feed(websocket: WebSocket, cafe_id: str, token: str = Query(...)):
+        """Push device status deltas for a cafe.
+
+        Browsers cannot set headers on a WebSocket, so the JWT comes in the
+        ``token`` query parameter. The first message is a snapshot of every
+        device's status; after that only deltas are sent.
+        """
+        try:
+            current_user = verify_token(token)
+        except HTTPException:
+            await websocket.close(code=1008)
+            return
+        if not await can_watch_cafe(current_user, cafe_id):
+            await websocket.close(code=1008)
+            return
+
+        await websocket.accept()
+        # Subscribe before reading the snapshot so no change can fall between them
+        subscription = status_hub.subscribe(cafe_id)
+
+        async def push():
+            devices = await db.devices.find(
+                {"cafe_id": cafe_id}, {"_id": 0, "id": 1, "status": 1}
+            ).to_list(None)
+            await websocket.send_text(orjson.dumps({"type": "snapshot", "devices": devices}).decode())
+            while True:
+                message = await subscription.queue.get()
+                if subscription.dropped:
+                    # Too far behind; the client reconnects and gets a new snapshot
+                    await websocket.close(code=1013)
+                    return
+                await websocket.send_text(message)
+
+        async def listen():
+            while True:
+                await websocket.receive_text()
+
+        tasks = [asyncio.create_task(push()), asyncio.create_task(listen())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            status_hub.unsubscribe(subscription)
+
+    # ==================== LIVE BILLING ====================
+    
+    @api_router.get("/sessions/{session_id}/bill")
+    async def get_session_bill(session_id: str, current_user: dict = Depends(get_current_user)):
+        """Running bill of an open session"""
+        if not await can_watch_session(current_user, session_id):
+            raise HTTPException(status_code=404, detail="Session not found")
+        return await session_bill(session_id)
+    
+    @api_router.get("/sessions/{session_id}/bill/stream")
+    async def stream_session_bill(session_id: str, request: Request, token: str = Query(...)):
+        """Stream the running bill of an open session (JWT in ``token``, as EventSource cannot set headers)"""
+        if not await can_watch_session(verify_token(token), session_id):
+            raise HTTPException(status_code=404, detail="Session not found")
+        return event_stream(request, lambda: session_bill(session_id))
+    
+    @api_router.get("/billing/cafes/{cafe_id}/live")
+    async def stream_cafe_bill(cafe_id: str, request: Request, token: str = Query(...)):
+        """Stream the running totals of every open session in a cafe (JWT in ``token``)"""
+        if not await can_watch_cafe(verify_token(token), cafe_id):
+            raise HTTPException(status_code=403, detail="Access denied")
+        return event_stream(request, lambda: cafe_bill(cafe_id))
+    
+    return api_router
@@ -1,19 +1,42 @@
-from fastapi import FastAPI, APIRouter, Depends, HTTPException
+from fastapi import FastAPI, APIRouter, Body, Depends, File, HTTPException, Query, Request, UploadFile
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime, timezone, timedelta
 import razorpay
 
 from models import *
+from models_extended import Reservation, ReservationCreate, WaitlistStatus
 from auth import *
+from responses import DocumentResponse
+from pagination import paginate, paginated_response, NEXT_CURSOR_HEADER
+from projection import field_projection, partial_model
+from caching import public_reads, catalog_changed, catalog_etag, cache_headers, not_modified
+from indexes import ensure_indexes
+from idempotency import IdempotencyMiddleware, REPLAYED_HEADER
+from realtime import status_hub
+from change_feed import change_feed
+from billing_meter import ActiveSession, billing_meter
+from availability import availability_index
+import reservations
+from reservations import reservation_book
+from sessions import open_session, release_device
+from device_import import csv_rows, validate_devices
+import waitlist
+from device_health import health_writer, migrate_legacy_readings
+from invoice_pdf import invoice_pdfs
+from health_rollups import apply_readings
+from pricing_engine import CAFE_TIMEZONE, pricing_engine
 from ai_agents import ai_orchestrator
+from maintenance_risk import top_risks
 from routes_extended import create_extended_routes
 from routes_advanced import create_advanced_routes
+from routes_realtime import create_realtime_routes
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -30,7 +53,7 @@ razorpay_client = razorpay.Client(auth=(
 ))
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # ==================== AUTH ROUTES ====================
@@ -135,11 +158,17 @@ async def create_cafe(cafe_data: CafeCreate, current_user: dict = Depends(get_cu
         {"id": cafe.id},
         {"$set": {"subscription_id": subscription.id}}
     )
+    await catalog_changed(db, "cafes", f"cafe:{cafe.id}")
     
     return cafe
 
-@api_router.get("/cafes", response_model=List[Cafe])
-async def list_cafes(current_user: dict = Depends(get_current_user)):
+@api_router.get("/cafes", response_model=List[partial_model(Cafe)])
+async def list_cafes(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """List all cafes (filtered by role)"""
     query = {}
     
@@ -151,66 +180,102 @@ async def list_cafes(current_user: dict = Depends(get_current_user)):
         if user_doc and user_doc.get('cafe_id'):
             query = {"id": user_doc['cafe_id']}
     
-    cafes = await db.cafes.find(query, {"_id": 0}).limit(100).to_list(100)
-    
-    for cafe in cafes:
-        if isinstance(cafe['created_at'], str):
-            cafe['created_at'] = datetime.fromisoformat(cafe['created_at'])
+    cafes, next_cursor = await paginate(
+        db.cafes, query, limit=limit, cursor=cursor, projection=field_projection(Cafe, fields)
+    )
     
-    return cafes
+    return paginated_response(cafes, next_cursor)
 
-@api_router.get("/cafes/public", response_model=List[Cafe])
-async def list_public_cafes():
+@api_router.get("/cafes/public", response_model=List[partial_model(Cafe)])
+async def list_public_cafes(
+    request: Request,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = None
+):
     """List all active cafes (public endpoint)"""
-    cafes = await db.cafes.find({"is_active": True}, {"_id": 0}).to_list(100)
+    etag = await catalog_etag(db, request, "cafes")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    async def load():
+        return await paginate(
+            db.cafes, {"is_active": True}, limit=limit, cursor=cursor,
+            projection=field_projection(Cafe, fields)
+        )
     
-    for cafe in cafes:
-        if isinstance(cafe['created_at'], str):
-            cafe['created_at'] = datetime.fromisoformat(cafe['created_at'])
+    cafes, next_cursor = await public_reads.get(etag, load, tags=("cafes",))
     
-    return cafes
+    response = paginated_response(cafes, next_cursor)
+    response.headers.update(cache_headers(etag))
+    return response
 
 @api_router.get("/cafes/{cafe_id}", response_model=Cafe)
-async def get_cafe(cafe_id: str):
+async def get_cafe(cafe_id: str, request: Request):
     """Get cafe details (public)"""
-    cafe_doc = await db.cafes.find_one({"id": cafe_id}, {"_id": 0})
+    etag = await catalog_etag(db, request, f"cafe:{cafe_id}")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    cafe_doc = await public_reads.get(
+        etag, lambda: db.cafes.find_one({"id": cafe_id}, {"_id": 0}), tags=(f"cafe:{cafe_id}",)
+    )
     if not cafe_doc:
         raise HTTPException(status_code=404, detail="Cafe not found")
     
-    if isinstance(cafe_doc['created_at'], str):
-        cafe_doc['created_at'] = datetime.fromisoformat(cafe_doc['created_at'])
-    
-    return Cafe(**cafe_doc)
+    return DocumentResponse(cafe_doc, headers=cache_headers(etag))
 
 # ==================== DEVICE ROUTES ====================
 
+async def check_cafe_access(current_user: dict, cafe_id: str):
+    """Owners manage their own cafes, staff the cafe they are assigned to"""
+    if current_user['role'] == 'SUPER_ADMIN':
+        return
+    if current_user['role'] == 'CAFE_OWNER':
+        if await db.cafes.find_one({"id": cafe_id, "owner_id": current_user['user_id']}, {"_id": 0, "id": 1}):
+            return
+    elif current_user['role'] == 'STAFF':
+        user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0, "cafe_id": 1})
+        if user_doc and user_doc.get('cafe_id') == cafe_id:
+            return
+    raise HTTPException(status_code=403, detail="Not allowed to manage this cafe")
+
+async def resolve_device_cafe(current_user: dict) -> str:
+    """The cafe new devices go to: the user's own, or a cafe owner's first cafe"""
+    user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0})
+    if user_doc and user_doc.get('cafe_id'):
+        return user_doc['cafe_id']
+    # If cafe owner, get their first cafe
+    if current_user['role'] == 'CAFE_OWNER':
+        cafe_doc = await db.cafes.find_one({"owner_id": current_user['user_id']}, {"_id": 0})
+        if cafe_doc:
+            return cafe_doc['id']
+        raise HTTPException(status_code=400, detail="No cafe found")
+    raise HTTPException(status_code=400, detail="User not assigned to any cafe")
+
 @api_router.post("/devices", response_model=Device)
 async def create_device(device_data: DeviceCreate, current_user: dict = Depends(get_current_user)):
     """Create new device"""
-    # Get user's cafe
-    user_doc = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0})
-    if not user_doc or not user_doc.get('cafe_id'):
-        # If cafe owner, get their first cafe
-        if current_user['role'] == 'CAFE_OWNER':
-            cafe_doc = await db.cafes.find_one({"owner_id": current_user['user_id']}, {"_id": 0})
-            if cafe_doc:
-                cafe_id = cafe_doc['id']
-            else:
-                raise HTTPException(status_code=400, detail="No cafe found")
-        else:
-            raise HTTPException(status_code=400, detail="User not assigned to any cafe")
-    else:
-        cafe_id = user_doc['cafe_id']
+    cafe_id = await resolve_device_cafe(current_user)
     
     device = Device(**device_data.model_dump(), cafe_id=cafe_id)
     doc = device.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.devices.insert_one(doc)
+    availability_index.put_device(doc)
     
     return device
 
-@api_router.get("/devices", response_model=List[Device])
-async def list_devices(cafe_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+@api_router.get("/devices", response_model=List[partial_model(Device)])
+async def list_devices(
+    cafe_id: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """List devices"""
     query = {}
     
@@ -226,13 +291,11 @@ async def list_devices(cafe_id: Optional[str] = None, current_user: dict = Depen
         if user_doc and user_doc.get('cafe_id'):
             query = {"cafe_id": user_doc['cafe_id']}
     
-    devices = await db.devices.find(query, {"_id": 0}).limit(100).to_list(100)
-    
-    for device in devices:
-        if isinstance(device['created_at'], str):
-            device['created_at'] = datetime.fromisoformat(device['created_at'])
+    devices, next_cursor = await paginate(
+        db.devices, query, limit=limit, cursor=cursor, projection=field_projection(Device, fields)
+    )
     
-    return devices
+    return paginated_response(devices, next_cursor)
 
 @api_router.patch("/devices/{device_id}/status")
 async def update_device_status(
@@ -241,16 +304,125 @@ async def update_device_status(
     current_user: dict = Depends(get_current_user)
 ):
     """Update device status"""
-    result = await db.devices.update_one(
+    device_doc = await db.devices.find_one_and_update(
         {"id": device_id},
-        {"$set": {"status": status_data.status.value}}
+        {"$set": {"status": status_data.status.value}},
+        projection={"_id": 0, "cafe_id": 1}
     )
     
-    if result.matched_count == 0:
+    if device_doc is None:
         raise HTTPException(status_code=404, detail="Device not found")
     
+    status_hub.publish_device_status(device_doc['cafe_id'], device_id, status_data.status.value)
+    availability_index.set_status(device_id, status_data.status.value)
+    if status_data.status == DeviceStatus.AVAILABLE:
+        await waitlist.hand_off(db, device_id)
+    
     return {"message": "Device status updated", "status": status_data.status.value}
 
+@api_router.get("/devices/availability")
+async def search_available_devices(
+    cafe_id: str,
+    device_type: DeviceType,
+    start: Optional[datetime] = Query(None, description="Defaults to now; naive times are cafe-local"),
+    hours: float = Query(1.0, gt=0, le=24),
+    current_user: dict = Depends(get_current_user)
+):
+    """Devices of a type that are free for ``hours`` from ``start``"""
+    if start is None:
+        start = datetime.now(timezone.utc)
+    elif start.tzinfo is None:
+        start = start.replace(tzinfo=CAFE_TIMEZONE)
+    end = start + timedelta(hours=hours)
+    
+    await reservation_book.refresh(db, cafe_id)
+    free = await availability_index.search(db, cafe_id, device_type.value, start.timestamp(), end.timestamp())
+    return DocumentResponse({
+        "cafe_id": cafe_id,
+        "device_type": device_type.value,
+        "start": start,
+        "end": end,
+        "devices": sorted((entry.view() for entry in free), key=lambda device: device['name'] or device['id'])
+    })
+
+async def import_devices(rows, cafe_id: Optional[str], current_user: dict) -> dict:
+    if cafe_id:
+        await check_cafe_access(current_user, cafe_id)
+    else:
+        cafe_id = await resolve_device_cafe(current_user)
+    
+    existing = await db.devices.find({"cafe_id": cafe_id}, {"_id": 0, "name": 1}).to_list(None)
+    docs, results = validate_devices(rows, cafe_id, {device['name'].strip().casefold() for device in existing})
+    failed = sum(1 for result in results if result['errors'])
+    if failed:
+        # Nothing is written until the whole sheet is valid
+        raise HTTPException(status_code=422, detail={
+            "message": f"{failed} of {len(results)} rows are invalid; no devices were created",
+            "results": results
+        })
+    
+    await db.devices.insert_many(docs, ordered=False)
+    for doc in docs:
+        availability_index.put_device(doc)
+    return {"cafe_id": cafe_id, "created": len(docs), "results": results}
+
+@api_router.post("/devices/bulk", status_code=201)
+async def create_devices_bulk(
+    devices: List[Any] = Body(..., description="Objects shaped like DeviceCreate"),
+    cafe_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create many devices at once; rows are reported by their 0-based index"""
+    return await import_devices(enumerate(devices), cafe_id, current_user)
+
+@api_router.post("/devices/bulk/csv", status_code=201)
+async def import_devices_csv(
+    file: UploadFile = File(..., description="Header line plus name,device_type,hourly_rate[,specifications]"),
+    cafe_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create devices from a CSV upload; rows are reported by line number"""
+    return await import_devices(csv_rows(await file.read()), cafe_id, current_user)
+
+@api_router.post("/devices/bulk/status")
+async def update_device_status_bulk(update: DeviceBulkStatusUpdate, current_user: dict = Depends(get_current_user)):
+    """Set the status of many devices in a cafe; devices with a session running are left alone"""
+    await check_cafe_access(current_user, update.cafe_id)
+    status = update.status.value
+    
+    query: Dict[str, Any] = {"cafe_id": update.cafe_id}
+    if update.device_ids is not None:
+        query["id"] = {"$in": update.device_ids}
+    devices = await db.devices.find(query, {"_id": 0, "id": 1, "status": 1}).to_list(None)
+    current = {device['id']: device['status'] for device in devices}
+    
+    results = []
+    for device_id in update.device_ids if update.device_ids is not None else current:
+        if device_id not in current:
+            results.append({"device_id": device_id, "result": "not_found"})
+        elif current[device_id] == status:
+            results.append({"device_id": device_id, "result": "unchanged"})
+        elif current[device_id] == DeviceStatus.OCCUPIED.value:
+            results.append({"device_id": device_id, "result": "occupied"})
+        else:
+            results.append({"device_id": device_id, "result": "updated"})
+    
+    changed = [result['device_id'] for result in results if result['result'] == "updated"]
+    if changed:
+        # The status condition keeps a session started meanwhile from losing its device
+        await db.devices.update_many(
+            {"id": {"$in": changed}, "status": {"$ne": DeviceStatus.OCCUPIED.value}},
+            {"$set": {"status": status}}
+        )
+        for device_id in changed:
+            availability_index.set_status(device_id, status)
+            status_hub.publish_device_status(update.cafe_id, device_id, status)
+        if update.status == DeviceStatus.AVAILABLE:
+            for device_id in changed:
+                await waitlist.hand_off(db, device_id)
+    
+    return {"status": status, "updated": len(changed), "results": results}
+
 # ==================== SESSION/BOOKING ROUTES ====================
 
 @api_router.post("/sessions", response_model=Session)
@@ -264,25 +436,16 @@ async def create_session(session_data: SessionCreate, current_user: dict = Depen
     if device_doc['status'] != DeviceStatus.AVAILABLE.value:
         raise HTTPException(status_code=400, detail="Device not available")
     
-    # Create session
-    session = Session(
-        customer_id=session_data.customer_id,
-        device_id=session_data.device_id,
-        cafe_id=device_doc['cafe_id'],
-        start_time=datetime.now(timezone.utc)
-    )
-    
-    doc = session.model_dump()
-    doc['start_time'] = doc['start_time'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.sessions.insert_one(doc)
-    
-    # Update device status
-    await db.devices.update_one(
-        {"id": session_data.device_id},
-        {"$set": {"status": DeviceStatus.OCCUPIED.value}}
-    )
+    # Walk-ins have no end, so they cannot take a device reserved within the next
+    # OPEN_SESSION_CLEARANCE; one that runs longer still blocks that check-in (409)
+    now = datetime.now(timezone.utc).timestamp()
+    await reservation_book.refresh(db, device_doc['cafe_id'])
+    if reservation_book.conflict(device_doc['id'], now, reservations.open_session_horizon(now)):
+        raise HTTPException(status_code=409, detail="Device is reserved")
     
+    session = await open_session(db, device_doc, session_data.customer_id)
+    if session is None:
+        raise HTTPException(status_code=400, detail="Device not available")
     return session
 
 @api_router.post("/sessions/{session_id}/end")
@@ -291,6 +454,9 @@ async def end_session(session_id: str, current_user: dict = Depends(get_current_
     session_doc = await db.sessions.find_one({"id": session_id}, {"_id": 0})
     if not session_doc:
         raise HTTPException(status_code=404, detail="Session not found")
+    open_statuses = [SessionStatus.ACTIVE.value, SessionStatus.EXTENDED.value]
+    if session_doc['status'] not in open_statuses:
+        raise HTTPException(status_code=409, detail="Session already ended")
     
     # Calculate duration and amount
     if isinstance(session_doc['start_time'], str):
@@ -301,15 +467,20 @@ async def end_session(session_id: str, current_user: dict = Depends(get_current_
     end_time = datetime.now(timezone.utc)
     duration_hours = (end_time - start_time).total_seconds() / 3600
     
-    # Get device rate
-    device_doc = await db.devices.find_one({"id": session_doc['device_id']}, {"_id": 0})
-    hourly_rate = device_doc['hourly_rate'] if device_doc else 100
+    # Sessions keep the rate they started at; older ones fall back to the device's
+    hourly_rate = session_doc.get('hourly_rate')
+    if hourly_rate is None:
+        device_doc = await db.devices.find_one({"id": session_doc['device_id']}, {"_id": 0})
+        hourly_rate = device_doc['hourly_rate'] if device_doc else 100
     
-    total_amount = duration_hours * hourly_rate
+    # Same formula as the live meter: time priced by the cafe's rules (at least the prepaid extensions), then the coupon
+    timeline = await pricing_engine.timeline(db, session_doc['cafe_id'])
+    billing_meter.set_timeline(session_doc['cafe_id'], timeline)
+    total_amount = ActiveSession.from_document(session_doc, hourly_rate).total(end_time.timestamp(), timeline)
     
-    # Update session
-    await db.sessions.update_one(
-        {"id": session_id},
+    # Only one of several concurrent ends gets to close the session
+    ended = await db.sessions.update_one(
+        {"id": session_id, "status": {"$in": open_statuses}},
         {"$set": {
             "end_time": end_time.isoformat(),
             "duration_hours": duration_hours,
@@ -317,21 +488,97 @@ async def end_session(session_id: str, current_user: dict = Depends(get_current_
             "status": SessionStatus.COMPLETED.value
         }}
     )
-    
-    # Free up device
-    await db.devices.update_one(
-        {"id": session_doc['device_id']},
-        {"$set": {"status": DeviceStatus.AVAILABLE.value}}
+    if not ended.matched_count:
+        raise HTTPException(status_code=409, detail="Session already ended")
+    billing_meter.close(session_id)
+    availability_index.apply_session({**session_doc, "status": SessionStatus.COMPLETED.value})
+    if session_doc.get('reservation_id'):
+        await reservations.complete(db, session_doc['reservation_id'], end_time)
+    status_hub.publish_session_status(
+        session_doc['cafe_id'], session_id, session_doc['device_id'], SessionStatus.COMPLETED.value
     )
     
+    # Straight to the next waiter, if any; otherwise free up the device
+    if await waitlist.hand_off(db, session_doc['device_id'], session_id) is None:
+        await release_device(db, session_doc['cafe_id'], session_doc['device_id'], session_id)
+    
     return {
         "message": "Session ended",
         "duration_hours": round(duration_hours, 2),
         "total_amount": round(total_amount, 2)
     }
 
-@api_router.get("/sessions", response_model=List[Session])
-async def list_sessions(cafe_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+@api_router.post("/cafes/{cafe_id}/sessions/end-all")
+async def end_all_sessions(cafe_id: str, current_user: dict = Depends(get_current_user)):
+    """Closing time: end every open session in the cafe and clear its waitlist"""
+    await check_cafe_access(current_user, cafe_id)
+    
+    open_statuses = [SessionStatus.ACTIVE.value, SessionStatus.EXTENDED.value]
+    session_docs = await db.sessions.find({"cafe_id": cafe_id, "status": {"$in": open_statuses}}, {"_id": 0}).to_list(None)
+    end_time = datetime.now(timezone.utc)
+    
+    # One timeline and one device lookup for the whole floor
+    timeline = await pricing_engine.timeline(db, cafe_id)
+    billing_meter.set_timeline(cafe_id, timeline)
+    missing_rate = [doc['device_id'] for doc in session_docs if doc.get('hourly_rate') is None]
+    device_rates = {
+        device['id']: device['hourly_rate']
+        async for device in db.devices.find({"id": {"$in": missing_rate}}, {"_id": 0, "id": 1, "hourly_rate": 1})
+    } if missing_rate else {}
+    
+    results = []
+    for doc in session_docs:
+        start_time = datetime.fromisoformat(doc['start_time']) if isinstance(doc['start_time'], str) else doc['start_time']
+        duration_hours = (end_time - start_time).total_seconds() / 3600
+        hourly_rate = doc.get('hourly_rate') or device_rates.get(doc['device_id'], 100)
+        total_amount = ActiveSession.from_document(doc, hourly_rate).total(end_time.timestamp(), timeline)
+        # Skip sessions a concurrent /end closed after the read above
+        ended = await db.sessions.find_one_and_update(
+            {"id": doc['id'], "status": {"$in": open_statuses}},
+            {"$set": {
+                "end_time": end_time.isoformat(),
+                "duration_hours": duration_hours,
+                "total_amount": total_amount,
+                "status": SessionStatus.COMPLETED.value
+            }},
+            projection={"_id": 0, "id": 1}
+        )
+        if ended is None:
+            continue
+        billing_meter.close(doc['id'])
+        availability_index.apply_session({**doc, "status": SessionStatus.COMPLETED.value})
+        if doc.get('reservation_id'):
+            await reservations.complete(db, doc['reservation_id'], end_time)
+        status_hub.publish_session_status(cafe_id, doc['id'], doc['device_id'], SessionStatus.COMPLETED.value)
+        await release_device(db, cafe_id, doc['device_id'], doc['id'])
+        results.append({
+            "session_id": doc['id'],
+            "device_id": doc['device_id'],
+            "customer_id": doc['customer_id'],
+            "duration_hours": round(duration_hours, 2),
+            "total_amount": round(total_amount, 2)
+        })
+    
+    cleared = await db.waitlist.update_many(
+        {"cafe_id": cafe_id, "status": WaitlistStatus.WAITING.value},
+        {"$set": {"status": WaitlistStatus.CANCELLED.value}}
+    )
+    
+    return {
+        "ended": len(results),
+        "total_amount": round(sum(result['total_amount'] for result in results), 2),
+        "waitlist_cleared": cleared.modified_count,
+        "sessions": results
+    }
+
+@api_router.get("/sessions", response_model=List[partial_model(Session)])
+async def list_sessions(
+    cafe_id: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """List sessions"""
     query = {}
     
@@ -344,17 +591,90 @@ async def list_sessions(cafe_id: Optional[str] = None, current_user: dict = Depe
         cafe_ids = [c['id'] for c in cafes]
         query = {"cafe_id": {"$in": cafe_ids}}
     
-    sessions = await db.sessions.find(query, {"_id": 0}).sort("created_at", -1).limit(50).to_list(50)
+    sessions, next_cursor = await paginate(
+        db.sessions, query, limit=limit, cursor=cursor, projection=field_projection(Session, fields)
+    )
     
-    for session in sessions:
-        if isinstance(session['start_time'], str):
-            session['start_time'] = datetime.fromisoformat(session['start_time'])
-        if session.get('end_time') and isinstance(session['end_time'], str):
-            session['end_time'] = datetime.fromisoformat(session['end_time'])
-        if isinstance(session['created_at'], str):
-            session['created_at'] = datetime.fromisoformat(session['created_at'])
+    return paginated_response(sessions, next_cursor)
+
+# ==================== RESERVATION ROUTES ====================
+
+def check_reservation_access(current_user: dict, reservation_doc: dict):
+    if current_user['role'] == 'CUSTOMER' and reservation_doc['customer_id'] != current_user['user_id']:
+        raise HTTPException(status_code=403, detail="Not your reservation")
+
+@api_router.post("/reservations", response_model=Reservation)
+async def create_reservation(reservation_data: ReservationCreate, current_user: dict = Depends(get_current_user)):
+    """Reserve a device for a future slot"""
+    device_doc = await db.devices.find_one({"id": reservation_data.device_id}, {"_id": 0})
+    if not device_doc:
+        raise HTTPException(status_code=404, detail="Device not found")
     
-    return sessions
+    customer_id = current_user['user_id']
+    if reservation_data.customer_id and current_user['role'] != 'CUSTOMER':
+        customer_id = reservation_data.customer_id
+    
+    start = reservation_data.start_time
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=CAFE_TIMEZONE)
+    end = start + timedelta(hours=reservation_data.duration_hours)
+    return await reservations.book(db, device_doc, customer_id, start, end)
+
+@api_router.get("/reservations", response_model=List[Reservation])
+async def list_reservations(
+    cafe_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """List reservations, latest start first"""
+    if current_user['role'] == 'CUSTOMER':
+        query = {"customer_id": current_user['user_id']}
+    elif cafe_id:
+        query = {"cafe_id": cafe_id}
+    elif current_user['role'] == 'CAFE_OWNER':
+        cafes = await db.cafes.find({"owner_id": current_user['user_id']}, {"_id": 0, "id": 1}).limit(100).to_list(100)
+        query = {"cafe_id": {"$in": [c['id'] for c in cafes]}}
+    else:
+        query = {}
+    
+    items, next_cursor = await paginate(db.reservations, query, sort_field="start_time", limit=limit, cursor=cursor)
+    return paginated_response(items, next_cursor)
+
+@api_router.post("/reservations/{reservation_id}/cancel", response_model=Reservation)
+async def cancel_reservation(reservation_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancel a confirmed reservation and free its slots"""
+    reservation_doc = await db.reservations.find_one({"id": reservation_id}, {"_id": 0})
+    if not reservation_doc:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    check_reservation_access(current_user, reservation_doc)
+    
+    return await reservations.cancel(db, reservation_id)
+
+@api_router.post("/reservations/{reservation_id}/check-in", response_model=Session)
+async def check_in_reservation(reservation_id: str, current_user: dict = Depends(get_current_user)):
+    """Turn a reservation into an active session on its device"""
+    reservation_doc = await db.reservations.find_one({"id": reservation_id}, {"_id": 0})
+    if not reservation_doc:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    check_reservation_access(current_user, reservation_doc)
+    reservations.check_in_window(reservation_doc, datetime.now(timezone.utc))
+    
+    device_doc = await db.devices.find_one({"id": reservation_doc['device_id']}, {"_id": 0})
+    if not device_doc:
+        raise HTTPException(status_code=404, detail="Device not found")
+    if device_doc['status'] != DeviceStatus.AVAILABLE.value:
+        raise HTTPException(status_code=409, detail="Device is still in use")
+    
+    claimed = await reservations.claim_check_in(db, reservation_id)
+    # open_session claims the device only if it is still AVAILABLE; a walk-in
+    # or hand-off may have taken it since the read above
+    session = await open_session(db, device_doc, reservation_doc['customer_id'], reservation_id=reservation_id)
+    if session is None:
+        await reservations.undo_check_in(db, claimed)
+        raise HTTPException(status_code=409, detail="Device is still in use")
+    await reservations.attach_session(db, claimed, session.id)
+    return session
 
 # ==================== AI AGENT ROUTES ====================
 
@@ -400,6 +720,10 @@ async def ai_chat(message_data: AIMessage, current_user: dict = Depends(get_curr
         'month_revenue': today_revenue * 10,  # Mock for now
         'avg_utilization': (active_sessions_count / total_devices * 100) if total_devices else 0
     }
+    if message_data.agent_type == "DEVICE_OPTIMIZATION":
+        context['at_risk_devices'] = await top_risks(db, cafe_id)
+    elif message_data.agent_type == "RISK_FRAUD":
+        context['noshow_rate'] = await reservations.noshow_rate(db, cafe_id)
     
     # Route to appropriate AI agent
     session_id = f"{current_user['user_id']}_chat"
@@ -543,15 +867,22 @@ create_extended_routes(db, api_router)
 # Add advanced routes
 create_advanced_routes(db, api_router)
 
+# Add live status and billing feeds
+create_realtime_routes(db, api_router)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Retried money-moving POSTs replay their first response; see idempotency.py
+app.add_middleware(IdempotencyMiddleware, db=db)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, REPLAYED_HEADER],
 )
 
 # Configure logging
@@ -561,6 +892,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await ensure_indexes(db)
+
+@app.on_event("startup")
+async def start_live_state():
+    await billing_meter.rebuild(db)
+    for cafe_id in billing_meter.cafe_ids():
+        billing_meter.set_timeline(cafe_id, await pricing_engine.timeline(db, cafe_id))
+    await availability_index.rebuild(db)
+    await reservation_book.rebuild(db)
+    change_feed.add_session_listener(billing_meter.apply_document)
+    change_feed.add_session_listener(availability_index.apply_session)
+    change_feed.add_device_listener(availability_index.put_device)
+    change_feed.start(db)
+    health_writer.add_flush_listener(apply_readings)
+    await migrate_legacy_readings(db, health_writer)
+    health_writer.start(db)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await change_feed.stop(db)
+    await health_writer.stop(db)
+    await invoice_pdfs.stop()
     client.close()
@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from models import DeviceStatus, Session
+from availability import availability_index
+from billing_meter import ActiveSession, billing_meter
+from pricing_engine import pricing_engine
+from realtime import status_hub
+
+def held_by(session_id: str) -> Dict:
+    """Device filter matching only while ``session_id`` holds the device.
+
+    Devices taken before ``current_session_id`` was recorded carry none and
+    match any session.
+    """
+    return {"status": DeviceStatus.OCCUPIED.value, "current_session_id": {"$in": [session_id, None]}}
+
+async def open_session(
+    db, device_doc: Dict, customer_id: str, reservation_id: Optional[str] = None,
+    waitlist_id: Optional[str] = None, expected: Optional[Dict] = None
+) -> Optional[Session]:
+    """Start a session on ``device_doc``, or None if the device could not be claimed.
+
+    The device is claimed with one conditional update from ``expected``
+    (AVAILABLE by default; ``held_by(ended_session)`` when handing it over
+    from a session that just ended) to OCCUPIED by the new session, so of
+    several callers racing for a device exactly one opens a session on it.
+    """
+    session = Session(
+        customer_id=customer_id,
+        device_id=device_doc['id'],
+        cafe_id=device_doc['cafe_id'],
+        start_time=datetime.now(timezone.utc),
+        hourly_rate=device_doc['hourly_rate'],
+        reservation_id=reservation_id,
+        waitlist_id=waitlist_id
+    )
+    claimed = await db.devices.update_one(
+        {"id": session.device_id, **(expected or {"status": DeviceStatus.AVAILABLE.value})},
+        {"$set": {"status": DeviceStatus.OCCUPIED.value, "current_session_id": session.id}}
+    )
+    if not claimed.matched_count:
+        return None
+    
+    doc = session.model_dump()
+    doc['start_time'] = doc['start_time'].isoformat()
+    doc['created_at'] = doc['created_at'].isoformat()
+    try:
+        await db.sessions.insert_one(doc)
+    except Exception:
+        await release_device(db, session.cafe_id, session.device_id, session.id, publish=False)
+        raise
+    availability_index.apply_session(doc)
+    billing_meter.set_timeline(session.cafe_id, await pricing_engine.timeline(db, session.cafe_id))
+    billing_meter.open(ActiveSession.from_document(doc))
+    
+    availability_index.set_status(session.device_id, DeviceStatus.OCCUPIED.value)
+    status_hub.publish_device_status(session.cafe_id, session.device_id, DeviceStatus.OCCUPIED.value, session.id)
+    status_hub.publish_session_status(session.cafe_id, session.id, session.device_id, session.status.value)
+    
+    return session
+
+async def release_device(db, cafe_id: str, device_id: str, session_id: str, publish: bool = True) -> bool:
+    """Free a device if ``session_id`` still holds it; False if someone else has it now"""
+    released = await db.devices.update_one(
+        {"id": device_id, **held_by(session_id)},
+        {"$set": {"status": DeviceStatus.AVAILABLE.value, "current_session_id": None}}
+    )
+    if not released.matched_count:
+        return False
+    availability_index.set_status(device_id, DeviceStatus.AVAILABLE.value)
+    if publish:
+        status_hub.publish_device_status(cafe_id, device_id, DeviceStatus.AVAILABLE.value, session_id)
+    return True
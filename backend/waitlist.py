@@ -0,0 +1,217 @@
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+import heapq
+import os
+import time
+
+import numpy as np
+
+from availability import availability_index
+from billing_meter import billing_meter
+from models import DeviceStatus, Session, SessionStatus
+from models_extended import MembershipTier, WaitlistEntry, WaitlistStatus
+from reservations import open_session_horizon, reservation_book
+from sessions import held_by, open_session
+
+# Lower is served first; within a tier, first come first served
+TIER_PRIORITY = {
+    MembershipTier.PLATINUM.value: 0,
+    MembershipTier.GOLD.value: 1,
+    MembershipTier.SILVER.value: 2,
+    MembershipTier.BRONZE.value: 3,
+}
+QUEUE_ORDER = [("priority", 1), ("joined_at", 1), ("id", 1)]
+DEFAULT_SESSION_HOURS = float(os.environ.get('WAITLIST_DEFAULT_SESSION_HOURS', '1'))
+TYPICAL_SESSION_DAYS = 30
+TYPICAL_SESSION_TTL_SECONDS = 600.0
+# A session already past its expected end is assumed to finish this soon
+MIN_REMAINING_SECONDS = 300.0
+
+_typical_seconds: Dict[Tuple[str, str], Tuple[float, float]] = {}
+
+async def typical_session_seconds(db, cafe_id: str, device_type: str) -> float:
+    """Median length of recent completed sessions on a cafe's devices of one type (cached)"""
+    key = (cafe_id, device_type)
+    cached = _typical_seconds.get(key)
+    if cached and time.monotonic() - cached[1] < TYPICAL_SESSION_TTL_SECONDS:
+        return cached[0]
+    since = (datetime.now(timezone.utc) - timedelta(days=TYPICAL_SESSION_DAYS)).isoformat()
+    docs = await db.sessions.find({
+        "device_id": {"$in": [device.id for device in availability_index.devices_of(cafe_id, device_type)]},
+        "status": SessionStatus.COMPLETED.value,
+        "created_at": {"$gte": since}
+    }, {"_id": 0, "duration_hours": 1}).sort("created_at", -1).limit(5000).to_list(5000)
+    hours = [doc['duration_hours'] for doc in docs if doc.get('duration_hours')]
+    seconds = float(np.median(hours)) * 3600 if hours else DEFAULT_SESSION_HOURS * 3600
+    _typical_seconds[key] = (seconds, time.monotonic())
+    return seconds
+
+def free_times(cafe_id: str, device_type: str, now: float, typical: float) -> List[float]:
+    """When each in-service device of a type is expected to come free.
+
+    An open session is expected to run ``typical`` seconds plus whatever
+    extensions were bought (read off its extension charges), and never to
+    end sooner than ``MIN_REMAINING_SECONDS`` from now.
+    """
+    sessions = {entry.device_id: entry for entry in billing_meter.cafe_sessions(cafe_id)}
+    times = []
+    for device in availability_index.devices_of(cafe_id, device_type):
+        if device.status == DeviceStatus.MAINTENANCE.value:
+            continue
+        session = sessions.get(device.id)
+        if session is None:
+            times.append(now if device.status == DeviceStatus.AVAILABLE.value else now + typical)
+            continue
+        extended = session.prepaid / session.hourly_rate * 3600 if session.hourly_rate else 0.0
+        times.append(max(session.started_at + typical + extended, now + MIN_REMAINING_SECONDS))
+    return times
+
+def estimate_waits(free_at: List[float], positions: int, now: float, typical: float) -> List[float]:
+    """Seconds until each of the first ``positions`` waiters gets a device.
+
+    Replays the hand-offs on a heap of device free times: the next waiter
+    takes whichever device frees up first and keeps it for ``typical``.
+    Empty when no device of the type is in service.
+    """
+    heap = list(free_at)
+    heapq.heapify(heap)
+    waits = []
+    while heap and len(waits) < positions:
+        free = max(heapq.heappop(heap), now)
+        waits.append(free - now)
+        heapq.heappush(heap, free + typical)
+    return waits
+
+async def _estimates(db, cafe_id: str, device_type: str, positions: int) -> List[Optional[float]]:
+    """Estimated wait in minutes for queue positions 1..``positions``"""
+    now = time.time()
+    typical = await typical_session_seconds(db, cafe_id, device_type)
+    waits = estimate_waits(free_times(cafe_id, device_type, now, typical), positions, now, typical)
+    return [round(wait / 60, 1) for wait in waits] + [None] * (positions - len(waits))
+
+def _ahead_of(doc: Dict) -> Dict:
+    """Query for the waiting entries served before ``doc``"""
+    return {
+        "cafe_id": doc['cafe_id'],
+        "device_type": doc['device_type'],
+        "status": WaitlistStatus.WAITING.value,
+        "$or": [
+            {"priority": {"$lt": doc['priority']}},
+            {"priority": doc['priority'], "joined_at": {"$lt": doc['joined_at']}},
+            {"priority": doc['priority'], "joined_at": doc['joined_at'], "id": {"$lt": doc['id']}}
+        ]
+    }
+
+async def entry_view(db, doc: Dict) -> Dict:
+    """A stored entry with its queue position and wait estimate, while it is waiting"""
+    doc = {**doc, "position": None, "estimated_wait_minutes": None}
+    if doc['status'] == WaitlistStatus.WAITING.value:
+        doc['position'] = await db.waitlist.count_documents(_ahead_of(doc)) + 1
+        doc['estimated_wait_minutes'] = (await _estimates(db, doc['cafe_id'], doc['device_type'], doc['position']))[-1]
+    return doc
+
+async def queue(db, cafe_id: str, device_type: str, limit: int) -> List[Dict]:
+    """The first ``limit`` waiting entries in serving order, with estimates"""
+    docs = await db.waitlist.find(
+        {"cafe_id": cafe_id, "device_type": device_type, "status": WaitlistStatus.WAITING.value}, {"_id": 0}
+    ).sort(QUEUE_ORDER).limit(limit).to_list(limit)
+    estimates = await _estimates(db, cafe_id, device_type, len(docs))
+    return [
+        {**doc, "position": position, "estimated_wait_minutes": estimate}
+        for position, (doc, estimate) in enumerate(zip(docs, estimates), start=1)
+    ]
+
+async def join(db, cafe_id: str, device_type: str, customer_id: str) -> Dict:
+    """Queue ``customer_id`` for the next free device of a type; served at once if one is free"""
+    if not availability_index.devices_of(cafe_id, device_type):
+        raise HTTPException(status_code=404, detail="No devices of this type in this cafe")
+    membership = await db.memberships.find_one({"customer_id": customer_id}, {"_id": 0, "tier": 1})
+    tier = (membership or {}).get('tier') or MembershipTier.BRONZE.value
+
+    entry = WaitlistEntry(
+        cafe_id=cafe_id, device_type=device_type, customer_id=customer_id,
+        tier=tier, priority=TIER_PRIORITY[tier]
+    )
+    doc = entry.model_dump(exclude={'position', 'estimated_wait_minutes'})
+    doc['joined_at'] = doc['joined_at'].isoformat()
+    try:
+        await db.waitlist.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Already on the waitlist for this device type")
+    doc.pop('_id', None)
+
+    await drain(db, cafe_id, device_type)
+    return await entry_view(db, await db.waitlist.find_one({"id": doc['id']}, {"_id": 0}))
+
+async def cancel(db, entry_id: str) -> Dict:
+    doc = await db.waitlist.find_one_and_update(
+        {"id": entry_id, "status": WaitlistStatus.WAITING.value},
+        {"$set": {"status": WaitlistStatus.CANCELLED.value}},
+        projection={"_id": 0}
+    )
+    if doc is None:
+        raise HTTPException(status_code=409, detail="Only waiting entries can be cancelled")
+    return await entry_view(db, {**doc, "status": WaitlistStatus.CANCELLED.value})
+
+async def _offer(db, device_id: str, ended_session_id: Optional[str]) -> Tuple[Optional[Session], bool]:
+    """(session opened, whether the queue turned out empty)"""
+    device_doc = await db.devices.find_one({"id": device_id}, {"_id": 0})
+    expected_status = DeviceStatus.OCCUPIED.value if ended_session_id else DeviceStatus.AVAILABLE.value
+    if not device_doc or device_doc['status'] != expected_status:
+        return None, False
+    now = datetime.now(timezone.utc)
+    await reservation_book.refresh(db, device_doc['cafe_id'])
+    if reservation_book.conflict(device_id, now.timestamp(), open_session_horizon(now.timestamp())):
+        return None, False
+
+    entry = await db.waitlist.find_one_and_update(
+        {"cafe_id": device_doc['cafe_id'], "device_type": device_doc['device_type'], "status": WaitlistStatus.WAITING.value},
+        {"$set": {"status": WaitlistStatus.ASSIGNED.value, "device_id": device_id, "assigned_at": now.isoformat()}},
+        sort=QUEUE_ORDER,
+        projection={"_id": 0}
+    )
+    if entry is None:
+        return None, True
+    session = await open_session(
+        db, device_doc, entry['customer_id'], waitlist_id=entry['id'],
+        expected=held_by(ended_session_id) if ended_session_id else None
+    )
+    if session is None:
+        await db.waitlist.update_one(
+            {"id": entry['id']},
+            {"$set": {"status": WaitlistStatus.WAITING.value, "device_id": None, "assigned_at": None}}
+        )
+        return None, False
+    await db.waitlist.update_one({"id": entry['id']}, {"$set": {"session_id": session.id}})
+    return session, False
+
+async def hand_off(db, device_id: str, ended_session_id: Optional[str] = None) -> Optional[Session]:
+    """Give a device that just came free to the first waiter in its queue.
+
+    Pass ``ended_session_id`` when the device is being handed straight over
+    from a session that just ended (it is still OCCUPIED); otherwise the
+    device must be AVAILABLE. The waiter is popped with one sorted
+    conditional update, and ``open_session`` claims the device with a
+    conditional update on that state, so each waiter gets one device and
+    each device one session even with several workers at once. If the
+    device was taken in between, the waiter goes back to the queue in the
+    same place. Devices with a reservation starting within
+    ``OPEN_SESSION_CLEARANCE`` are not handed off, as the session has no end.
+    A session that runs past it still blocks that check-in.
+    """
+    session, _ = await _offer(db, device_id, ended_session_id)
+    return session
+
+async def drain(db, cafe_id: str, device_type: str) -> List[Session]:
+    """Hand every free device of a type to waiters, until the devices or the queue run out"""
+    now = time.time()
+    sessions = []
+    for device in availability_index.free_devices(cafe_id, device_type, now, open_session_horizon(now)):
+        session, queue_empty = await _offer(db, device.id, None)
+        if queue_empty:
+            break
+        if session is not None:
+            sessions.append(session)
+    return sessions
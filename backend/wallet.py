@@ -0,0 +1,371 @@
+from fastapi import HTTPException
+from pymongo import ReplaceOne, UpdateOne
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Contra accounts: where the other side of each wallet movement is booked
+RECHARGES = "cash:recharges"
+PASS_SALES = "revenue:passes"
+REFERRAL_REWARDS = "promotions:referrals"
+NO_SHOW_PENALTIES = "revenue:no_show_penalties"
+
+WALLET_ACCOUNT = "wallet"
+PENDING, POSTED, FAILED = "pending", "posted", "failed"
+# A posting still pending after this long was interrupted; recovery settles it
+STALE_PENDING_AFTER = timedelta(minutes=5)
+RECONCILE_BATCH_SIZE = 1000
+CHECKPOINT_BATCH_SIZE = 1000
+CHECKPOINT_WATERMARK_ID = "__watermark__"
+BALANCE_TOLERANCE = 0.005
+
+class Posting:
+    """One wallet movement: ``amount`` in (credit) or out (debit) of a customer's wallet.
+
+    It is booked as two ledger legs in ``wallet_transactions`` that sum to
+    zero: the customer's wallet leg, shaped like the entries the history
+    endpoint has always returned, and a contra leg on ``contra_account``.
+    """
+    __slots__ = (
+        'id', 'customer_id', 'amount', 'transaction_type', 'description',
+        'contra_account', 'reference_id', 'allow_overdraft', 'created_at'
+    )
+
+    def __init__(
+        self,
+        customer_id: str,
+        amount: float,
+        transaction_type: str,
+        description: str,
+        contra_account: str,
+        reference_id: Optional[str] = None,
+        allow_overdraft: bool = False
+    ):
+        self.id = str(uuid.uuid4())
+        self.customer_id = customer_id
+        self.amount = amount
+        self.transaction_type = transaction_type
+        self.description = description
+        self.contra_account = contra_account
+        self.reference_id = reference_id
+        self.allow_overdraft = allow_overdraft
+        self.created_at = datetime.now(timezone.utc).isoformat()
+
+    def legs(self) -> List[Dict]:
+        common = {
+            "posting_id": self.id,
+            "transaction_type": self.transaction_type,
+            "description": self.description,
+            "reference_id": self.reference_id,
+            "state": PENDING,
+            "created_at": self.created_at
+        }
+        return [
+            {"id": str(uuid.uuid4()), "customer_id": self.customer_id, "account": WALLET_ACCOUNT,
+             "amount": self.amount, **common},
+            {"id": str(uuid.uuid4()), "customer_id": None, "counterparty_id": self.customer_id,
+             "account": self.contra_account, "amount": -self.amount, **common}
+        ]
+
+    def balance_update(self) -> Tuple[Dict, Dict]:
+        """Apply to the wallet at most once, and never below zero unless allowed.
+
+        The posting id left in ``pending_postings`` marks it applied until the
+        legs are settled, which makes the step safe to retry after a crash.
+        """
+        query = {"id": self.customer_id, "pending_postings": {"$ne": self.id}}
+        if self.amount < 0 and not self.allow_overdraft:
+            query["wallet_balance"] = {"$gte": -self.amount}
+        return query, {"$inc": {"wallet_balance": self.amount}, "$push": {"pending_postings": self.id}}
+
+async def _settle(db, applied: Set[str], failed: Set[str]):
+    if applied:
+        await db.wallet_transactions.update_many({"posting_id": {"$in": list(applied)}}, {"$set": {"state": POSTED}})
+        await db.users.update_many(
+            {"pending_postings": {"$in": list(applied)}}, {"$pullAll": {"pending_postings": list(applied)}}
+        )
+    if failed:
+        await db.wallet_transactions.update_many({"posting_id": {"$in": list(failed)}}, {"$set": {"state": FAILED}})
+
+async def post(db, posting: Posting) -> float:
+    """Apply one posting and return the new balance.
+
+    Raises 400 if a debit would overdraw the wallet and 404 if the customer
+    does not exist; the ledger legs are then kept as ``failed``.
+    """
+    await db.wallet_transactions.insert_many(posting.legs())
+    query, update = posting.balance_update()
+    user_doc = await db.users.find_one_and_update(query, update, projection={"_id": 0, "wallet_balance": 1})
+    if user_doc is None:
+        await _settle(db, set(), {posting.id})
+        if await db.users.count_documents({"id": posting.customer_id}, limit=1):
+            raise HTTPException(status_code=400, detail="Insufficient wallet balance")
+        raise HTTPException(status_code=404, detail="User not found")
+    await _settle(db, {posting.id}, set())
+    return (user_doc.get('wallet_balance') or 0.0) + posting.amount
+
+async def post_many(db, postings: Sequence[Posting]) -> List[Posting]:
+    """Apply a batch of postings in a fixed number of round trips; returns the ones that failed"""
+    if not postings:
+        return []
+    await db.wallet_transactions.insert_many([leg for posting in postings for leg in posting.legs()])
+    await db.users.bulk_write([UpdateOne(*posting.balance_update()) for posting in postings], ordered=False)
+
+    ids = {posting.id for posting in postings}
+    applied = set()
+    async for user_doc in db.users.find({"pending_postings": {"$in": list(ids)}}, {"_id": 0, "pending_postings": 1}):
+        applied.update(ids.intersection(user_doc['pending_postings']))
+    await _settle(db, applied, ids - applied)
+    return [posting for posting in postings if posting.id not in applied]
+
+async def _clear_settled_markers(db) -> int:
+    """Pull markers a crash left behind after their legs were already settled"""
+    marked = set()
+    async for user_doc in db.users.find({"pending_postings.0": {"$exists": True}}, {"_id": 0, "pending_postings": 1}):
+        marked.update(user_doc['pending_postings'])
+    if not marked:
+        return 0
+    settled = await db.wallet_transactions.distinct(
+        "posting_id", {"posting_id": {"$in": list(marked)}, "account": WALLET_ACCOUNT, "state": {"$in": [POSTED, FAILED]}}
+    )
+    if settled:
+        await db.users.update_many(
+            {"pending_postings": {"$in": settled}}, {"$pullAll": {"pending_postings": settled}}
+        )
+    return len(settled)
+
+async def recover_pending(db, older_than: timedelta = STALE_PENDING_AFTER) -> Dict[str, int]:
+    """Settle postings a crash left pending: applied ones are posted, the rest failed.
+
+    Also clears markers of postings whose legs were settled just before a
+    crash, which would otherwise keep the wallet out of reconciliation.
+    """
+    cleared = await _clear_settled_markers(db)
+    if cleared:
+        logger.warning("Cleared %d wallet posting markers left after settlement", cleared)
+    cutoff = (datetime.now(timezone.utc) - older_than).isoformat()
+    stale = await db.wallet_transactions.distinct(
+        "posting_id", {"state": PENDING, "account": WALLET_ACCOUNT, "created_at": {"$lt": cutoff}}
+    )
+    if not stale:
+        return {"posted": 0, "failed": 0}
+    applied = set()
+    async for user_doc in db.users.find({"pending_postings": {"$in": stale}}, {"_id": 0, "pending_postings": 1}):
+        applied.update(set(stale).intersection(user_doc['pending_postings']))
+    failed = set(stale) - applied
+    await _settle(db, applied, failed)
+    logger.warning("Recovered %d interrupted wallet postings (%d applied)", len(stale), len(applied))
+    return {"posted": len(applied), "failed": len(failed)}
+
+async def recover_pass_purchases(db, older_than: timedelta = STALE_PENDING_AFTER) -> Dict[str, int]:
+    """Finish pass purchases a crash interrupted: paid passes are activated, unpaid ones removed.
+
+    Run after ``recover_pending``, so every debit old enough to look at is settled.
+    """
+    cutoff = (datetime.now(timezone.utc) - older_than).isoformat()
+    pending = await db.passes.distinct("id", {"payment_pending": True, "created_at": {"$lt": cutoff}})
+    if not pending:
+        return {"activated": 0, "removed": 0}
+    paid, in_flight = set(), set()
+    async for leg in db.wallet_transactions.find(
+        {"reference_id": {"$in": pending}, "account": WALLET_ACCOUNT, "state": {"$in": [POSTED, PENDING]}},
+        {"_id": 0, "reference_id": 1, "state": 1}
+    ):
+        (paid if leg['state'] == POSTED else in_flight).add(leg['reference_id'])
+    if paid:
+        await db.passes.update_many(
+            {"id": {"$in": list(paid)}, "payment_pending": True},
+            {"$set": {"is_active": True}, "$unset": {"payment_pending": ""}}
+        )
+    unpaid = list(set(pending) - paid - in_flight)
+    if unpaid:
+        await db.passes.delete_many({"id": {"$in": unpaid}, "payment_pending": True})
+    logger.warning("Recovered %d interrupted pass purchases (%d paid)", len(pending), len(paid))
+    return {"activated": len(paid), "removed": len(unpaid)}
+
+# Wallet legs that have moved a balance; entries from before the ledger have no state
+BALANCE_ENTRIES = {"customer_id": {"$ne": None}, "state": {"$in": [POSTED, None]}}
+
+def _after(through_at: str, through_id: str) -> Dict:
+    """Entries after the (created_at, id) position of a checkpoint"""
+    return {"$or": [{"created_at": {"$gt": through_at}}, {"created_at": through_at, "id": {"$gt": through_id}}]}
+
+def _position(doc: Dict) -> Tuple[str, str]:
+    return doc['through_at'], doc['through_id']
+
+async def latest_checkpoints(db, customer_ids: List[str], at: Optional[str] = None) -> Dict[str, Dict]:
+    """Newest checkpoint per customer, optionally only those taken up to ``at``"""
+    match = {"customer_id": {"$in": customer_ids}}
+    if at is not None:
+        match["through_at"] = {"$lte": at}
+    checkpoints = {}
+    async for row in db.wallet_checkpoints.aggregate([
+        {"$match": match},
+        {"$sort": {"customer_id": 1, "through_at": -1, "through_id": -1}},
+        {"$group": {"_id": "$customer_id", "checkpoint": {"$first": "$$ROOT"}}}
+    ]):
+        checkpoints[row['_id']] = row['checkpoint']
+    return checkpoints
+
+async def ledger_balances(db, customer_ids: List[str], at: Optional[str] = None) -> Dict[str, float]:
+    """Balance per customer from the ledger: latest checkpoint plus the entries after it"""
+    checkpoints = await latest_checkpoints(db, customer_ids, at)
+    balances = {customer_id: 0.0 for customer_id in customer_ids}
+    tails = []
+    for customer_id in customer_ids:
+        checkpoint = checkpoints.get(customer_id)
+        if checkpoint is None:
+            tails.append({"customer_id": customer_id})
+        else:
+            balances[customer_id] = checkpoint['balance']
+            tails.append({"customer_id": customer_id, **_after(*_position(checkpoint))})
+
+    match = {"$and": [BALANCE_ENTRIES, {"$or": tails}]}
+    if at is not None:
+        match["created_at"] = {"$lte": at}
+    async for row in db.wallet_transactions.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$customer_id", "total": {"$sum": "$amount"}}}
+    ]):
+        balances[row['_id']] += row['total']
+    return balances
+
+async def _write_checkpoint_batch(db, running: Dict[str, list], taken_at: str) -> int:
+    """Store one checkpoint per customer in ``running``: customer -> [delta, first, last]"""
+    previous = await latest_checkpoints(db, list(running))
+    writes = []
+    for customer_id, (delta, first, last) in running.items():
+        base = previous.get(customer_id)
+        if base is not None and _position(base) >= first:
+            # A repeated run: build on the checkpoint taken before these entries
+            base = await db.wallet_checkpoints.find_one(
+                {"customer_id": customer_id, **{
+                    "$or": [{"through_at": {"$lt": first[0]}}, {"through_at": first[0], "through_id": {"$lt": first[1]}}]
+                }},
+                sort=[("through_at", -1), ("through_id", -1)]
+            )
+        checkpoint_id = f"{customer_id}:{last[1]}"
+        writes.append(ReplaceOne({"_id": checkpoint_id}, {
+            "_id": checkpoint_id,
+            "customer_id": customer_id,
+            "balance": (base['balance'] if base else 0.0) + delta,
+            "through_at": last[0],
+            "through_id": last[1],
+            "created_at": taken_at
+        }, upsert=True))
+    if writes:
+        await db.wallet_checkpoints.bulk_write(writes, ordered=False)
+    return len(writes)
+
+async def write_checkpoints(db, batch_size: int = CHECKPOINT_BATCH_SIZE) -> Dict[str, int]:
+    """Stream the ledger written since the last run and checkpoint every customer it touched.
+
+    Entries are read once, in (created_at, id) order, and only up to the
+    recovery horizon, so no pending posting can settle behind a checkpoint
+    later. Running balances are flushed whenever ``batch_size`` customers are
+    in memory, and the watermark moves after each flush. Checkpoint ids are
+    deterministic, so a run cut short between the two is safely repeated.
+    """
+    await recover_pending(db)
+    taken_at = datetime.now(timezone.utc)
+    horizon = (taken_at - STALE_PENDING_AFTER).isoformat()
+
+    query = {**BALANCE_ENTRIES, "created_at": {"$lt": horizon}}
+    watermark = await db.wallet_checkpoints.find_one({"_id": CHECKPOINT_WATERMARK_ID})
+    if watermark:
+        query.update(_after(*_position(watermark)))
+
+    running: Dict[str, list] = {}
+    entries = written = 0
+    last = None
+    cursor = db.wallet_transactions.find(
+        query, {"_id": 0, "id": 1, "customer_id": 1, "amount": 1, "created_at": 1}
+    ).sort([("created_at", 1), ("id", 1)]).batch_size(batch_size)
+    async for entry in cursor:
+        last = (entry['created_at'], entry['id'])
+        totals = running.get(entry['customer_id'])
+        if totals is None:
+            running[entry['customer_id']] = [entry['amount'], last, last]
+        else:
+            totals[0] += entry['amount']
+            totals[2] = last
+        entries += 1
+
+        if len(running) >= batch_size:
+            written += await _write_checkpoint_batch(db, running, taken_at.isoformat())
+            await _save_watermark(db, last)
+            running = {}
+
+    if running:
+        written += await _write_checkpoint_batch(db, running, taken_at.isoformat())
+    if last is not None:
+        await _save_watermark(db, last)
+    return {"entries": entries, "checkpoints": written}
+
+async def _save_watermark(db, position: Tuple[str, str]):
+    await db.wallet_checkpoints.update_one(
+        {"_id": CHECKPOINT_WATERMARK_ID},
+        {"$set": {"through_at": position[0], "through_id": position[1]}},
+        upsert=True
+    )
+
+async def balance_at(db, customer_id: str, at: datetime) -> float:
+    """Wallet balance as of ``at``, from the ledger"""
+    balances = await ledger_balances(db, [customer_id], at.astimezone(timezone.utc).isoformat())
+    return balances[customer_id]
+
+async def reconcile(db, batch_size: int = RECONCILE_BATCH_SIZE, max_reported: int = 100) -> Dict:
+    """Check every wallet balance against its ledger.
+
+    Users are walked in ``id`` order in batches. Each batch costs one
+    checkpoint read and one aggregation over the entries after those
+    checkpoints, so memory stays flat however many wallets there are.
+    Wallets with a posting in flight are skipped. Also checks that all posted
+    legs sum to zero, and finishes interrupted pass purchases.
+    """
+    recovered = await recover_pending(db)
+    passes = await recover_pass_purchases(db)
+    checked = skipped = mismatched = 0
+    mismatches = []
+    last_id = ""
+    while True:
+        users = await db.users.find(
+            {"id": {"$gt": last_id}},
+            {"_id": 0, "id": 1, "wallet_balance": 1, "pending_postings": 1}
+        ).sort("id", 1).limit(batch_size).to_list(batch_size)
+        if not users:
+            break
+        last_id = users[-1]['id']
+        sums = await ledger_balances(db, [user['id'] for user in users])
+
+        for user in users:
+            if user.get('pending_postings'):
+                skipped += 1
+                continue
+            checked += 1
+            balance = user.get('wallet_balance') or 0.0
+            ledger = sums.get(user['id'], 0.0)
+            if abs(balance - ledger) > BALANCE_TOLERANCE:
+                mismatched += 1
+                if len(mismatches) < max_reported:
+                    mismatches.append({"customer_id": user['id'], "balance": balance, "ledger": round(ledger, 2)})
+
+    imbalance = 0.0
+    async for row in db.wallet_transactions.aggregate([
+        {"$match": {"state": POSTED}},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+    ]):
+        imbalance = row['total']
+
+    return {
+        "wallets_checked": checked,
+        "wallets_skipped": skipped,
+        "mismatched": mismatched,
+        "mismatches": mismatches,
+        "ledger_imbalance": round(imbalance, 2),
+        "recovered": recovered,
+        "pass_purchases_recovered": passes
+    }
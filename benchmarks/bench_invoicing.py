@@ -0,0 +1,118 @@
+"""Month-end invoicing: invoice documents built per second.
+
+"single" is ``invoice_for_session``'s path: each session goes through
+``build_invoices`` alone and takes its own number from the counter. "scalar"
+works out the same documents in a plain Python loop, which is what
+``generate_invoice`` did for each session. "batch" is ``run_invoicing``'s path:
+``build_invoices`` over ``INVOICE_BATCH_SIZE`` chunks, with one block of numbers
+per cafe per chunk. Database round trips are not timed; the counter
+round trips each path needs are counted instead.
+
+    python benchmarks/bench_invoicing.py
+"""
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from invoicing import GST_BASIS_POINTS, INVOICE_BATCH_SIZE, INVOICE_DUE_DAYS, build_invoices, invoice_number
+
+CAFES = 20
+SESSIONS = 100000
+
+def make_sessions(count: int):
+    rng = random.Random(11)
+    cafes = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(CAFES)]
+    sessions = []
+    for n in range(count):
+        hours = rng.choice([0.0, 0.5, 1.0, 1.5, 2.0, 3.25])
+        sessions.append({
+            "id": f"s{n}", "cafe_id": cafes[n % CAFES], "customer_id": f"c{rng.randrange(5000)}",
+            "device_id": f"d{rng.randrange(500):08d}", "status": "COMPLETED",
+            "total_amount": round(hours * rng.uniform(60, 200), 2), "duration_hours": hours
+        })
+    sessions.sort(key=lambda s: s['cafe_id'])
+    return sessions
+
+def run_single(sessions, now):
+    counters = {}
+    invoices = []
+    for session in sessions:
+        counters[session['cafe_id']] = counters.get(session['cafe_id'], 0) + 1
+        invoices.extend(build_invoices([session], [invoice_number(session['cafe_id'], counters[session['cafe_id']])], now))
+    return invoices, len(sessions)
+
+def run_scalar(sessions, now):
+    counters = {}
+    invoices = []
+    for session in sessions:
+        counters[session['cafe_id']] = counters.get(session['cafe_id'], 0) + 1
+        paise = round(session['total_amount'] * 100)
+        tax_paise = (paise * GST_BASIS_POINTS + 5000) // 10000
+        amount, tax = paise / 100, tax_paise / 100
+        hours = session['duration_hours']
+        invoices.append({
+            "id": str(uuid.uuid4()),
+            "invoice_number": invoice_number(session['cafe_id'], counters[session['cafe_id']]),
+            "cafe_id": session['cafe_id'],
+            "customer_id": session['customer_id'],
+            "reference_id": session['id'],
+            "amount": amount,
+            "tax_amount": tax,
+            "total_amount": (paise + tax_paise) / 100,
+            "status": "PAID",
+            "line_items": [{
+                "description": f"Gaming Session - Device {session['device_id'][:8]}",
+                "quantity": hours,
+                "rate": round(amount / hours, 2) if hours else amount,
+                "amount": amount
+            }],
+            "due_date": (now + timedelta(days=INVOICE_DUE_DAYS)).isoformat(),
+            "created_at": now.isoformat()
+        })
+    return invoices, len(sessions)
+
+def run_batch(sessions, now):
+    counters = {}
+    invoices = []
+    round_trips = 0
+    for i in range(0, len(sessions), INVOICE_BATCH_SIZE):
+        chunk = sessions[i:i + INVOICE_BATCH_SIZE]
+        by_cafe = {}
+        for position, session in enumerate(chunk):
+            by_cafe.setdefault(session['cafe_id'], []).append(position)
+        numbers = [""] * len(chunk)
+        for cafe_id, positions in by_cafe.items():
+            first = counters.get(cafe_id, 0) + 1
+            counters[cafe_id] = first + len(positions) - 1
+            round_trips += 1
+            for offset, position in enumerate(positions):
+                numbers[position] = invoice_number(cafe_id, first + offset)
+        invoices.extend(build_invoices(chunk, numbers, now))
+    return invoices, round_trips
+
+def timed(label, run, sessions, now):
+    started = time.perf_counter()
+    invoices, round_trips = run(sessions, now)
+    elapsed = time.perf_counter() - started
+    print(f"{label:7} {len(invoices) / elapsed:12,.0f} invoices/s  {elapsed / len(invoices) * 1e6:6.2f} us each  "
+          f"({round_trips:,} counter round trips)")
+    return invoices, elapsed
+
+def main():
+    sessions = make_sessions(SESSIONS)
+    now = datetime.now(timezone.utc)
+    print(f"{SESSIONS:,} completed sessions across {CAFES} cafes, batches of {INVOICE_BATCH_SIZE}")
+    batch, batch_time = timed("batch", run_batch, sessions, now)
+    scalar, _ = timed("scalar", run_scalar, sessions, now)
+    _, single_time = timed("single", run_single, sessions, now)
+    assert [(i['invoice_number'], i['tax_amount'], i['total_amount']) for i in batch] == \
+        [(i['invoice_number'], i['tax_amount'], i['total_amount']) for i in scalar]
+    print(f"batch is {single_time / batch_time:.1f}x faster than single")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Pricing-rule engine: compile time and per-session cost throughput.
+
+"naive" walks a session minute by minute and multiplies the rules that cover
+each minute, which is what pricing without a compiled timeline amounts to.
+"timeline" is ``PricingTimeline.cost``: two binary searches on prefix sums.
+"batch" is ``cost_many`` over a /pricing/quote sized batch.
+
+    python benchmarks/bench_pricing.py
+"""
+import math
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from pricing_engine import DAY_MINUTES, compile_timeline, rule_windows
+
+RULES = 40
+SESSIONS = 20000
+NAIVE_SESSIONS = 200
+BATCH = 500
+
+def make_rules(count: int):
+    rng = random.Random(7)
+    rules = []
+    for _ in range(count):
+        start = rng.randrange(DAY_MINUTES)
+        rules.append({
+            "rule_type": rng.choice(["PEAK", "OFFPEAK", "HAPPY_HOUR"]),
+            "multiplier": rng.choice([0.7, 0.8, 1.25, 1.5]),
+            "start_time": f"{start // 60:02d}:{start % 60:02d}",
+            "end_time": f"{(start + rng.randrange(30, 360)) // 60 % 24:02d}:{rng.randrange(60):02d}",
+            "days_of_week": rng.sample(range(7), rng.randrange(1, 8)),
+        })
+    return rules
+
+def make_sessions(timeline, count: int):
+    rng = random.Random(11)
+    base = 1_709_000_000.0
+    return [(start, start + rng.uniform(0.5, 8) * 3600)
+            for start in (base + rng.uniform(0, 14 * 86400) for _ in range(count))]
+
+def naive_cost(windows, timeline, start_ts, end_ts, hourly_rate):
+    start, end = timeline.wall_minutes(start_ts), timeline.wall_minutes(end_ts)
+    total = 0.0
+    for minute in range(math.floor(start), math.ceil(end)):
+        offset = minute % (7 * DAY_MINUTES)
+        total += math.prod(m for m, spans in windows if any(s <= offset < e for s, e in spans))
+    return hourly_rate / 60 * total
+
+def main():
+    rules = make_rules(RULES)
+
+    started = time.perf_counter()
+    for _ in range(100):
+        timeline = compile_timeline(rules)
+    compile_us = (time.perf_counter() - started) / 100 * 1e6
+    print(f"compile  {compile_us:10.1f} us for {RULES} rules ({len(timeline.starts)} segments)")
+
+    sessions = make_sessions(timeline, SESSIONS)
+    started = time.perf_counter()
+    for start, end in sessions:
+        timeline.cost(start, end, 120.0)
+    fast = (time.perf_counter() - started) / SESSIONS
+    print(f"timeline {fast * 1e6:10.2f} us per session ({1 / fast:,.0f} sessions/s)")
+
+    starts, ends = zip(*sessions[:BATCH])
+    rates = [120.0] * BATCH
+    started = time.perf_counter()
+    for _ in range(100):
+        timeline.cost_many(starts, ends, rates)
+    batch_ms = (time.perf_counter() - started) / 100 * 1e3
+    print(f"batch    {batch_ms:10.2f} ms per {BATCH} quotes")
+
+    windows = [(rule['multiplier'], rule_windows(rule)) for rule in rules]
+    started = time.perf_counter()
+    for start, end in sessions[:NAIVE_SESSIONS]:
+        naive_cost(windows, timeline, start, end, 120.0)
+    slow = (time.perf_counter() - started) / NAIVE_SESSIONS
+    print(f"naive    {slow * 1e6:10.2f} us per session ({1 / slow:,.0f} sessions/s)")
+    print(f"speedup  {slow / fast:10.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Session QR endpoint: requests per second and event-loop stalls.
+
+Replays a burst of QR requests, 50 in flight at a time, where each session's
+code is asked for several times (the app polls while the customer checks in).
+"inline" renders the PNG and base64-encodes it on the event loop for every
+request, which is what ``get_session_qr`` used to do. "pooled" is
+``SessionQrCodes.data_uri``: rendered on the QR thread pool once per
+session, then served from the LRU. "max stall" is the longest the loop went
+without running a 1 ms ticker, i.e. how long other requests were blocked.
+Database lookups are not included.
+
+    python benchmarks/bench_qr.py
+"""
+import asyncio
+import base64
+import io
+import random
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import qrcode
+
+from qr_codes import SessionQrCodes
+
+SESSIONS = 200
+REQUESTS = 2000
+CONCURRENCY = 50
+
+def make_requests():
+    rng = random.Random(3)
+    sessions = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(SESSIONS)]
+    return [rng.choice(sessions) for _ in range(REQUESTS)]
+
+async def inline(session_id: str) -> str:
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(f"SESSION:{session_id}")
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+async def run(handler, requests):
+    stalls = []
+    done = asyncio.Event()
+
+    async def ticker():
+        last = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stalls.append(now - last)
+            last = now
+
+    slots = asyncio.Semaphore(CONCURRENCY)
+
+    async def request(session_id):
+        async with slots:
+            await asyncio.sleep(0)  # stands in for the session lookup
+            return await handler(session_id)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(request(session_id) for session_id in requests))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    return results, elapsed, max(stalls, default=0.0)
+
+def report(label, requests, elapsed, stall):
+    print(f"{label:7} {len(requests) / elapsed:10,.0f} requests/s  {elapsed / len(requests) * 1e3:6.2f} ms each  "
+          f"max stall {stall * 1e3:6.1f} ms")
+
+async def main():
+    requests = make_requests()
+    print(f"{REQUESTS:,} requests for {SESSIONS} sessions, {CONCURRENCY} in flight")
+    before, inline_time, inline_stall = await run(inline, requests)
+    report("inline", requests, inline_time, inline_stall)
+    codes = SessionQrCodes()
+    after, pooled_time, pooled_stall = await run(codes.data_uri, requests)
+    report("pooled", requests, pooled_time, pooled_stall)
+    assert before == after
+    print(f"pooled serves {inline_time / pooled_time:.0f}x the requests per second of inline")
+
+if __name__ == "__main__":
+    asyncio.run(main())
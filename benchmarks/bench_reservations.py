@@ -0,0 +1,94 @@
+"""Reservation conflict checks at 10k bookings per cafe per day.
+
+A month of booking attempts (30 minutes to 1.25 hours each, spread over a
+500-device cafe) is replayed against each structure: every attempt is a
+conflict check, and the ones that fit are added. "naive" keeps a device's reservations in a list and scans all of
+them, which is what a query over the device's reservations amounts to.
+"book" is ``DeviceBookings``: one bisect per check. "indexed" is the full
+``ReservationBook.put`` path, which also blocks the window in the
+availability index.
+
+    python benchmarks/bench_reservations.py
+"""
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from availability import availability_index
+from reservations import SLOT_SECONDS, DeviceBookings, ReservationBook
+
+DEVICES = 500
+BOOKINGS_PER_DAY = 10000
+DAYS = 30
+
+def make_attempts(days: int):
+    rng = random.Random(5)
+    base = time.time() + 86400
+    base -= base % SLOT_SECONDS
+    slots_per_day = 86400 // SLOT_SECONDS
+    attempts = []
+    for n in range(days * BOOKINGS_PER_DAY):
+        day = n // BOOKINGS_PER_DAY
+        start = base + (day * slots_per_day + rng.randrange(slots_per_day)) * SLOT_SECONDS
+        attempts.append((f"r{n}", f"d{rng.randrange(DEVICES)}", start, start + rng.randrange(2, 6) * SLOT_SECONDS))
+    return attempts
+
+def run_naive(attempts):
+    devices = {}
+    booked = 0
+    for reservation_id, device_id, start, end in attempts:
+        intervals = devices.setdefault(device_id, [])
+        if not any(s < end and e > start for s, e in intervals):
+            intervals.append((start, end))
+            booked += 1
+    return booked
+
+def run_book(attempts):
+    devices = {}
+    booked = 0
+    for reservation_id, device_id, start, end in attempts:
+        bookings = devices.get(device_id)
+        if bookings is None:
+            bookings = devices[device_id] = DeviceBookings()
+        if bookings.conflict(start, end) is None:
+            bookings.add(reservation_id, start, end)
+            booked += 1
+    return booked
+
+def run_indexed(attempts):
+    book = ReservationBook()
+    for i in range(DEVICES):
+        availability_index.put_device({"id": f"d{i}", "cafe_id": "bench", "device_type": "PC", "status": "AVAILABLE"})
+    booked = 0
+    for reservation_id, device_id, start, end in attempts:
+        if book.conflict(device_id, start, end) is None:
+            book.put({
+                "id": reservation_id, "cafe_id": "bench", "device_id": device_id, "status": "CONFIRMED",
+                "start_time": datetime.fromtimestamp(start, timezone.utc),
+                "end_time": datetime.fromtimestamp(end, timezone.utc)
+            })
+            booked += 1
+    return booked
+
+def timed(label, run, attempts):
+    started = time.perf_counter()
+    booked = run(attempts)
+    elapsed = time.perf_counter() - started
+    print(f"{label:8} {len(attempts) / elapsed:12,.0f} attempts/s  {elapsed / len(attempts) * 1e6:7.2f} us each  "
+          f"({booked:,} of {len(attempts):,} booked)")
+    return elapsed / len(attempts)
+
+def main():
+    attempts = make_attempts(DAYS)
+    print(f"{DEVICES} devices, {BOOKINGS_PER_DAY:,} attempts a day for {DAYS} days")
+    book = timed("book", run_book, attempts)
+    timed("indexed", run_indexed, attempts)
+    naive = timed("naive", run_naive, attempts)
+    print(f"book is {naive / book:.0f}x faster per attempt than naive")
+
+if __name__ == "__main__":
+    main()
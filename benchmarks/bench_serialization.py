@@ -0,0 +1,80 @@
+"""Serialization cost of a 100-item list response, before and after DocumentResponse.
+
+"before" replays what FastAPI did for ``list_sessions``: parse ISO strings in a
+Python loop, validate against ``List[Session]``, re-serialize and render with the
+stdlib JSON encoder. "after" hands the stored documents straight to orjson.
+
+    python benchmarks/bench_serialization.py
+"""
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from models import Session
+from responses import DocumentResponse
+
+ITEMS = 100
+ROUNDS = 2000
+
+def make_documents(count: int) -> List[dict]:
+    """Session documents as the routes store them (datetimes as ISO strings)"""
+    now = datetime.now(timezone.utc)
+    docs = []
+    for i in range(count):
+        start = now - timedelta(hours=i)
+        docs.append({
+            "id": str(uuid.uuid4()),
+            "customer_id": str(uuid.uuid4()),
+            "device_id": str(uuid.uuid4()),
+            "cafe_id": str(uuid.uuid4()),
+            "start_time": start.isoformat(),
+            "end_time": (start + timedelta(hours=2)).isoformat(),
+            "duration_hours": 2.0,
+            "total_amount": 200.0,
+            "status": "COMPLETED",
+            "created_at": start.isoformat(),
+        })
+    return docs
+
+async def before(docs: List[dict], field) -> bytes:
+    for session in docs:
+        if isinstance(session['start_time'], str):
+            session['start_time'] = datetime.fromisoformat(session['start_time'])
+        if session.get('end_time') and isinstance(session['end_time'], str):
+            session['end_time'] = datetime.fromisoformat(session['end_time'])
+        if isinstance(session['created_at'], str):
+            session['created_at'] = datetime.fromisoformat(session['created_at'])
+    content = await serialize_response(field=field, response_content=docs)
+    return JSONResponse(content).body
+
+async def after(docs: List[dict]) -> bytes:
+    return DocumentResponse(docs).body
+
+async def measure(label: str, run) -> float:
+    # Fresh documents every round: the old path mutates them in place
+    batches = [make_documents(ITEMS) for _ in range(ROUNDS)]
+    started = time.process_time()
+    for docs in batches:
+        await run(docs)
+    per_request = (time.process_time() - started) / ROUNDS * 1e6
+    print(f"{label:<8} {per_request:8.1f} us CPU per {ITEMS}-item response")
+    return per_request
+
+async def main():
+    field = create_response_field(name="Response_list_sessions", type_=List[Session])
+    slow = await measure("before", lambda docs: before(docs, field))
+    fast = await measure("after", after)
+    print(f"speedup  {slow / fast:8.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main())
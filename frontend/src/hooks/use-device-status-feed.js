@@ -0,0 +1,53 @@
+import { useEffect } from 'react';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const RECONNECT_DELAY_MS = 2000;
+
+// Keeps a devices list in sync with the backend's live status feed, one
+// WebSocket per cafe. The first message is a snapshot, the rest are deltas.
+export const useDeviceStatusFeed = (cafeIds, setDevices) => {
+  const key = [...new Set(cafeIds)].sort().join(',');
+
+  useEffect(() => {
+    const token = localStorage.getItem('token');
+    if (!key || !token) return undefined;
+
+    const wsBase = BACKEND_URL.replace(/^http/, 'ws');
+    const sockets = new Set();
+    let stopped = false;
+
+    const applyStatuses = (updates) => {
+      const statusById = Object.fromEntries(updates.map((d) => [d.id, d.status]));
+      setDevices((devices) =>
+        devices.map((d) => (statusById[d.id] ? { ...d, status: statusById[d.id] } : d))
+      );
+    };
+
+    const connect = (cafeId) => {
+      const ws = new WebSocket(
+        `${wsBase}/api/ws/cafes/${cafeId}/devices?token=${encodeURIComponent(token)}`
+      );
+      ws.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'snapshot') {
+          applyStatuses(message.devices);
+        } else if (message.type === 'device_status') {
+          applyStatuses([{ id: message.device_id, status: message.status }]);
+        }
+      };
+      ws.onclose = () => {
+        sockets.delete(ws);
+        if (!stopped) {
+          setTimeout(() => !stopped && connect(cafeId), RECONNECT_DELAY_MS);
+        }
+      };
+      sockets.add(ws);
+    };
+
+    key.split(',').forEach(connect);
+    return () => {
+      stopped = true;
+      sockets.forEach((ws) => ws.close());
+    };
+  }, [key, setDevices]);
+};
@@ -9,6 +9,9 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from
 import { toast } from 'sonner';
 import { Gamepad, Plus, Star, Info } from 'lucide-react';
 
+// The grid only renders these; full guides are fetched when a game is opened
+const GRID_FIELDS = 'name,genre,age_rating,difficulty_level,popularity_score,image_url';
+
 export const GameLibrary = () => {
   const { user } = useAuth();
   const [games, setGames] = useState([]);
@@ -31,13 +34,22 @@ export const GameLibrary = () => {
 
   const fetchGames = async () => {
     try {
-      const { data } = await api.get('/games');
+      const { data } = await api.get('/games', { params: { fields: GRID_FIELDS } });
       setGames(data);
     } catch (error) {
       console.error('Failed to fetch games:', error);
     }
   };
 
+  const openGame = async (gameId) => {
+    try {
+      const { data } = await api.get(`/games/${gameId}`);
+      setSelectedGame(data);
+    } catch (error) {
+      console.error('Failed to fetch game:', error);
+    }
+  };
+
   const handleAddGame = async () => {
     try {
       await api.post('/games', formData);
@@ -162,7 +174,7 @@ export const GameLibrary = () => {
               <Card
                 key={game.id}
                 className="bg-surface border-white/10 p-6 cursor-pointer hover:border-primary/50 transition-all"
-                onClick={() => setSelectedGame(game)}
+                onClick={() => openGame(game.id)}
               >
                 <div className="flex justify-between items-start mb-4">
                   <Gamepad className="w-10 h-10 text-primary" />
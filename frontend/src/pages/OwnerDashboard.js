@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useAuth, api } from '@/contexts/AuthContext';
+import { useDeviceStatusFeed } from '@/hooks/use-device-status-feed';
 import { Button } from '@/components/ui/button';
 import { Card } from '@/components/ui/card';
 import { Input } from '@/components/ui/input';
@@ -25,6 +26,8 @@ export const OwnerDashboard = () => {
     fetchSessions();
   }, []);
 
+  useDeviceStatusFeed(devices.map((d) => d.cafe_id), setDevices);
+
   const fetchAnalytics = async () => {
     try {
       const { data } = await api.get('/analytics/dashboard');
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useAuth, api } from '@/contexts/AuthContext';
+import { useDeviceStatusFeed } from '@/hooks/use-device-status-feed';
 import { Button } from '@/components/ui/button';
 import { Card } from '@/components/ui/card';
 import { Input } from '@/components/ui/input';
@@ -20,6 +21,8 @@ export const StaffPanel = () => {
     fetchDevices();
   }, []);
 
+  useDeviceStatusFeed(devices.map((d) => d.cafe_id), setDevices);
+
   const fetchDevices = async () => {
     try {
       const { data } = await api.get('/devices');
@@ -86,7 +89,6 @@ export const StaffPanel = () => {
       toast.success('Customer checked in successfully');
       setSelectedDevice('');
       setCustomerPhone('');
-      fetchDevices();
     } catch (error) {
       toast.error('Check-in failed');
       console.error(error);
@@ -0,0 +1,113 @@
+"""Concurrent coupon redemption against a real MongoDB.
+
+Runs only when MONGO_URL points at a reachable server; each test works in a
+throwaway database that is dropped afterwards.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from caching import catalog_versions
+from coupons import COUPONS_SCOPE, CouponIndex, coupon_index, redeem_coupon
+from indexes import ensure_indexes
+
+MONGO_URL = os.environ.get('MONGO_URL')
+REDEEMERS = 500
+
+pytestmark = pytest.mark.skipif(not MONGO_URL, reason="needs MONGO_URL")
+
+def run_in_scratch_db(test):
+    async def runner():
+        client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+        try:
+            await client.admin.command('ping')
+        except Exception as exc:
+            pytest.skip(f"MongoDB unreachable: {exc}")
+        name = f"coupon_load_{uuid.uuid4().hex[:8]}"
+        try:
+            db = client[name]
+            await ensure_indexes(db)
+            await test(db)
+        finally:
+            await client.drop_database(name)
+            client.close()
+    asyncio.run(runner())
+
+async def seed(db, max_uses, customers):
+    now = datetime.now(timezone.utc)
+    coupon = {
+        "id": str(uuid.uuid4()), "cafe_id": "cafe-1", "code": "LOAD", "discount_type": "percentage",
+        "discount_value": 10.0, "min_amount": None, "max_uses": max_uses, "used_count": 0,
+        "valid_from": (now - timedelta(days=1)).isoformat(), "valid_until": (now + timedelta(days=1)).isoformat(),
+        "is_active": True
+    }
+    await db.coupons.insert_one(coupon)
+    await coupon_index.coupon_written(db, coupon)
+    sessions = [
+        {"id": str(uuid.uuid4()), "cafe_id": "cafe-1", "device_id": f"device-{i}", "customer_id": customer,
+         "status": "ACTIVE", "start_time": now.isoformat()}
+        for i, customer in enumerate(customers)
+    ]
+    await db.sessions.insert_many(sessions)
+    return coupon, [{k: v for k, v in s.items() if k != '_id'} for s in sessions]
+
+async def redeem_all(db, sessions):
+    async def attempt(session):
+        try:
+            await redeem_coupon(db, "load", session)
+            return True
+        except HTTPException:
+            return False
+    return await asyncio.gather(*(attempt(session) for session in sessions))
+
+def test_concurrent_redeemers_never_oversell():
+    async def scenario(db):
+        coupon, sessions = await seed(db, 50, [f"customer-{i}" for i in range(REDEEMERS)])
+        results = await redeem_all(db, sessions)
+
+        assert sum(results) == 50
+        assert (await db.coupons.find_one({"id": coupon['id']}))['used_count'] == 50
+        assert await db.coupon_redemptions.count_documents({"coupon_id": coupon['id']}) == 50
+        assert await db.sessions.count_documents({"coupon_code": "LOAD"}) == 50
+    run_in_scratch_db(scenario)
+
+def test_customer_redeems_once_across_sessions():
+    async def scenario(db):
+        coupon, sessions = await seed(db, None, ["customer-1"] * 20)
+        results = await redeem_all(db, sessions)
+
+        assert sum(results) == 1
+        assert (await db.coupons.find_one({"id": coupon['id']}))['used_count'] == 1
+    run_in_scratch_db(scenario)
+
+def test_coupon_from_another_cafe_is_rejected():
+    async def scenario(db):
+        _, sessions = await seed(db, None, ["customer-1"])
+        with pytest.raises(HTTPException) as error:
+            await redeem_coupon(db, "load", {**sessions[0], "cafe_id": "cafe-2"})
+        assert error.value.status_code == 404
+    run_in_scratch_db(scenario)
+
+def test_index_picks_up_coupon_inserted_after_a_newer_one():
+    async def scenario(db):
+        index = CouponIndex()
+        now = datetime.now(timezone.utc)
+        window = {"valid_from": (now - timedelta(days=1)).isoformat(), "valid_until": (now + timedelta(days=1)).isoformat()}
+
+        def coupon(code, created_at):
+            return {"id": str(uuid.uuid4()), "cafe_id": "cafe-1", "code": code, "discount_type": "fixed",
+                    "discount_value": 5.0, "is_active": True, "created_at": created_at.isoformat(), **window}
+
+        # Another worker stamped EARLY first, but NEWER was inserted and indexed before it
+        await db.coupons.insert_one(coupon("NEWER", now))
+        await catalog_versions.bump(db, COUPONS_SCOPE)
+        assert await index.lookup(db, "cafe-1", "newer") is not None
+        await db.coupons.insert_one(coupon("EARLY", now - timedelta(seconds=2)))
+        await catalog_versions.bump(db, COUPONS_SCOPE)
+        assert await index.lookup(db, "cafe-1", "early") is not None
+    run_in_scratch_db(scenario)
@@ -0,0 +1,167 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+from billing_meter import ActiveSession
+from pricing_engine import (
+    DAY_MINUTES, REFERENCE_MONDAY, WEEK_MINUTES, PricingTimeline, compile_timeline, parse_hhmm, price_quotes,
+    rule_windows
+)
+
+hhmm = st.builds(lambda h, m: f"{h:02d}:{m:02d}", st.integers(0, 23), st.integers(0, 59))
+rules = st.fixed_dictionaries({
+    "rule_type": st.sampled_from(["PEAK", "OFFPEAK", "WEEKEND", "HAPPY_HOUR", "FESTIVAL"]),
+    "multiplier": st.sampled_from([0.5, 0.7, 0.8, 1.25, 1.5, 2.0]),
+    "start_time": st.none() | hhmm,
+    "end_time": st.none() | hhmm,
+    "days_of_week": st.none() | st.lists(st.integers(0, 6), max_size=7),
+    "is_active": st.booleans(),
+})
+rule_lists = st.lists(rules, max_size=6)
+# Wall-clock minutes around the reference week, including a span before it
+minutes = st.integers(-WEEK_MINUTES, 3 * WEEK_MINUTES)
+
+def covers(rule, minute: int) -> bool:
+    """Reference reading of a rule: does it apply to wall-clock ``minute``?"""
+    if not rule.get('is_active', True):
+        return False
+    start = parse_hhmm(rule['start_time']) if rule.get('start_time') else 0
+    end = parse_hhmm(rule['end_time']) if rule.get('end_time') else start
+    length = (end - start) % DAY_MINUTES or DAY_MINUTES
+    days = rule['days_of_week']
+    if days is None:
+        days = [5, 6] if rule['rule_type'] == 'WEEKEND' else range(7)
+    return any((minute - (day * DAY_MINUTES + start)) % WEEK_MINUTES < length for day in days)
+
+def brute_force(rule_list, start: int, end: int) -> float:
+    total = 0.0
+    for minute in range(start, end):
+        total += math.prod(rule['multiplier'] for rule in rule_list if covers(rule, minute))
+    return total
+
+@settings(max_examples=150, deadline=None)
+@given(rule_lists, minutes, st.integers(0, 3 * DAY_MINUTES))
+def test_integral_matches_minute_by_minute_sum(rule_list, start, length):
+    timeline = compile_timeline(rule_list)
+    priced = timeline.integral(start + length) - timeline.integral(start)
+    assert priced == pytest.approx(brute_force(rule_list, start, start + length), rel=1e-9, abs=1e-6)
+
+@given(rule_lists, minutes, minutes, minutes)
+def test_integral_is_additive(rule_list, a, b, c):
+    timeline = compile_timeline(rule_list)
+    a, b, c = sorted((a, b, c))
+    split = (timeline.integral(b) - timeline.integral(a)) + (timeline.integral(c) - timeline.integral(b))
+    assert split == pytest.approx(timeline.integral(c) - timeline.integral(a), abs=1e-6)
+
+@given(rule_lists, minutes)
+def test_timeline_repeats_weekly(rule_list, start):
+    timeline = compile_timeline(rule_list)
+    assert timeline.integral(start + WEEK_MINUTES) - timeline.integral(start) == pytest.approx(timeline.week_total)
+    assert timeline.multiplier_at(start) == timeline.multiplier_at(start + WEEK_MINUTES)
+
+@given(rule_lists)
+def test_segments_are_sorted_and_merged(rule_list):
+    timeline = compile_timeline(rule_list)
+    assert timeline.starts[0] == 0
+    assert timeline.starts == sorted(set(timeline.starts))
+    assert all(a != b for a, b in zip(timeline.multipliers, timeline.multipliers[1:]))
+
+@given(rule_lists, st.floats(0, 3 * DAY_MINUTES))
+def test_cost_never_negative(rule_list, length):
+    timeline = compile_timeline(rule_list)
+    start = datetime(2024, 3, 1, 18, 30, tzinfo=timeline.tz).timestamp()
+    assert timeline.cost(start, start + length * 60, 120.0) >= 0
+
+@given(rule_lists, st.lists(st.tuples(st.floats(1.6e9, 1.9e9), st.floats(0, 86400)), min_size=1, max_size=20))
+def test_vectorized_cost_matches_scalar(rule_list, spans):
+    timeline = compile_timeline(rule_list)
+    starts = [start for start, _ in spans]
+    ends = [start + length for start, length in spans]
+    expected = [timeline.cost(start, end, 90.0) for start, end in zip(starts, ends)]
+    assert list(timeline.cost_many(starts, ends, [90.0] * len(spans))) == pytest.approx(expected, abs=1e-6)
+
+def test_quotes_apply_coupons_by_cafe_and_minimum():
+    now = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    start = datetime(2024, 3, 4, 10, 0, tzinfo=PricingTimeline.flat().tz).timestamp()
+    devices = {"d1": {"cafe_id": "c1", "hourly_rate": 100.0}, "d2": {"cafe_id": "c2", "hourly_rate": 100.0}}
+    coupon = {
+        "cafe_id": "c1", "code": "TEN", "discount_type": "fixed", "discount_value": 10.0, "min_amount": 150.0,
+        "valid_from": "2024-01-01T00:00:00+00:00", "valid_until": "2025-01-01T00:00:00+00:00", "is_active": True,
+        "max_uses": None, "used_count": 0
+    }
+    quotes = [
+        {"device_id": device_id, "start_time": None, "duration_hours": hours, "start_ts": start,
+         "end_ts": start + hours * 3600, "coupon_code": "TEN"}
+        for device_id, hours in [("d1", 1), ("d1", 2), ("d2", 2)]
+    ]
+    timelines = {"c1": compile_timeline([]), "c2": compile_timeline([{"rule_type": "PEAK", "multiplier": 2.0}])}
+    result = price_quotes(quotes, devices, {("c1", "TEN"): coupon}, timelines, now)
+    assert [q['total_amount'] for q in result] == [100.0, 190.0, 400.0]
+    assert [q['coupon_applied'] for q in result] == [False, True, False]
+
+@pytest.mark.parametrize("discount_type,discount_value", [("fixed", 10.0), ("percentage", 20.0)])
+@pytest.mark.parametrize("hours", [1, 2, 3])
+def test_quote_matches_bill_for_same_span(discount_type, discount_value, hours):
+    now = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    timeline = compile_timeline([{"rule_type": "HAPPY_HOUR", "multiplier": 0.5, "start_time": "11:00", "end_time": "12:00"}])
+    start = datetime(2024, 3, 4, 10, 0, tzinfo=timeline.tz).timestamp()
+    coupon = {
+        "cafe_id": "c1", "code": "SAVE", "discount_type": discount_type, "discount_value": discount_value,
+        "min_amount": 150.0, "valid_from": "2024-01-01T00:00:00+00:00", "valid_until": "2025-01-01T00:00:00+00:00",
+        "is_active": True, "max_uses": None, "used_count": 0
+    }
+    quote = {"device_id": "d1", "start_time": None, "duration_hours": hours, "start_ts": start,
+             "end_ts": start + hours * 3600, "coupon_code": "SAVE"}
+    [priced] = price_quotes([quote], {"d1": {"cafe_id": "c1", "hourly_rate": 100.0}}, {("c1", "SAVE"): coupon},
+                            {"c1": timeline}, now)
+    session = ActiveSession("s1", "c1", "d1", "u1", start, 100.0, discount_type=discount_type,
+                            discount_value=discount_value, min_amount=150.0)
+    assert priced['total_amount'] == pytest.approx(session.total(quote['end_ts'], timeline))
+
+def test_no_rules_is_flat_rate():
+    timeline = compile_timeline([])
+    assert timeline.is_flat
+    start = datetime(2024, 3, 1, 22, 0, tzinfo=timeline.tz).timestamp()
+    assert timeline.cost(start, start + 90 * 60, 100.0) == pytest.approx(150.0)
+
+def test_overnight_window_wraps_past_midnight():
+    # Friday 22:00 -> Saturday 02:00 at 1.5x
+    timeline = compile_timeline([
+        {"rule_type": "PEAK", "multiplier": 1.5, "start_time": "22:00", "end_time": "02:00", "days_of_week": [4]}
+    ])
+    start = datetime(2024, 3, 1, 21, 0, tzinfo=timeline.tz).timestamp()  # a Friday
+    # 1h at 1x, 4h at 1.5x, 1h at 1x
+    assert timeline.cost(start, start + 6 * 3600, 100.0) == pytest.approx(100 + 600 + 100)
+
+def test_sunday_night_window_wraps_into_monday():
+    timeline = compile_timeline([
+        {"rule_type": "PEAK", "multiplier": 2.0, "start_time": "23:00", "end_time": "01:00", "days_of_week": [6]}
+    ])
+    assert timeline.multiplier_at(WEEK_MINUTES - 30) == 2.0
+    assert timeline.multiplier_at(30) == 2.0
+    assert timeline.multiplier_at(90) == 1.0
+
+def test_overlapping_rules_multiply():
+    timeline = compile_timeline([
+        {"rule_type": "WEEKEND", "multiplier": 1.5},
+        {"rule_type": "HAPPY_HOUR", "multiplier": 0.8, "start_time": "15:00", "end_time": "17:00"},
+    ])
+    saturday_4pm = 5 * DAY_MINUTES + 16 * 60
+    assert timeline.multiplier_at(saturday_4pm) == pytest.approx(1.2)
+    assert timeline.multiplier_at(saturday_4pm - DAY_MINUTES) == pytest.approx(0.8)
+
+def test_wall_minutes_counts_from_reference_monday():
+    timeline = PricingTimeline.flat()
+    local = datetime.combine(REFERENCE_MONDAY, datetime.min.time(), timeline.tz) + timedelta(days=9, minutes=75)
+    assert timeline.wall_minutes(local.timestamp()) == pytest.approx(9 * DAY_MINUTES + 75)
+
+@pytest.mark.parametrize("rule", [
+    {"multiplier": 1.5, "start_time": "25:00"},
+    {"multiplier": 1.5, "start_time": "9am"},
+    {"multiplier": 1.5, "days_of_week": [7]},
+])
+def test_malformed_rules_are_rejected(rule):
+    with pytest.raises(ValueError):
+        rule_windows(rule)